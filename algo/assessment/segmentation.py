@@ -232,7 +232,7 @@ def get_task_context(self):
     context["topics"] = topics_send
 
     # Get the text
-    text = self.document.text
+    text = self.document.get_text()
 
     word_index = self.document.get_word_index()
     term_beginnings = set()
@@ -300,7 +300,7 @@ def alter_task(task, POST):
 
         if new_selection_start < 0:
             new_selection_start = 0
-        doc_length = len(task.document.text)
+        doc_length = len(task.document.get_text())
         if new_selection_end > doc_length:
             new_selection_end = doc_length
         if new_selection_start >= new_selection_end:
@@ -4,6 +4,9 @@ import re
 import numpy as np
 from random import randint
 import pymorphy2
+from django.conf import settings
+from algo.preprocessing.LemmaCache import LemmaCache
+from algo.preprocessing.Tokenizer import tokenize
 
 
 class BowBuilder:
@@ -16,6 +19,10 @@ class BowBuilder:
         self.uci_dir = os.path.join(self.dataset_folder, "UCI")
         self.language = language
         self.morph = pymorphy2.MorphAnalyzer()
+        self.lemma_cache = LemmaCache(getattr(
+            settings, "LEMMA_CACHE_FILE",
+            os.path.join(settings.DATA_DIR, "lemmas.sqlite3")),
+            language=language)
 
         os.makedirs(self.word_index_dir, exist_ok=True)
         os.makedirs(self.uci_dir, exist_ok=True)
@@ -32,7 +39,11 @@ class BowBuilder:
         word = word.lower()
         if word[0] == "#":
             return word
-        return self.morph.parse(word)[0].normal_form
+        lemma = self.lemma_cache.get(word)
+        if lemma is None:
+            lemma = self.morph.parse(word)[0].normal_form
+            self.lemma_cache.put(word, lemma)
+        return lemma
 
     def get_word_id(self, word_text):
         word_text = self.lemmatize(word_text)
@@ -104,34 +115,13 @@ class BowBuilder:
                 return True
         return False
 
-    def char_good(self, c):
-        return (c.isalpha() or c in '#_')
-
-    # TODO: Make generator
     def parse_text(self, doc_file_name):
         with open(doc_file_name, 'r', encoding='utf-8') as f:
             line = f.read()
 
-        cur_pos = 0
-        bracket_level = 0
-        line_len = len(line)
-        while cur_pos < line_len:
-            while cur_pos < line_len and not self.char_good(line[cur_pos]):
-                c = line[cur_pos]
-                if (c == '{' or c == '['):
-                    bracket_level += 1
-                if (c == '}' or c == ']'):
-                    bracket_level -= 1
-                cur_pos += 1
-            init_pos = cur_pos
-
-            while cur_pos < line_len and self.char_good(line[cur_pos]):
-                cur_pos += 1
-
-            length = cur_pos - init_pos
-            word = line[init_pos: init_pos + length]
-            if len(word) > 1:
-                self.add_word_text(word, init_pos, length)
+        for init_pos, length, word, sentence_break in tokenize(
+                line, hashtags=True):
+            self.add_word_text(word, init_pos, length)
 
     def process(self):
         print("Reading documents")
@@ -144,6 +134,7 @@ class BowBuilder:
             jj += 1
             if jj % 100 == 0:
                 print(jj)
+        self.lemma_cache.close()
 
         print("Filtering words")
         self.filter_words()
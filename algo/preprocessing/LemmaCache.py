@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+from collections import OrderedDict
+
+
+# Cache of lemmas of words, keyed by (language, word).
+# Recently used lemmas are kept in memory (at most capacity of them, least
+# recently used are evicted). If file_name is given, lemmas are also stored
+# in SQLite database, which is shared by all datasets and processes: lemmas
+# missing in memory are looked up there, new lemmas are written there in
+# batches.
+class LemmaCache:
+    def __init__(self, file_name=None, language="ru", capacity=100000):
+        self.file_name = file_name
+        self.language = language
+        self.capacity = capacity
+        self.lemmas = OrderedDict()
+        self.pending = []
+        self.flush_size = 1000
+        self.connection = None
+        self.reopen()
+
+    # Opens own connection to database. Must be called in forked process
+    # before cache is used there.
+    def reopen(self):
+        self.pending = []
+        self.connection = None
+        if self.file_name is None:
+            return
+        self.connection = sqlite3.connect(self.file_name, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS lemmas ("
+            "language TEXT NOT NULL, word TEXT NOT NULL, lemma TEXT NOT NULL, "
+            "PRIMARY KEY (language, word)) WITHOUT ROWID")
+        self.connection.commit()
+
+    # Returns lemma of word, or None if it isn't known.
+    def get(self, word):
+        try:
+            lemma = self.lemmas[word]
+            self.lemmas.move_to_end(word)
+            return lemma
+        except KeyError:
+            pass
+        if self.connection is None:
+            return None
+        row = self.connection.execute(
+            "SELECT lemma FROM lemmas WHERE language=? AND word=?",
+            (self.language, word)).fetchone()
+        if row is None:
+            return None
+        self.remember(word, row[0])
+        return row[0]
+
+    def put(self, word, lemma):
+        self.remember(word, lemma)
+        if self.connection is not None:
+            self.pending.append((self.language, word, lemma))
+            if len(self.pending) >= self.flush_size:
+                self.flush()
+
+    def remember(self, word, lemma):
+        self.lemmas[word] = lemma
+        if len(self.lemmas) > self.capacity:
+            self.lemmas.popitem(last=False)
+
+    # Writes new lemmas to database.
+    def flush(self):
+        if self.connection is None or len(self.pending) == 0:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO lemmas (language, word, lemma) "
+                "VALUES (?, ?, ?)", self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
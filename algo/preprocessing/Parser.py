@@ -1,26 +1,69 @@
 # -*- coding: utf-8 -*-
 import os
+import hashlib
+import multiprocessing
+from shutil import copyfileobj, rmtree
 import pymorphy2
+from algo.preprocessing.LemmaCache import LemmaCache
+from algo.preprocessing.Tokenizer import tokenize, get_table
+from algo.preprocessing.WordposPack import WordposPack, WordposPackBuilder
+
+
+# Parser which is run by worker processes in parallel mode. Worker processes
+# are forked, so they get copy of it with all parameters.
+_parser = None
+
+
+# Each worker has its own MorphAnalyzer and connection to lemmas cache, and
+# its own handle of previous vw.txt.
+def _init_worker():
+    _parser.morph = pymorphy2.MorphAnalyzer()
+    _parser.lemma_cache.reopen()
+    if _parser.previous_vw_file is not None:
+        _parser.previous_vw_file = open(_parser.previous_vw_file.name, "rb")
+
+
+def _process_shard(shard_file_name, documents):
+    return _parser.process_shard(shard_file_name, documents)
 
 
 class Parser:
-    def __init__(self, dataset_folder):
+    def __init__(self, dataset_folder, language="russian"):
         self.documents_folder = os.path.join(dataset_folder, "documents")
-        self.output_folder = os.path.join(dataset_folder, "wordpos")
-        os.makedirs(self.output_folder, exist_ok=True)
+        # Positions of words are written to packed container (see
+        # WordposPack) instead of one file per document in wordpos/.
+        self.output_folder = os.path.join(dataset_folder, "wordpos_pack")
         self.morph = pymorphy2.MorphAnalyzer()
-        self.vw_file = open(
-            os.path.join(
-                dataset_folder,
-                "vw.txt"),
-            "w",
-            encoding="utf-8")
-        self.lemmatized = dict()
+        # Language of dataset. Lemmas in cache are keyed by it, so datasets
+        # in different languages don't share lemmas.
+        self.language = language
+        self.vw_file_name = os.path.join(dataset_folder, "vw.txt")
+        # Lemmas cache. By default it is kept only in memory; to share lemmas
+        # between datasets, replace it with cache backed by file (see
+        # use_lemma_cache).
+        self.lemma_cache = LemmaCache(language=self.language)
+
+        # Hashes of documents (relative name -> hash), parsed by previous run
+        # with the same parameters. Documents with unchanged hash aren't
+        # parsed again: their lines are copied from previous vw.txt, and
+        # their positions of words are copied from previous container.
+        self.previous_hashes = dict()
+        # Hashes of documents, filled by process.
+        self.documents_hashes = dict()
+        self.reused_count = 0
 
         self.store_order = False
         self.hashtags = False
         self.bigrams = False
 
+        # Number of worker processes. If it is more than 1, documents are
+        # split into shards, which are parsed in parallel; vw.txt is then
+        # merged from shards in order of os.walk, so it is the same as with
+        # one process.
+        self.workers = 1
+        # Maximal number of documents in one shard.
+        self.shard_size = 1000
+
         self.ctr = 0
 
         self.meta_vw = dict()
@@ -31,90 +74,90 @@ class Parser:
                     pos = line.find(' ')
                     self.meta_vw[line[0:pos]] = line[pos:-1]
 
-        self.char_good = lambda c: c.isalpha()
+    def use_lemma_cache(self, file_name):
+        self.lemma_cache = LemmaCache(file_name, language=self.language)
 
     def lemmatize(self, word):
         word = word.lower()
-        try:
-            return self.lemmatized[word]
-        except BaseException:
-            if word[0] == "#":
-                ans = word
-            else:
-                ans = self.morph.parse(word)[0].normal_form
-            self.lemmatized[word] = ans
-            return ans
+        if word[0] == "#":
+            return word
+        ans = self.lemma_cache.get(word)
+        if ans is None:
+            ans = self.morph.parse(word)[0].normal_form
+            self.lemma_cache.put(word, ans)
+        return ans
 
     def process_document(self, rel_name, doc_name):
         file_name = os.path.join(self.documents_folder, rel_name)
         with open(file_name, "r", encoding='utf-8') as f:
             text = f.read()
 
+        meta = self.meta_vw.get(rel_name, self.meta_vw.get(doc_name, ""))
+        document_hash = hashlib.sha1(
+            (text + "\0" + meta).encode("utf-8")).hexdigest()
+        self.documents_hashes[rel_name] = document_hash
+        if (self.previous_hashes.get(rel_name) == document_hash and
+                rel_name in self.previous_lines and
+                self.previous_pack is not None and
+                rel_name in self.previous_pack):
+            self.previous_vw_file.seek(self.previous_lines[rel_name])
+            self.vw_file.write(
+                self.previous_vw_file.readline().decode("utf-8"))
+            self.wordpos.add_from(self.previous_pack, rel_name)
+            self.reused_count += 1
+            return
+
         self.vw_file.write(rel_name + " |word")
         bow = dict()
         hashtags = []
         bigrams = dict()
 
-        wordpos_file = open(
-            os.path.join(
-                self.output_folder,
-                rel_name),
-            "w",
-            encoding='utf-8')
+        positions = []
+        lengths = []
+        keys = []
 
-        cur_pos = 0
         prev_word = None
         prev_word_start_pos = 0
-        text_len = len(text)
-        while cur_pos < text_len:
-            while cur_pos < text_len and not self.char_good(text[cur_pos]):
-                if text[cur_pos] in "\n.!?":
-                    prev_word = None
-                cur_pos += 1
-            init_pos = cur_pos
-
-            while cur_pos < text_len and self.char_good(text[cur_pos]):
-                cur_pos += 1
-
-            length = cur_pos - init_pos
-            word = text[init_pos: cur_pos]
-            if length > 1:
-                word_lemmatized = self.lemmatize(word)
-                if len(word_lemmatized) <= 1:
-                    continue
-
-                if word_lemmatized[0] == '#' and self.hashtags:
-                    wordpos_file.write(
-                        "%d %d %s$#hashtag\n" %
-                        (init_pos, length, word_lemmatized))
-                    hashtags.append(word_lemmatized)
-                    prev_word = None
+        for init_pos, length, word, sentence_break in tokenize(
+                text, hashtags=self.hashtags):
+            if sentence_break:
+                prev_word = None
+            word_lemmatized = self.lemmatize(word)
+            if len(word_lemmatized) <= 1:
+                continue
+
+            if word_lemmatized[0] == '#' and self.hashtags:
+                positions.append(init_pos)
+                lengths.append(length)
+                keys.append(word_lemmatized + "$#hashtag")
+                hashtags.append(word_lemmatized)
+                prev_word = None
+            else:
+                if self.bigrams:
+                    if prev_word:
+                        bigram_text = prev_word + "_" + word_lemmatized
+                        bigram_pos = prev_word_start_pos
+                        bigram_length = init_pos + \
+                            length - prev_word_start_pos
+                        positions.append(bigram_pos)
+                        lengths.append(bigram_length)
+                        keys.append(bigram_text + "$#bigram")
+                        try:
+                            bigrams[bigram_text] += 1
+                        except BaseException:
+                            bigrams[bigram_text] = 1
+                    prev_word_start_pos = init_pos
+                    prev_word = word_lemmatized
+                positions.append(init_pos)
+                lengths.append(length)
+                keys.append(word_lemmatized + "$#word")
+                if self.store_order:
+                    self.vw_file.write(" " + word_lemmatized)
                 else:
-                    if self.bigrams:
-                        if prev_word:
-                            bigram_text = prev_word + "_" + word_lemmatized
-                            bigram_pos = prev_word_start_pos
-                            bigram_length = init_pos + \
-                                length - prev_word_start_pos
-                            wordpos_file.write(
-                                "%d %d %s$#bigram\n" %
-                                (bigram_pos, bigram_length, bigram_text))
-                            try:
-                                bigrams[bigram_text] += 1
-                            except BaseException:
-                                bigrams[bigram_text] = 1
-                        prev_word_start_pos = init_pos
-                        prev_word = word_lemmatized
-                    wordpos_file.write(
-                        "%d %d %s$#word\n" %
-                        (init_pos, length, word_lemmatized))
-                    if self.store_order:
-                        self.vw_file.write(" " + word_lemmatized)
+                    if word_lemmatized in bow:
+                        bow[word_lemmatized] += 1
                     else:
-                        if word_lemmatized in bow:
-                            bow[word_lemmatized] += 1
-                        else:
-                            bow[word_lemmatized] = 1
+                        bow[word_lemmatized] = 1
 
         if not self.store_order:
             for word, count in bow.items():
@@ -139,30 +182,108 @@ class Parser:
         elif doc_name in self.meta_vw:
             self.vw_file.write(self.meta_vw[doc_name])
         self.vw_file.write("\n")
-        wordpos_file.close()
+        self.wordpos.add(rel_name, positions, lengths, keys)
 
         self.ctr += 1
         # if self.ctr % 100 == 0:
         #    print(self.ctr)
 
     def process(self):
-        if self.hashtags:
-            self.char_good = lambda c: c.isalpha() or c in '#_'
+        # Lookup table of tokenizer is built before workers are forked.
+        get_table(self.hashtags)
 
+        # Offsets of lines of previous vw.txt by names of documents.
+        self.previous_lines = dict()
+        self.previous_vw_file = None
+        self.previous_pack = None
+        if (len(self.previous_hashes) > 0 and
+                WordposPack.exists(self.output_folder)):
+            self.previous_pack = WordposPack(self.output_folder)
+        previous_vw_file_name = self.vw_file_name + ".old"
+        if len(self.previous_hashes) > 0 and os.path.exists(self.vw_file_name):
+            os.replace(self.vw_file_name, previous_vw_file_name)
+            self.previous_vw_file = open(previous_vw_file_name, "rb")
+            offset = 0
+            for line in self.previous_vw_file:
+                name = line.split(b" ", 1)[0].decode("utf-8")
+                self.previous_lines[name] = offset
+                offset += len(line)
+
+        documents = []
         root_path_length = len(self.documents_folder)
         for root, subdirs, files in os.walk(self.documents_folder):
             rel_foler_path = root[root_path_length + 1:]
-            for subdir in subdirs:
-                rel_subdir = os.path.join(rel_foler_path, subdir)
-                os.makedirs(
-                    os.path.join(
-                        self.output_folder,
-                        rel_subdir),
-                    exist_ok=True)
             for file in files:
                 rel_file_name = os.path.join(rel_foler_path, file)
+                documents.append((rel_file_name, file))
+
+        if (self.workers > 1 and len(documents) > 1 and
+                "fork" in multiprocessing.get_all_start_methods()):
+            self.process_parallel(documents)
+        else:
+            self.vw_file = open(self.vw_file_name, "w", encoding="utf-8")
+            self.wordpos = WordposPackBuilder(self.output_folder)
+            for rel_file_name, file in documents:
                 self.process_document(rel_file_name, file)
+            self.vw_file.close()
+            self.wordpos.finish()
+            self.lemma_cache.flush()
+
+        if self.previous_vw_file is not None:
+            self.previous_vw_file.close()
+            os.remove(previous_vw_file_name)
+
+        # Files of old layout are superseded by container.
+        old_wordpos_folder = os.path.join(
+            os.path.dirname(self.documents_folder), "wordpos")
+        if os.path.exists(old_wordpos_folder):
+            rmtree(old_wordpos_folder)
+
+    # Parses shard of documents, writing their lines to separate file and
+    # positions of their words to separate container.
+    # Returns hashes of documents and number of reused documents.
+    def process_shard(self, shard_file_name, documents):
+        self.documents_hashes = dict()
+        self.reused_count = 0
+        self.vw_file = open(shard_file_name, "w", encoding="utf-8")
+        self.wordpos = WordposPackBuilder(shard_file_name + ".wordpos")
+        for rel_file_name, file in documents:
+            self.process_document(rel_file_name, file)
         self.vw_file.close()
+        self.wordpos.finish()
+        self.lemma_cache.flush()
+        return self.documents_hashes, self.reused_count
+
+    def process_parallel(self, documents):
+        global _parser
+        _parser = self
+        # Several shards per worker, so workers are evenly loaded.
+        shard_size = max(1, min(self.shard_size,
+                                len(documents) // (4 * self.workers)))
+        shards = [documents[i: i + shard_size]
+                  for i in range(0, len(documents), shard_size)]
+        context = multiprocessing.get_context("fork")
+        with context.Pool(self.workers, initializer=_init_worker) as pool:
+            results = [
+                pool.apply_async(_process_shard, (
+                    self.vw_file_name + ".shard" + str(i), shard))
+                for i, shard in enumerate(shards)]
+            wordpos = WordposPackBuilder(self.output_folder)
+            with open(self.vw_file_name, "wb") as vw_file:
+                for i, result in enumerate(results):
+                    documents_hashes, reused_count = result.get()
+                    self.documents_hashes.update(documents_hashes)
+                    self.reused_count += reused_count
+                    self.ctr += len(shards[i])
+                    shard_file_name = self.vw_file_name + ".shard" + str(i)
+                    with open(shard_file_name, "rb") as shard_file:
+                        copyfileobj(shard_file, vw_file)
+                    os.remove(shard_file_name)
+                    wordpos.add_pack(
+                        WordposPack(shard_file_name + ".wordpos"))
+                    rmtree(shard_file_name + ".wordpos")
+            wordpos.finish()
+        _parser = None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import sys
+import numpy as np
+
+
+# Tokenizer, which splits text into words with array operations instead of
+# loop over characters. Word is maximal run of alphabetic characters (in
+# sense of str.isalpha), or also of '#' and '_' in hashtags mode, so spans
+# are exactly the same as spans found by such loop.
+
+# Lookup tables: code of character -> whether it belongs to word.
+_tables = dict()
+
+# Characters which break sentence (and so bigrams).
+SENTENCE_BREAK = "\n.!?"
+
+
+def get_table(hashtags=False):
+    if hashtags not in _tables:
+        if False not in _tables:
+            _tables[False] = np.fromiter(
+                (chr(code).isalpha() for code in range(sys.maxunicode + 1)),
+                dtype=bool, count=sys.maxunicode + 1)
+        if hashtags:
+            table = _tables[False].copy()
+            table[[ord('#'), ord('_')]] = True
+            _tables[True] = table
+    return _tables[hashtags]
+
+
+# Returns list of tuples (position, length, word, sentence_break) for words
+# not shorter than min_length. sentence_break is True if there is sentence
+# break character between previous returned word and this word.
+def tokenize(text, hashtags=False, min_length=2):
+    codes = np.frombuffer(text.encode("utf-32-le", "surrogatepass"),
+                          dtype=np.uint32)
+    in_word = np.zeros(len(codes) + 2, dtype=np.int8)
+    in_word[1:-1] = get_table(hashtags)[codes]
+    edges = np.diff(in_word)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    long_enough = ends - starts >= min_length
+    starts = starts[long_enough]
+    ends = ends[long_enough]
+    if len(starts) == 0:
+        return []
+
+    is_break = np.zeros(len(codes), dtype=bool)
+    for c in SENTENCE_BREAK:
+        is_break |= codes == ord(c)
+    breaks = np.flatnonzero(is_break)
+    previous_ends = np.concatenate(([0], ends[:-1]))
+    sentence_breaks = (np.searchsorted(breaks, starts) !=
+                       np.searchsorted(breaks, previous_ends))
+
+    starts = starts.tolist()
+    ends = ends.tolist()
+    return list(zip(starts, [end - start for start, end in zip(starts, ends)],
+                    [text[start: end] for start, end in zip(starts, ends)],
+                    sentence_breaks.tolist()))
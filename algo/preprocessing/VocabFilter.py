@@ -1,8 +1,23 @@
 # -*- coding: utf-8 -*-
+import os
+import heapq
+import tempfile
+from shutil import rmtree
 
 
+# Approximate number of bytes, used by one entry of counts dict besides key.
+ENTRY_SIZE = 200
+
+
+# Counts of terms are exact. If memory_limit (in bytes) is given, counts
+# dict is spilled to sorted run on disk each time it becomes larger than
+# memory_limit, and runs are merged by save_vocabulary. Each count keeps
+# number of first occurence of term, so vocabulary is written in the same
+# order as without limit. Kept terms are sorted by first occurence in runs
+# on disk as well, so only set of kept words (needed to check bigrams) is
+# held in memory by save_vocabulary.
 class VocabFilter():
-    def __init__(self, vw_file):
+    def __init__(self, vw_file, memory_limit=None, temp_folder=None):
         self.lower_bound = 0
         self.upper_bound = 1000000
         self.upper_bound_relative = 1000000
@@ -10,7 +25,13 @@ class VocabFilter():
         self.total_terms_count = 0
         self.minimal_length = 1
 
+        self.memory_limit = memory_limit
+        self.temp_parent = temp_folder or os.path.dirname(vw_file)
+        self.temp_folder = None
+        self.runs = []
+        # key -> [count, number of first occurence]
         self.vocab = dict()
+        vocab_size = 0
         with open(vw_file, "r", encoding="utf-8") as f:
             for line in f:
                 self.documents_count += 1
@@ -27,38 +48,147 @@ class VocabFilter():
                         else:
                             count = 1
                         try:
-                            self.vocab[key] += count
+                            self.vocab[key][0] += count
                         except BaseException:
-                            self.vocab[key] = count
+                            self.vocab[key] = [count, self.total_terms_count]
+                            vocab_size += len(key) + ENTRY_SIZE
                         self.total_terms_count += count
+                if (self.memory_limit is not None and
+                        vocab_size > self.memory_limit):
+                    self.spill()
+                    vocab_size = 0
+
+    def get_temp_folder(self):
+        if self.temp_folder is None:
+            self.temp_folder = tempfile.mkdtemp(dir=self.temp_parent)
+        return self.temp_folder
+
+    # Writes counts to sorted run and clears them.
+    def spill(self):
+        run_file_name = os.path.join(self.get_temp_folder(),
+                                     "run%d.txt" % len(self.runs))
+        with open(run_file_name, "w", encoding="utf-8") as f:
+            for key in sorted(self.vocab):
+                count, first = self.vocab[key]
+                f.write("%s\t%d\t%d\n" % (key, count, first))
+        self.runs.append(run_file_name)
+        self.vocab = dict()
+
+    def read_run(run_file_name):
+        with open(run_file_name, "r", encoding="utf-8") as f:
+            for line in f:
+                key, count, first = line.split("\t")
+                yield key, int(count), int(first)
+
+    # Yields triples (key, count, number of first occurence) for all terms,
+    # merged from runs (in order of keys) or taken from counts dict (in order
+    # of first occurence).
+    def entries(self):
+        if len(self.runs) == 0:
+            for key, (count, first) in self.vocab.items():
+                yield key, count, first
+            return
+
+        self.spill()
+        merged = heapq.merge(*[VocabFilter.read_run(run_file_name)
+                               for run_file_name in self.runs])
+        current_key = None
+        for key, count, first in merged:
+            if key == current_key:
+                current_count += count
+                current_first = min(current_first, first)
+                continue
+            if current_key is not None:
+                yield current_key, current_count, current_first
+            current_key, current_count, current_first = key, count, first
+        if current_key is not None:
+            yield current_key, current_count, current_first
 
     def word_good(self, word, count):
         return count >= self.lower_bound and count <= self.upper_bound and len(
             word) >= self.minimal_length
 
+    # Bigram is kept only if both its words are kept.
     def save_vocabulary(self, vocab_file):
+        self.upper_bound = min(
+            self.upper_bound,
+            self.upper_bound_relative *
+            self.documents_count)
+
+        good_words = set()
+        good_entries = SortedEntries(self)
+        bigrams = SortedEntries(self)
+        for entry, count, first in self.entries():
+            word, modality = entry.split()
+            if self.word_good(word, count):
+                if modality == "word":
+                    good_words.add(word)
+                if modality == "bigram":
+                    bigrams.add(first, entry)
+                else:
+                    good_entries.add(first, entry)
+        self.vocab = dict()
+
+        for first, entry in bigrams:
+            try:
+                word1, word2 = entry.split()[0].split('_')
+            except BaseException:
+                continue
+            if word1 in good_words and word2 in good_words:
+                good_entries.add(first, entry)
+
         with open(vocab_file, "w", encoding="utf-8") as f:
-            self.upper_bound = min(
-                self.upper_bound,
-                self.upper_bound_relative *
-                self.documents_count)
-            for entry, count in self.vocab.items():
-                word, modality = entry.split()
-                if self.word_good(word, count):
-                    if modality == "bigram":
-                        try:
-                            word1, word2 = word.split('_')
-                            count1 = self.vocab[word1 + " word"]
-                            count2 = self.vocab[word2 + " word"]
-                            if not self.word_good(
-                                    word1,
-                                    count1) or not self.word_good(
-                                    word2,
-                                    count2):
-                                continue
-                        except BaseException:
-                            continue
-                    f.write(entry + "\n")
+            for first, entry in good_entries:
+                f.write(entry + "\n")
+
+        if self.temp_folder is not None:
+            rmtree(self.temp_folder)
+            self.temp_folder = None
+            self.runs = []
+
+
+# Pairs (number of first occurence, entry), iterated in order of first
+# occurence. If memory limit of filter is given, pairs are written to sorted
+# runs on disk each time they take more memory, and runs are merged.
+class SortedEntries():
+    def __init__(self, vocab_filter):
+        self.vocab_filter = vocab_filter
+        self.entries = []
+        self.size = 0
+        self.runs = []
+
+    def add(self, first, entry):
+        self.entries.append((first, entry))
+        self.size += len(entry) + ENTRY_SIZE
+        memory_limit = self.vocab_filter.memory_limit
+        if memory_limit is not None and self.size > memory_limit:
+            self.spill()
+
+    def spill(self):
+        run_file_name = os.path.join(
+            self.vocab_filter.get_temp_folder(),
+            "sorted%d_%d.txt" % (id(self), len(self.runs)))
+        self.entries.sort()
+        with open(run_file_name, "w", encoding="utf-8") as f:
+            for first, entry in self.entries:
+                f.write("%d\t%s\n" % (first, entry))
+        self.runs.append(run_file_name)
+        self.entries = []
+        self.size = 0
+
+    def read_run(run_file_name):
+        with open(run_file_name, "r", encoding="utf-8") as f:
+            for line in f:
+                first, entry = line.rstrip("\n").split("\t")
+                yield int(first), entry
+
+    def __iter__(self):
+        if len(self.runs) == 0:
+            self.entries.sort()
+            return iter(self.entries)
+        self.spill()
+        return heapq.merge(*[SortedEntries.read_run(run_file_name)
+                             for run_file_name in self.runs])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+from shutil import rmtree
+
+
+# Packed container of positions of words in documents, which replaces folder
+# wordpos/ with one file per document.
+#
+# Container is folder with files:
+#     names.txt   - relative names of documents, one per line;
+#     offsets.npy - int64, offsets of records of documents in records.bin
+#                   (document i has records offsets[i]:offsets[i+1]);
+#     keys.txt    - keys of terms ("word$#modality"), one per line;
+#     records.bin - records (position, length, number of key in keys.txt).
+# records.bin and offsets.npy are memory-mapped, so records of document are
+# read without copying and without parsing text.
+
+RECORD_DTYPE = np.dtype([("pos", "<u4"), ("length", "<u4"), ("key", "<u4")])
+
+
+class WordposPack:
+    def __init__(self, folder):
+        self.folder = folder
+        self.offsets = np.load(os.path.join(folder, "offsets.npy"),
+                               mmap_mode='r')
+        records_file = os.path.join(folder, "records.bin")
+        if os.path.getsize(records_file) > 0:
+            self.records = np.memmap(records_file, dtype=RECORD_DTYPE,
+                                     mode='r')
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        with open(os.path.join(folder, "keys.txt"), "r",
+                  encoding="utf-8") as f:
+            self.keys = f.read().split("\n")[:-1]
+        with open(os.path.join(folder, "names.txt"), "r",
+                  encoding="utf-8") as f:
+            self.names = dict((name, i) for i, name in
+                              enumerate(f.read().split("\n")[:-1]))
+
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, "offsets.npy"))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    # Returns records of document (view of memory-mapped file), or None if
+    # there is no such document in container.
+    def get(self, name):
+        i = self.names.get(name)
+        if i is None:
+            return None
+        return self.records[self.offsets[i]: self.offsets[i + 1]]
+
+    # Returns array, which maps number of key to value from dictionary
+    # (missing keys are mapped to default).
+    def map_keys(self, dictionary, default=-1, dtype=np.int64):
+        return np.array([dictionary.get(key, default) for key in self.keys],
+                        dtype=dtype)
+
+
+class WordposPackBuilder:
+    def __init__(self, folder):
+        self.folder = folder
+        self.temp_folder = folder + ".new"
+        if os.path.exists(self.temp_folder):
+            rmtree(self.temp_folder)
+        os.makedirs(self.temp_folder)
+        self.records_file = open(
+            os.path.join(self.temp_folder, "records.bin"), "wb")
+        self.names = []
+        self.offsets = [0]
+        self.keys = dict()
+
+    def get_key(self, key):
+        try:
+            return self.keys[key]
+        except KeyError:
+            self.keys[key] = len(self.keys)
+            return self.keys[key]
+
+    def write(self, name, records):
+        self.records_file.write(records.tobytes())
+        self.names.append(name)
+        self.offsets.append(self.offsets[-1] + len(records))
+
+    # Adds document. Arguments are lists of positions, lengths and keys of its
+    # words.
+    def add(self, name, positions, lengths, keys):
+        records = np.zeros(len(keys), dtype=RECORD_DTYPE)
+        records["pos"] = positions
+        records["length"] = lengths
+        records["key"] = [self.get_key(key) for key in keys]
+        self.write(name, records)
+
+    # Copies document from other container.
+    def add_from(self, pack, name):
+        records = np.array(pack.get(name))
+        keys = [pack.keys[key] for key in records["key"].tolist()]
+        records["key"] = [self.get_key(key) for key in keys]
+        self.write(name, records)
+
+    # Appends all documents of other container, in their order.
+    def add_pack(self, pack):
+        keys_map = np.array([self.get_key(key) for key in pack.keys],
+                            dtype=np.uint32)
+        names = sorted(pack.names, key=pack.names.get)
+        block_size = 1 << 20
+        for start in range(0, len(pack.records), block_size):
+            records = np.array(pack.records[start: start + block_size])
+            records["key"] = keys_map[records["key"]]
+            self.records_file.write(records.tobytes())
+        base = self.offsets[-1]
+        self.offsets.extend((base + pack.offsets[1:]).tolist())
+        self.names.extend(names)
+
+    def finish(self):
+        self.records_file.close()
+        np.save(os.path.join(self.temp_folder, "offsets.npy"),
+                np.array(self.offsets, dtype=np.int64))
+        keys = sorted(self.keys, key=self.keys.get)
+        with open(os.path.join(self.temp_folder, "keys.txt"), "w",
+                  encoding="utf-8") as f:
+            f.write("".join(key + "\n" for key in keys))
+        with open(os.path.join(self.temp_folder, "names.txt"), "w",
+                  encoding="utf-8") as f:
+            f.write("".join(name + "\n" for name in self.names))
+        if os.path.exists(self.folder):
+            rmtree(self.folder)
+        os.rename(self.temp_folder, self.folder)
+        return WordposPack(self.folder)
@@ -1,4 +1,102 @@
+import io
 import os
+import heapq
+import tempfile
+import multiprocessing
+import numpy as np
+from shutil import copyfileobj, rmtree
+
+
+# Both converters split input file into chunks of lines (by byte offsets),
+# which are converted by forked worker processes into separate files, and
+# then concatenated in order. Memory used by worker is bounded by size of
+# chunk, so files of any size can be converted.
+
+# Approximate size of chunk in bytes.
+CHUNK_SIZE = 1 << 25
+
+# Maximal number of chunks (and so of files merged at once).
+MAX_CHUNKS = 512
+
+# Object, which is used by worker processes. Worker processes are forked, so
+# they get copy of it.
+_converter = None
+
+
+def _convert_chunk(method, *args):
+    return getattr(_converter, method)(*args)
+
+
+# Calls method of converter for each tuple of arguments and returns list of
+# results in order of arguments. If fork isn't available, works in-process.
+def map_chunks(converter, method, args_list, workers=None):
+    global _converter
+    if workers is None:
+        workers = os.cpu_count() or 1
+    _converter = converter
+    try:
+        if (workers <= 1 or len(args_list) <= 1 or
+                "fork" not in multiprocessing.get_all_start_methods()):
+            return [_convert_chunk(method, *args) for args in args_list]
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers) as pool:
+            results = [pool.apply_async(_convert_chunk, (method, ) + args)
+                       for args in args_list]
+            return [result.get() for result in results]
+    finally:
+        _converter = None
+
+
+# Returns list of pairs (begin, end) of byte offsets, which split file into
+# chunks of whole lines. If key is given, chunk can start only at line, for
+# which key differs from key of previous line (lines for which key returns
+# None are ignored).
+def split_file(file_name, chunk_size=CHUNK_SIZE, key=None):
+    size = os.path.getsize(file_name)
+    chunk_size = max(chunk_size, size // MAX_CHUNKS + 1)
+    bounds = [0]
+    with open(file_name, "rb") as f:
+        position = chunk_size
+        while position < size:
+            f.seek(position)
+            f.readline()
+            previous_key = None
+            while True:
+                position = f.tell()
+                line = f.readline()
+                if len(line) == 0:
+                    break
+                if key is None:
+                    break
+                line_key = key(line)
+                if line_key is None:
+                    continue
+                if previous_key is not None and line_key != previous_key:
+                    break
+                previous_key = line_key
+            if position >= size:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+            position += chunk_size
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Returns decoded lines of chunk of file (with the same newlines handling
+# as for file opened in text mode).
+def read_lines(file_name, begin, end):
+    with open(file_name, "rb") as f:
+        f.seek(begin)
+        data = f.read(end - begin)
+    return io.TextIOWrapper(io.BytesIO(data), encoding="utf-8")
+
+
+def concatenate(file_names, output_file):
+    for file_name in file_names:
+        with open(file_name, "rb") as f:
+            copyfileobj(f, output_file)
+        os.remove(file_name)
 
 
 class UciReader:
@@ -19,111 +117,261 @@ class UciReader:
         self.docword_file = docword_file
         self.log("UCI read OK")
 
+    # Returns id of document of line of docword file, or None if it isn't
+    # an entry (header).
+    def get_doc_id(line):
+        parsed = line.split()
+        if len(parsed) != 3:
+            return None
+        return int(parsed[0])
+
+    def save_vw(self, output_file, workers=None):
+        chunks = split_file(self.docword_file, key=UciReader.get_doc_id)
+        temp_folder = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(output_file)))
+        self.log("Converting %d chunks..." % len(chunks))
+        args_list = [(os.path.join(temp_folder, "chunk%d" % i), begin, end,
+                      i == 0)
+                     for i, (begin, end) in enumerate(chunks)]
+        map_chunks(self, "save_vw_chunk", args_list, workers)
+        with open(output_file, "wb") as out:
+            concatenate([args[0] for args in args_list], out)
+        rmtree(temp_folder)
+        self.log("Converted.")
+
+    # Converts documents from chunk of docword file. Documents don't cross
+    # bounds of chunks. As before, first document is numbered 1 even if
+    # docword starts from other document.
+    def save_vw_chunk(self, chunk_file_name, begin, end, first_chunk):
+        out = open(chunk_file_name, "w", encoding='utf-8')
+        self.out = out
+        self.cur_doc_id = 1 if first_chunk else None
+        self.bow = dict()
+        for line in read_lines(self.docword_file, begin, end):
+            parsed = line.split()
+            if len(parsed) != 3:
+                continue
+            doc_id = int(parsed[0])
+            if self.cur_doc_id is None:
+                self.cur_doc_id = doc_id
+            if doc_id != self.cur_doc_id:
+                self.write_doc()
+                self.cur_doc_id = doc_id
+            word, modality = self.vocab[int(parsed[1])]
+            count = parsed[2]
+            write = word
+            if ':' in word:
+                print("Warning! Colon found! Term ignored.")
+                continue
+            if count != "1":
+                write += ':' + count
+            try:
+                self.bow[modality].append(write)
+            except KeyError:
+                self.bow[modality] = [write]
+
+        if self.cur_doc_id is not None:
+            self.write_doc()
+        out.close()
+
     def write_doc(self):
         self.out.write("%06d.txt " % self.cur_doc_id)
-        for modality, string in self.bow.items():
-            self.out.write("|%s %s" % (modality, string))
+        for modality, words in self.bow.items():
+            self.out.write("|%s %s " % (modality, " ".join(words)))
         self.out.write("\n")
-        # if self.cur_doc_id % 100 == 0:
-        #     print(self.cur_doc_id)
-        self.bow = {}
-
-    def save_vw(self, output_file):
-        self.out = open(output_file, "w", encoding='utf-8')
-        self.cur_doc_id = 1
         self.bow = dict()
-        with open(self.docword_file, "r", encoding="utf-8") as f:
-            for line in f:
-                parsed = line.split()
-                if len(parsed) != 3:
-                    continue
-                doc_id = int(parsed[0])
-                if doc_id != self.cur_doc_id:
-                    self.write_doc()
-                    self.cur_doc_id = doc_id
-                    if self.cur_doc_id % 1000 == 0:
-                        self.log(str(self.cur_doc_id))
-                word, modality = self.vocab[int(parsed[1])]
-                count = parsed[2]
-                write = word
-                if ':' in word:
-                    print("Warning! Colon found! Term ignored.")
-                    continue
-                if count != "1":
-                    write += ':' + count
-                try:
-                    self.bow[modality] += write + ' '
-                except BaseException:
-                    self.bow[modality] = write + ' '
-
-        self.write_doc()
-        self.out.close()
 
     def log(self, s):
         if self.logger:
             self.logger.log(s)
 
 
-def uci2vw(docword_file_name, vocab_file_name, vw_file_name, logger=None):
+def uci2vw(docword_file_name, vocab_file_name, vw_file_name, logger=None,
+           workers=None):
     uci = UciReader(docword_file_name, vocab_file_name, logger=logger)
-    uci.save_vw(vw_file_name)
-
-
-def vw2uci(vw_file_name, docword_file_name, vocab_file_name):
-    vocab = dict()
-    temp_docword_file_name = os.path.join(
-        os.path.dirname(vw_file_name), "temp.txt")
-    temp_docword_file = open(temp_docword_file_name, "w")
-    vocab_file = open(vocab_file_name, "w", encoding='utf-8')
-
-    docs_counter = 0
-    terms_counter = 0
-    entries_counter = 0
-
-    for line in open(vw_file_name, encoding='utf-8'):
-        docs_counter += 1
-        tokens = line.split()
-        current_modality = "@default_class"
-        bow = dict()
-        for token in tokens[1:]:
-            if token[0] == '|':
-                current_modality = token[1:]
-            else:
-                parsed = token.split(':')
-                try:
-                    cnt = int(parsed[1])
-                except BaseException:
-                    cnt = 1
+    uci.save_vw(vw_file_name, workers=workers)
 
-                word = parsed[0] + " " + current_modality
-                try:
-                    wid = vocab[word]
-                except BaseException:
-                    vocab_file.write(word + "\n")
-                    terms_counter += 1
-                    vocab[word] = terms_counter
-                    wid = terms_counter
 
+# Returns dict, which maps keys of terms of line of Vowpal Wabbit file
+# ("word modality") to their counts, in order of first occurence.
+def parse_vw_line(line):
+    bow = dict()
+    tokens = line.split()
+    current_modality = "@default_class"
+    for token in tokens[1:]:
+        if token[0] == '|':
+            current_modality = token[1:]
+            continue
+        cnt = 1
+        if ':' in token:
+            parsed = token.split(':')
+            token = parsed[0]
+            try:
+                cnt = int(parsed[1])
+            except ValueError:
+                pass
+        key = token + " " + current_modality
+        try:
+            bow[key] += cnt
+        except KeyError:
+            bow[key] = cnt
+    return bow
+
+
+# Converter of Vowpal Wabbit file to UCI format in two passes.
+# First pass parses each chunk: it writes distinct terms of chunk with
+# numbers of their first occurences as run sorted by term, and entries of
+# chunk (document, number of term in chunk, count) as arrays. Runs are
+# merged, and terms get ids in order of first occurence in file (as if they
+# were numbered in one pass). Sorted terms are stored in memory-mapped
+# array, so second pass finds ids of terms of each chunk with binary search
+# and writes docword entries of chunk without parsing it again.
+class VwConverter:
+    def __init__(self, vw_file_name, temp_folder):
+        self.vw_file_name = vw_file_name
+        self.temp_folder = temp_folder
+        self.terms = None
+
+    # Writes distinct terms of chunk, sorted, with numbers of their first
+    # occurences in chunk, and entries of chunk. Returns number of lines in
+    # chunk.
+    def collect_terms(self, run_file_name, begin, end):
+        first = dict()
+        docs = []
+        terms = []
+        counts = []
+        lines_count = 0
+        for line in read_lines(self.vw_file_name, begin, end):
+            for key, cnt in parse_vw_line(line).items():
                 try:
-                    bow[wid] += cnt
-                except BaseException:
-                    bow[wid] = cnt
-
-        for key, value in sorted(bow.items()):
-            temp_docword_file.write("%d %d %d\n" % (docs_counter, key, value))
-            entries_counter += 1
-
-    temp_docword_file.close()
-    vocab_file.close()
-
-    with open(docword_file_name, "w") as f:
-        f.write(
-            "%d\n%d\n%d\n" %
-            (docs_counter,
-             terms_counter,
-             entries_counter))
-        for line in open(temp_docword_file_name):
-            f.write(line)
+                    terms.append(first[key])
+                except KeyError:
+                    terms.append(len(first))
+                    first[key] = len(first)
+                counts.append(cnt)
+                docs.append(lines_count)
+            lines_count += 1
+        with open(run_file_name, "w", encoding="utf-8") as f:
+            for key in sorted(first):
+                f.write("%s\t%d\n" % (key, first[key]))
+        np.save(run_file_name + ".docs.npy", np.array(docs, dtype=np.int64))
+        np.save(run_file_name + ".terms.npy",
+                np.array(terms, dtype=np.int64))
+        np.save(run_file_name + ".counts.npy",
+                np.array(counts, dtype=np.int64))
+        return lines_count
+
+    def read_run(run_file_name, chunk):
+        with open(run_file_name, "r", encoding="utf-8") as f:
+            for line in f:
+                key, position = line[:-1].split("\t")
+                yield key, chunk, int(position)
+
+    # Merges runs of chunks and writes vocabulary. Returns number of terms.
+    def assign_ids(self, run_file_names, vocab_file_name):
+        keys_file_name = os.path.join(self.temp_folder, "keys.txt")
+        firsts = []
+        max_length = 1
+        merged = heapq.merge(*[VwConverter.read_run(run_file_name, chunk)
+                               for chunk, run_file_name in
+                               enumerate(run_file_names)])
+        with open(keys_file_name, "w", encoding="utf-8") as keys_file:
+            previous_key = None
+            for key, chunk, position in merged:
+                # Runs with the same key are merged in order of chunks, so
+                # the first one holds the first occurence.
+                if key == previous_key:
+                    continue
+                previous_key = key
+                keys_file.write(key + "\n")
+                firsts.append((chunk << 40) | position)
+                max_length = max(max_length, len(key.encode("utf-8")))
+
+        terms_count = len(firsts)
+        order = np.argsort(np.array(firsts, dtype=np.int64), kind="mergesort")
+        del firsts
+        self.ids = np.lib.format.open_memmap(
+            os.path.join(self.temp_folder, "ids.npy"), mode="w+",
+            dtype=np.int64, shape=(terms_count, ))
+        self.ids[order] = np.arange(1, terms_count + 1)
+        self.terms = np.lib.format.open_memmap(
+            os.path.join(self.temp_folder, "terms.npy"), mode="w+",
+            dtype="S%d" % max_length, shape=(terms_count, ))
+        offsets = np.zeros(terms_count + 1, dtype=np.int64)
+        with open(keys_file_name, "rb") as keys_file:
+            i = 0
+            for line in keys_file:
+                self.terms[i] = line[:-1]
+                offsets[i + 1] = offsets[i] + len(line)
+                i += 1
+        self.terms.flush()
+        self.ids.flush()
+
+        keys = np.memmap(keys_file_name, dtype=np.uint8, mode="r") \
+            if terms_count > 0 else np.zeros(0, dtype=np.uint8)
+        with open(vocab_file_name, "wb") as vocab_file:
+            for i in order.tolist():
+                vocab_file.write(keys[offsets[i]: offsets[i + 1]].tobytes())
+        del keys
+        os.remove(keys_file_name)
+        return terms_count
+
+    # Writes docword entries of chunk, whose documents are numbered from
+    # first_doc_id. Returns number of entries.
+    def write_entries(self, chunk_file_name, run_file_name, first_doc_id):
+        keys = []
+        positions = []
+        for key, chunk, position in VwConverter.read_run(run_file_name, 0):
+            keys.append(key.encode("utf-8"))
+            positions.append(position)
+        ids = np.zeros(len(keys), dtype=np.int64)
+        if len(keys) > 0:
+            ids[positions] = self.ids[np.searchsorted(
+                self.terms, np.array(keys, dtype=self.terms.dtype))]
+        docs = np.load(run_file_name + ".docs.npy") + first_doc_id
+        terms = ids[np.load(run_file_name + ".terms.npy")]
+        counts = np.load(run_file_name + ".counts.npy")
+        for suffix in ["", ".docs.npy", ".terms.npy", ".counts.npy"]:
+            os.remove(run_file_name + suffix)
+
+        order = np.lexsort((terms, docs))
+        with open(chunk_file_name, "w") as f:
+            f.write("".join(
+                "%d %d %d\n" % entry for entry in zip(
+                    docs[order].tolist(), terms[order].tolist(),
+                    counts[order].tolist())))
+        return len(order)
+
+
+def vw2uci(vw_file_name, docword_file_name, vocab_file_name, workers=None):
+    temp_folder = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(docword_file_name)))
+    converter = VwConverter(vw_file_name, temp_folder)
+    chunks = split_file(vw_file_name)
+
+    run_file_names = [os.path.join(temp_folder, "run%d" % i)
+                      for i in range(len(chunks))]
+    lines_counts = map_chunks(converter, "collect_terms", [
+        (run_file_name, begin, end)
+        for run_file_name, (begin, end) in zip(run_file_names, chunks)],
+        workers)
+    terms_count = converter.assign_ids(run_file_names, vocab_file_name)
+
+    first_doc_ids = np.cumsum([1] + lines_counts[:-1]).tolist()
+    chunk_file_names = [os.path.join(temp_folder, "chunk%d" % i)
+                        for i in range(len(chunks))]
+    entries_counts = map_chunks(converter, "write_entries", [
+        (chunk_file_name, run_file_name, first_doc_id)
+        for chunk_file_name, run_file_name, first_doc_id in
+        zip(chunk_file_names, run_file_names, first_doc_ids)], workers)
+
+    with open(docword_file_name, "wb") as f:
+        f.write(("%d\n%d\n%d\n" % (sum(lines_counts), terms_count,
+                                   sum(entries_counts))).encode())
+        concatenate(chunk_file_names, f)
+    converter.terms = None
+    converter.ids = None
+    rmtree(temp_folder)
 
 
 if __name__ == "__main__":
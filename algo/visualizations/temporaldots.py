@@ -1,33 +1,32 @@
-from datasets.models import Document
 from models.models import Topic
 import json
 
 
 def visual(vis, params):
     model = vis.model
-    documents = Document.objects.filter(dataset=model.dataset)
+    ids, times = model.dataset.get_documents_columns("id", "time")
     topics = Topic.objects.filter(
         model=model,
         layer=model.layers_count).order_by("spectrum_index")
-    min_time = documents[0].time
-    max_time = min_time
-
-    for document in documents:
-        time = document.time
-        if time < min_time:
-            min_time = time
-        if time > max_time:
-            max_time = time
-
-    period = (max_time - min_time).total_seconds()
+    # Documents without time (or missing) aren't shown.
+    known_times = [time for time in times.tolist() if time is not None]
+    if len(known_times) == 0:
+        min_time = max_time = None
+        period = 1
+    else:
+        min_time = min(known_times)
+        max_time = max(known_times)
+        period = (max_time - min_time).total_seconds() or 1
 
     documents_send = []
     for topic in topics:
-        for document in topic.get_documents():
+        for index_id in topic.get_documents_index_ids():
+            if times[index_id] is None:
+                continue
             documents_send.append({
-                "X": (document.time - min_time).total_seconds() / period,
+                "X": (times[index_id] - min_time).total_seconds() / period,
                 "Y": topic.spectrum_index,
-                "id": document.id
+                "id": ids[index_id]
             })
 
     topics_send = [{"Y": topic.spectrum_index, "name": topic.title}
@@ -1,9 +1,15 @@
-from datasets.models import Document
 from models.models import Topic
 import numpy as np
 import json
 import os
 from sklearn.manifold import TSNE
+from models.matrices import get_rows
+from models.models import THETA_BLOCK_SIZE
+
+
+# Number of components, to which theta with more topics is reduced before
+# t-SNE.
+TSNE_SVD_COMPONENTS = 50
 
 
 def visual(vis, params):
@@ -17,7 +23,22 @@ def visual(vis, params):
         tsne_matrix = np.load(tsne_matrix_path)
         print("t-SNE matrix from cache.")
     except BaseException:
-        theta_t = model.get_theta().transpose()
+        theta_t = model.get_theta_t()
+        if theta_t.shape[1] > TSNE_SVD_COMPONENTS:
+            # Theta with many topics is reduced first, whether it is dense or
+            # sparse, so t-SNE gets the same input in both storage modes.
+            from sklearn.decomposition import TruncatedSVD
+            print("Reducing theta...")
+            theta_t = TruncatedSVD(n_components=TSNE_SVD_COMPONENTS,
+                                   random_state=0).fit_transform(theta_t)
+        else:
+            # t-SNE needs dense input. It is filled by blocks of rows, so
+            # sparse theta is never made dense entirely at once.
+            dense = np.zeros(theta_t.shape, dtype=theta_t.dtype)
+            for begin in range(0, theta_t.shape[0], THETA_BLOCK_SIZE):
+                rows = slice(begin, begin + THETA_BLOCK_SIZE)
+                dense[rows] = get_rows(theta_t, rows)
+            theta_t = dense
         tsne_model = TSNE(n_components=2, n_iter=200, verbose=10)
         print("Fitting t-SNE...")
         tsne_matrix = tsne_model.fit_transform(theta_t)
@@ -25,8 +46,7 @@ def visual(vis, params):
         np.save(tsne_matrix_path, tsne_matrix)
 
     answer = []
-    documents = Document.objects.filter(
-        dataset=model.dataset).order_by("index_id")
+    ids, = model.dataset.get_documents_columns("id")
     documents_count = tsne_matrix.shape[0]
 
     border_0 = tsne_matrix[0].copy()
@@ -51,16 +71,14 @@ def visual(vis, params):
         for document_index_id in topic.get_documents_index_ids():
             doc_color[document_index_id] = topic_index_id
 
-    i = 0
-    for document in documents:
+    for i in range(documents_count):
         answer.append({
             "X": (tsne_matrix[i][0] - border_0[0]) /
                  (border_1[0] - border_0[0]),
             "Y": (tsne_matrix[i][1] - border_0[1]) /
                  (border_1[1] - border_0[1]),
-            "color": doc_color[document.index_id],
-            "id": document.id})
-        i += 1
+            "color": doc_color[i],
+            "id": ids[i]})
     print("colored")
 
     return "docs = " + json.dumps(answer) + ";\n"
@@ -5,8 +5,8 @@ from visual.models import Polygon
 from django.http import HttpResponse
 import json
 import os
-import struct
 from django.conf import settings
+from datasets import codec
 
 
 def allow(func):
@@ -33,11 +33,13 @@ def get_documents(request):
     else:
         fields = {}
 
+    # Documents are loaded without texts, word indexes and bags of words,
+    # unless they are needed.
     documents = Document.objects_safe(request)
 
     if 'ids' in request.GET:
         ids = request.GET["ids"].split(',')
-        documents = documents.filter(id__in=ids).order_by('id')
+        documents = Document.brief(documents.filter(id__in=ids)).order_by('id')
         for document in documents:
             doc = {
                 "id": document.id,
@@ -57,13 +59,19 @@ def get_documents(request):
         if offset + count > topic.documents_count:
             count = topic.documents_count - offset
         dataset_id = topic.model.dataset.id
-        s = topic.documents[8 * offset: 8 * (offset + count)]
-        for i in range(count):
-            document = documents.get(
-                dataset_id=dataset_id,
-                index_id=struct.unpack('I', s[8 * i: 8 * i + 4])[0]
-            )
-            weight = 100 * (struct.unpack('f', s[8 * i + 4: 8 * i + 8])[0])
+        topic_documents = codec.decode(
+            topic.documents, codec.TOPIC_DOCUMENTS_DTYPE)
+        topic_documents = topic_documents[offset: offset + count]
+        doc_iids = topic_documents["document"].tolist()
+        documents = Document.get_by_index_ids(
+            Document.brief(documents.filter(dataset_id=dataset_id)),
+            doc_iids)
+        for doc_iid, weight in zip(doc_iids,
+                                   topic_documents["weight"].tolist()):
+            if doc_iid not in documents:
+                continue
+            document = documents[doc_iid]
+            weight = 100 * weight
             result.append({
                 "id": document.id,
                 "title": document.title,
@@ -71,31 +79,31 @@ def get_documents(request):
             })
     elif 'dataset_id' in request.GET:
         documents = documents.filter(dataset_id=request.GET["dataset_id"])
-        documents = documents.order_by("index_id")[offset: offset + count]
-        for document in documents:
+        documents = documents.order_by("index_id").values_list(
+            "id", "title")[offset: offset + count]
+        for id, title in documents:
             result.append({
-                "id": document.id,
-                "title": document.title
+                "id": id,
+                "title": title
             })
     elif 'term_id' in request.GET:
         term = Term.objects.get(id=request.GET["term_id"])
-        term.count_documents_index()
-        docs_index = term.documents
-        if (docs_index):
-            length = len(docs_index) // 6
-            if offset + count > length:
-                count = length - offset
-            for i in range(offset, offset + count):
-                doc_iid = struct.unpack('I', docs_index[6 * i: 6 * i + 4])[0]
-                document = documents.get(dataset_id=term.dataset_id,
-                                         index_id=doc_iid)
-                count = struct.unpack('H', docs_index[6 * i + 4: 6 * i + 6])[0]
-                result.append({
-                    "id": document.id,
-                    "title": document.title,
-                    "count": count,
-                    "concordance": document.get_concordance([term.index_id])
-                })
+        doc_ids, counts = term.get_documents_index()
+        doc_ids = doc_ids[offset: offset + count].tolist()
+        counts = counts[offset: offset + count].tolist()
+        documents = Document.get_by_index_ids(
+            documents.filter(dataset_id=term.dataset_id).defer(
+                "text", "bag_of_words"), doc_ids)
+        for doc_iid, count in zip(doc_ids, counts):
+            if doc_iid not in documents:
+                continue
+            document = documents[doc_iid]
+            result.append({
+                "id": document.id,
+                "title": document.title,
+                "count": count,
+                "concordance": document.get_concordance([term.index_id])
+            })
     return HttpResponse(json.dumps(result), content_type='application/json')
 
 
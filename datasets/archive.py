@@ -0,0 +1,314 @@
+# Extraction of zip archive from stream of chunks (for example, from upload
+# while it is received, see datasets.upload), without saving archive to disk
+# first.
+#
+# Members are read one by one from their local headers, so central directory
+# at the end of archive isn't needed. Names and sizes of members are
+# validated before anything is written: names must be relative paths inside
+# target folder, and total size of extracted data is limited. Small members
+# from documents/, wordpos/ and meta/ (which are usually numerous) are
+# decompressed and written by pool of threads, while next members are read;
+# other members are decompressed and written as they arrive.
+
+import os
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_DIRECTORY_SIGNATURES = (0x02014b50, 0x06054b50, 0x06064b50)
+
+STORED = 0
+DEFLATED = 8
+
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+# Folders, small members of which are extracted in parallel.
+PARALLEL_FOLDERS = ("documents", "wordpos", "meta")
+
+# Maximal compressed size of member, which is extracted in parallel.
+PARALLEL_MEMBER_SIZE = 1 << 20
+
+BLOCK_SIZE = 1 << 20
+
+
+class StreamReader:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    # Returns up to size bytes (empty only at the end of stream).
+    def read_some(self, size):
+        if len(self.buffer) == 0:
+            self.buffer = next(self.chunks, b"")
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    # Returns exactly size bytes.
+    def read(self, size):
+        parts = []
+        while size > 0:
+            data = self.read_some(size)
+            if len(data) == 0:
+                raise ValueError("Archive is truncated.")
+            parts.append(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+# Returns normalized relative name of member, or raises ValueError if it
+# points outside of target folder.
+def get_member_name(raw_name, flags):
+    if flags & FLAG_UTF8:
+        name = raw_name.decode("utf-8")
+    else:
+        name = raw_name.decode("cp437")
+    name = name.replace("\\", "/")
+    if name.startswith("/") or (len(name) > 1 and name[1] == ":"):
+        raise ValueError("Absolute path in archive: %s" % name)
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise ValueError("Path outside of dataset in archive: %s" % name)
+    return "/".join(parts)
+
+
+class ArchiveExtractor:
+    def __init__(self, folder, workers=1, max_size=None):
+        self.folder = folder
+        self.workers = workers
+        self.max_size = max_size
+        self.extracted_size = 0
+        self.members_count = 0
+
+    # Accounts size of extracted data. If add is False, only checks that
+    # size (declared in header) fits into limit.
+    def check_size(self, size, add=True):
+        if (self.max_size is not None and
+                self.extracted_size + size > self.max_size):
+            raise ValueError("Archive is too large (more than %d bytes "
+                             "after extraction)." % self.max_size)
+        if add:
+            self.extracted_size += size
+
+    def get_path(self, name):
+        path = os.path.join(self.folder, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def extract(self, chunks):
+        reader = StreamReader(chunks)
+        pending = deque()
+        with ThreadPoolExecutor(max(1, self.workers)) as pool:
+            while True:
+                header = reader.read_some(4)
+                if len(header) < 4:
+                    header += reader.read_some(4 - len(header))
+                if len(header) == 0:
+                    break
+                if len(header) < 4:
+                    raise ValueError("Archive is truncated.")
+                signature = struct.unpack("<I", header)[0]
+                if signature in CENTRAL_DIRECTORY_SIGNATURES:
+                    break
+                if signature != LOCAL_HEADER_SIGNATURE:
+                    raise ValueError("File isn't zip archive.")
+                reader.unread(header)
+                task = self.read_member(reader)
+                if task is not None:
+                    pending.append(pool.submit(*task))
+                    while len(pending) > 2 * self.workers:
+                        pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        return self.members_count
+
+    # Reads member from stream. Small members are returned as task for
+    # pool (function and arguments), others are extracted immediately.
+    def read_member(self, reader):
+        (signature, version, flags, method, mtime, mdate, crc,
+         compressed_size, size, name_length, extra_length) = \
+            LOCAL_HEADER.unpack(reader.read(LOCAL_HEADER.size))
+        raw_name = reader.read(name_length)
+        name = get_member_name(raw_name, flags)
+        is_dir = raw_name.endswith(b"/") or raw_name.endswith(b"\\")
+        extra = reader.read(extra_length)
+        if flags & FLAG_ENCRYPTED:
+            raise ValueError("Encrypted archives aren't supported.")
+        if method not in (STORED, DEFLATED):
+            raise ValueError("Unsupported compression in archive: %s" % name)
+        size, compressed_size, zip64 = ArchiveExtractor.read_zip64_sizes(
+            extra, size, compressed_size)
+        descriptor = bool(flags & FLAG_DATA_DESCRIPTOR)
+        if not descriptor:
+            self.check_size(size, add=False)
+
+        if is_dir or name == "":
+            if name != "":
+                os.makedirs(os.path.join(self.folder, *name.split("/")),
+                            exist_ok=True)
+            self.skip_member(reader, method, compressed_size, descriptor,
+                             zip64)
+            return None
+        self.members_count += 1
+        if descriptor and method == STORED:
+            self.stream_stored_member(reader, name, zip64)
+            return None
+
+        if (not descriptor and compressed_size <= PARALLEL_MEMBER_SIZE and
+                name.split("/")[0] in PARALLEL_FOLDERS and self.workers > 1):
+            data = reader.read(compressed_size)
+            self.check_size(size)
+            return (ArchiveExtractor.write_member, self.get_path(name), data,
+                    method, size, crc)
+
+        self.stream_member(reader, name, method, compressed_size, size, crc,
+                           descriptor, zip64)
+        return None
+
+    # Returns sizes of member, taking them from zip64 extra field if it is
+    # present, and whether it is present.
+    def read_zip64_sizes(extra, size, compressed_size):
+        position = 0
+        while position + 4 <= len(extra):
+            header_id, length = struct.unpack(
+                "<HH", extra[position: position + 4])
+            if header_id == 1:
+                values = extra[position + 4: position + 4 + length]
+                if size == 0xFFFFFFFF:
+                    size = struct.unpack("<Q", values[:8])[0]
+                    values = values[8:]
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = struct.unpack("<Q", values[:8])[0]
+                return size, compressed_size, True
+            position += 4 + length
+        return size, compressed_size, False
+
+    def write_member(path, data, method, size, crc):
+        if method == DEFLATED:
+            # Output is limited, so lying header can't inflate member.
+            data = zlib.decompressobj(-15).decompress(data, size + 1)
+        if len(data) != size or zlib.crc32(data) & 0xFFFFFFFF != crc:
+            raise ValueError("Archive is damaged: %s" % path)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    # Decompresses member as it arrives, by blocks of limited size. If sizes
+    # are in data descriptor after data, end of deflate stream determines end
+    # of member.
+    def stream_member(self, reader, name, method, compressed_size, size,
+                      crc, descriptor, zip64):
+        decompressor = zlib.decompressobj(-15) if method == DEFLATED else None
+        written = 0
+        actual_crc = 0
+        remaining = compressed_size
+        with open(self.get_path(name), "wb") as f:
+            while True:
+                if decompressor is not None and decompressor.eof:
+                    break
+                if decompressor is not None and decompressor.unconsumed_tail:
+                    compressed = decompressor.unconsumed_tail
+                else:
+                    if not descriptor and remaining == 0:
+                        if decompressor is None:
+                            break
+                        raise ValueError("Archive is damaged: %s" % name)
+                    compressed = reader.read_some(
+                        BLOCK_SIZE if descriptor
+                        else min(BLOCK_SIZE, remaining))
+                    if len(compressed) == 0:
+                        raise ValueError("Archive is truncated.")
+                    remaining -= len(compressed)
+                if decompressor is not None:
+                    data = decompressor.decompress(compressed, BLOCK_SIZE)
+                else:
+                    data = compressed
+                self.check_size(len(data))
+                actual_crc = zlib.crc32(data, actual_crc)
+                written += len(data)
+                f.write(data)
+        if descriptor:
+            reader.unread(decompressor.unused_data)
+            crc, compressed_size, size = self.read_descriptor(reader, zip64)
+        elif remaining > 0:
+            reader.read(remaining)
+        if written != size or actual_crc & 0xFFFFFFFF != crc:
+            raise ValueError("Archive is damaged: %s" % name)
+
+    # Stored member with data descriptor has no size in header, so its end
+    # is found by scanning for signature of data descriptor, which is
+    # followed by CRC and sizes of data before it. Data is written as it
+    # arrives, except the tail which may hold beginning of descriptor.
+    def stream_stored_member(self, reader, name, zip64):
+        descriptor_format = "<IQQ" if zip64 else "<III"
+        descriptor_size = 4 + struct.calcsize(descriptor_format)
+        signature = struct.pack("<I", DATA_DESCRIPTOR_SIGNATURE)
+        buffer = b""
+        written = 0
+        actual_crc = 0
+        with open(self.get_path(name), "wb") as f:
+            while True:
+                data = reader.read_some(BLOCK_SIZE)
+                if len(data) == 0:
+                    raise ValueError("Archive is truncated.")
+                buffer += data
+                safe = max(len(buffer) - descriptor_size + 1, 0)
+                position = buffer.find(signature)
+                while position >= 0:
+                    if position + descriptor_size > len(buffer):
+                        safe = min(safe, position)
+                        break
+                    crc, compressed_size, size = struct.unpack(
+                        descriptor_format,
+                        buffer[position + 4: position + descriptor_size])
+                    if (size == compressed_size == written + position and
+                            zlib.crc32(buffer[:position], actual_crc) &
+                            0xFFFFFFFF == crc):
+                        self.check_size(position)
+                        f.write(buffer[:position])
+                        reader.unread(buffer[position + descriptor_size:])
+                        return
+                    position = buffer.find(signature, position + 1)
+                self.check_size(safe)
+                actual_crc = zlib.crc32(buffer[:safe], actual_crc)
+                written += safe
+                f.write(buffer[:safe])
+                buffer = buffer[safe:]
+
+    def read_descriptor(self, reader, zip64):
+        data = reader.read(4)
+        if struct.unpack("<I", data)[0] != DATA_DESCRIPTOR_SIGNATURE:
+            reader.unread(data)
+        if zip64:
+            return struct.unpack("<IQQ", reader.read(20))
+        return struct.unpack("<III", reader.read(12))
+
+    def skip_member(self, reader, method, compressed_size, descriptor, zip64):
+        if not descriptor or method == STORED:
+            reader.read(compressed_size)
+            if descriptor:
+                self.read_descriptor(reader, zip64)
+            return
+        decompressor = zlib.decompressobj(-15)
+        while not decompressor.eof:
+            data = reader.read_some(BLOCK_SIZE)
+            if len(data) == 0:
+                raise ValueError("Archive is truncated.")
+            decompressor.decompress(data)
+        reader.unread(decompressor.unused_data)
+        self.read_descriptor(reader, zip64)
+
+
+# Extracts zip archive, given as iterable of chunks of bytes, to folder.
+# Returns number of extracted members.
+def extract_archive(chunks, folder, workers=1, max_size=None):
+    return ArchiveExtractor(folder, workers, max_size).extract(chunks)
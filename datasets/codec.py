@@ -0,0 +1,56 @@
+# Encoding and decoding of packed binary blobs, which are stored in database.
+#
+# Each blob is a sequence of fixed-size records without padding, in native
+# byte order (the same layout struct.pack produces for each field separately).
+# Records are represented as NumPy structured arrays; decoding is zero-copy.
+
+import numpy as np
+
+
+# Document.bag_of_words
+# [4 bytes term.index_id][2 bytes count][1 byte modality.index_id]
+BOW_DTYPE = np.dtype([("term", "=u4"), ("count", "=u2"), ("modality", "u1")])
+
+# Document.word_index
+# [4 bytes position][1 byte length][4 bytes term.index_id]
+WORD_INDEX_DTYPE = np.dtype([("pos", "=u4"), ("length", "u1"),
+                             ("term", "=u4")])
+
+# Topic.documents
+# [4 bytes document.index_id][4 bytes weight]
+TOPIC_DOCUMENTS_DTYPE = np.dtype([("document", "=u4"), ("weight", "=f4")])
+
+
+# Returns read-only structured array, which shares memory with blob.
+# Incomplete trailing record, if any, is ignored.
+def decode(blob, dtype):
+    if not blob:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(blob, dtype=dtype, count=len(blob) // dtype.itemsize)
+
+
+# Packs columns into blob. All columns must have equal length.
+# Integer values which don't fit into their field are saturated.
+def encode(dtype, **columns):
+    length = len(next(iter(columns.values())))
+    records = np.zeros(length, dtype=dtype)
+    for name, values in columns.items():
+        field_type = dtype.fields[name][0]
+        values = np.asarray(values)
+        if field_type.kind == 'u' and len(values) > 0:
+            values = np.clip(values, 0, np.iinfo(field_type).max)
+        records[name] = values
+    return records.tobytes()
+
+
+def encode_bow(terms, counts, modalities):
+    return encode(BOW_DTYPE, term=terms, count=counts, modality=modalities)
+
+
+def encode_word_index(positions, lengths, terms):
+    return encode(WORD_INDEX_DTYPE, pos=positions, length=lengths,
+                  term=terms)
+
+
+def encode_topic_documents(documents, weights):
+    return encode(TOPIC_DOCUMENTS_DTYPE, document=documents, weight=weights)
@@ -0,0 +1,127 @@
+# Content hashes for change detection on dataset reload.
+#
+# Hashes are kept in folder hashes/ inside dataset folder:
+#     stages.json   - hash of inputs of each loading stage (parse, filter,
+#                     batches, dictionary, documents);
+#     parse.json    - hash of each parsed text file (relative name -> hash);
+#     documents.npy - hash of each loaded document, indexed by index_id.
+# Stage is skipped if hash of its inputs equals stored one. Hash of stage is
+# dropped before stage starts and stored after it finishes, so interrupted
+# stage is never reused.
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+# Dtype of hashes of documents (SHA-1 digests).
+DOCUMENT_HASH_DTYPE = np.dtype("S20")
+
+
+def hash_bytes(*values):
+    h = hashlib.sha1()
+    for value in values:
+        h.update(hashlib.sha1(value).digest())
+    return h.hexdigest()
+
+
+def hash_strings(*values):
+    return hash_bytes(*[str(value).encode("utf-8") for value in values])
+
+
+# Returns hash of file content, or empty string if file doesn't exist.
+def hash_file(file_name):
+    if not os.path.exists(file_name):
+        return ""
+    h = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Returns hash of document loaded from Vowpal Wabbit line: it covers the line
+# itself, text and wordpos files of document and its metadata.
+# If wordpos_pack is given and contains document, its records are hashed
+# instead of wordpos file. Keys are hashed as strings, because their numbers
+# depend on other documents.
+def hash_document(dataset_folder, text_id, line_vw, doc_info,
+                  wordpos_pack=None):
+    h = hashlib.sha1()
+    h.update(line_vw.encode("utf-8"))
+    records = None
+    if wordpos_pack is not None:
+        records = wordpos_pack.get(text_id)
+    for subfolder in ["documents", "wordpos"]:
+        file_name = os.path.join(dataset_folder, subfolder, text_id)
+        h.update(b"\0" + subfolder.encode("utf-8") + b"\0")
+        if subfolder == "wordpos" and records is not None:
+            h.update(np.ascontiguousarray(records["pos"]).tobytes())
+            h.update(np.ascontiguousarray(records["length"]).tobytes())
+            h.update("\n".join(wordpos_pack.keys[key] for key in
+                               records["key"].tolist()).encode("utf-8"))
+        elif os.path.exists(file_name):
+            with open(file_name, "rb") as f:
+                h.update(f.read())
+    h.update(json.dumps(doc_info, sort_keys=True).encode("utf-8"))
+    return h.digest()
+
+
+class StageHashes:
+    def __init__(self, dataset_folder):
+        self.folder = os.path.join(dataset_folder, "hashes")
+        os.makedirs(self.folder, exist_ok=True)
+        self.stages_file = os.path.join(self.folder, "stages.json")
+        self.stages = dict()
+        if os.path.exists(self.stages_file):
+            with open(self.stages_file) as f:
+                self.stages = json.load(f)
+
+    def get(self, stage):
+        return self.stages.get(stage)
+
+    def changed(self, stage, key):
+        return self.stages.get(stage) != key
+
+    # Forgets hash of stage. Must be called before outputs of stage are
+    # modified.
+    def reset(self, stage):
+        if stage in self.stages:
+            del self.stages[stage]
+            self.save()
+
+    def set(self, stage, key):
+        self.stages[stage] = key
+        self.save()
+
+    def save(self):
+        with open(self.stages_file + ".new", "w") as f:
+            json.dump(self.stages, f)
+        os.replace(self.stages_file + ".new", self.stages_file)
+
+    def load_parse_hashes(self):
+        file_name = os.path.join(self.folder, "parse.json")
+        if not os.path.exists(file_name):
+            return dict()
+        with open(file_name) as f:
+            return json.load(f)
+
+    def save_parse_hashes(self, hashes):
+        with open(os.path.join(self.folder, "parse.json"), "w") as f:
+            json.dump(hashes, f)
+
+    def load_documents_hashes(self):
+        file_name = os.path.join(self.folder, "documents.npy")
+        if not os.path.exists(file_name):
+            return None
+        return np.load(file_name)
+
+    def save_documents_hashes(self, hashes):
+        np.save(os.path.join(self.folder, "documents.npy"),
+                np.asarray(hashes, dtype=DOCUMENT_HASH_DTYPE))
+
+    def reset_documents_hashes(self):
+        file_name = os.path.join(self.folder, "documents.npy")
+        if os.path.exists(file_name):
+            os.remove(file_name)
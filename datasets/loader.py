@@ -0,0 +1,107 @@
+# Parallel loader of documents from vw.txt.
+#
+# Worker processes parse Vowpal Wabbit lines together with corresponding
+# files from documents/ and wordpos/ (or packed container of wordpos) into
+# ready-to-insert rows. The calling process is the only one which talks to
+# the database and reads metadata (see datasets.meta): it attaches metadata
+# to chunks before they are sent to workers and inserts rows with
+# bulk_create. At
+# most 2 * workers chunks are in flight, so memory is bounded by chunk size
+# regardless of collection size.
+#
+# Workers also compute content hash of each document (see datasets.hashes).
+# Documents, whose hash equals hash from previous load, aren't parsed.
+
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+
+# Fields of Document filled by Document.fetch_vw, in order of row tuples.
+ROW_FIELDS = ("text_id", "title", "text", "word_index", "bag_of_words",
+              "terms_count", "unique_terms_count")
+
+# Dataset which is being loaded and hashes of documents from previous load
+# (or None). Set in worker processes by init_worker.
+_dataset = None
+_previous_hashes = None
+
+
+def init_worker(dataset, previous_hashes=None):
+    global _dataset, _previous_hashes
+    _dataset = dataset
+    _previous_hashes = previous_hashes
+
+
+# Returns list of tuples (index_id, row, hash, doc_info). Row is None if
+# document didn't change since previous load.
+def parse_chunk(chunk):
+    from datasets.models import Document
+    from datasets.hashes import hash_document
+    folder = _dataset.get_folder()
+    rows = []
+    for index_id, line, doc_info in chunk:
+        text_id = line.split(maxsplit=1)[0]
+        document_hash = hash_document(folder, text_id, line, doc_info,
+                                      _dataset.wordpos_pack)
+        if (_previous_hashes is not None and
+                index_id < len(_previous_hashes) and
+                _previous_hashes[index_id] == document_hash):
+            rows.append((index_id, None, document_hash, doc_info))
+            continue
+        doc = Document()
+        doc.dataset = _dataset
+        doc.index_id = index_id
+        doc.fetch_vw(line)
+        rows.append((index_id, tuple(getattr(doc, field)
+                                     for field in ROW_FIELDS),
+                     document_hash, doc_info))
+    return rows
+
+
+# Yields lists of (index_id, line) for non-empty lines of vw.txt.
+def read_chunks(vw_file_name, chunk_size, first_index_id=0):
+    with open(vw_file_name, "r", encoding="utf-8") as f:
+        lines = (line for line in f if len(line) > 1)
+        index_id = first_index_id
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if len(chunk) == 0:
+                return
+            yield [(index_id + i, line) for i, line in enumerate(chunk)]
+            index_id += len(chunk)
+
+
+# Yields lists of (index_id, line, doc_info), taking metadata of documents
+# from meta (MetaJoiner). If meta is None, doc_info is None.
+def attach_meta(chunks, meta):
+    for chunk in chunks:
+        if meta is None:
+            infos = [None] * len(chunk)
+        else:
+            infos = meta.get([line.split(maxsplit=1)[0]
+                              for index_id, line in chunk])
+        yield [(index_id, line, doc_info)
+               for (index_id, line), doc_info in zip(chunk, infos)]
+
+
+# Yields parsed chunks in order of vw.txt.
+# Worker processes are forked, so they share dataset.terms_index with parent
+# without copying. If fork isn't available, chunks are parsed in-process.
+def parse_chunks(dataset, chunks, workers, previous_hashes=None):
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        init_worker(dataset, previous_hashes)
+        for chunk in chunks:
+            yield parse_chunk(chunk)
+        return
+
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers, initializer=init_worker,
+                      initargs=(dataset, previous_hashes)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(parse_chunk, (chunk, )))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
@@ -0,0 +1,253 @@
+# Streaming readers of metadata of documents.
+#
+# Metadata is stored in folder meta/ of dataset either as meta.json (JSON
+# dictionary: name of document -> metadata), or as meta.jsonl (JSON Lines:
+# one object per document, with name of document in key "text_id"). Both are
+# read entry by entry, so metadata is never held in memory entirely.
+#
+# MetaJoiner gives metadata for chunks of documents in order of vw.txt. If
+# entries of metadata file go in the same order (which is usual when both
+# files are exported together), they are just read along. On the first
+# mismatch, metadata is indexed in SQLite database on disk, which is then
+# used for lookups.
+
+import os
+import json
+import sqlite3
+
+
+BLOCK_SIZE = 1 << 20
+
+# Maximal number of parameters in one SQLite query.
+QUERY_SIZE = 900
+
+
+def find_meta_file(folder):
+    for name in ["meta.jsonl", "meta.json"]:
+        file_name = os.path.join(folder, "meta", name)
+        if os.path.exists(file_name):
+            return file_name
+    return None
+
+
+# Yields pairs (key, value) of JSON dictionary in file, parsing it by blocks.
+def iter_json_object(file_name, block_size=BLOCK_SIZE):
+    decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
+    with open(file_name, "r", encoding="utf-8") as f:
+        state = {"buffer": "", "position": 0, "eof": False}
+
+        def read_more():
+            if state["eof"]:
+                raise ValueError("Unexpected end of file %s" % file_name)
+            data = f.read(block_size)
+            if len(data) == 0:
+                state["eof"] = True
+            # Parsed part of buffer is dropped, so memory is bounded by the
+            # largest entry.
+            state["buffer"] = state["buffer"][state["position"]:] + data
+            state["position"] = 0
+
+        # Returns next non-whitespace character (or "" at the end of file),
+        # without consuming it.
+        def peek():
+            while True:
+                buffer = state["buffer"]
+                position = state["position"]
+                while position < len(buffer) and buffer[position] in \
+                        whitespace:
+                    position += 1
+                state["position"] = position
+                if position < len(buffer):
+                    return buffer[position]
+                if state["eof"]:
+                    return ""
+                read_more()
+
+        def expect(characters):
+            character = peek()
+            if character == "" or character not in characters:
+                raise ValueError("Invalid JSON in %s: expected %s" %
+                                 (file_name, " or ".join(characters)))
+            state["position"] += 1
+            return character
+
+        # Decodes next value. Value, which ends at the end of buffer, may be
+        # incomplete number, so it is decoded again after reading more.
+        def decode():
+            peek()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(state["buffer"],
+                                                    state["position"])
+                    if end < len(state["buffer"]) or state["eof"]:
+                        state["position"] = end
+                        return value
+                except ValueError:
+                    if state["eof"]:
+                        raise
+                read_more()
+
+        expect("{")
+        if peek() == "}":
+            return
+        while True:
+            key = decode()
+            if not isinstance(key, str):
+                raise ValueError("Invalid JSON in %s: expected key" %
+                                 file_name)
+            expect(":")
+            value = decode()
+            yield key, value
+            if expect(",}") == "}":
+                return
+
+
+# Yields pairs (text_id, metadata) from JSON Lines file.
+def iter_json_lines(file_name):
+    with open(file_name, "r", encoding="utf-8") as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry, dict) or "text_id" not in entry:
+                raise ValueError("Invalid line in %s: %s" % (file_name, line))
+            yield entry.pop("text_id"), entry
+
+
+def iter_meta(file_name):
+    if file_name.endswith(".jsonl"):
+        return iter_json_lines(file_name)
+    return iter_json_object(file_name)
+
+
+# Writes pairs (text_id, metadata) in format given by extension of file.
+def write_meta(file_name, pairs):
+    with open(file_name, "w", encoding="utf-8") as f:
+        if file_name.endswith(".jsonl"):
+            for key, value in pairs:
+                entry = {"text_id": key}
+                entry.update(value)
+                f.write(json.dumps(entry) + "\n")
+            return
+        f.write("{")
+        first = True
+        for key, value in pairs:
+            if not first:
+                f.write(", ")
+            first = False
+            f.write(json.dumps(key) + ": " + json.dumps(value))
+        f.write("}")
+
+
+# Adds metadata from source folder to metadata of dataset in target folder.
+# Entries with the same names are replaced.
+def merge_meta(target_folder, source_folder):
+    source_file = find_meta_file(source_folder)
+    if source_file is None:
+        return
+    target_file = find_meta_file(target_folder)
+    if target_file is None:
+        target_file = os.path.join(target_folder, "meta",
+                                   os.path.basename(source_file))
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+        open(target_file, "w").close()
+        old_pairs = iter([])
+    else:
+        old_pairs = iter_meta(target_file)
+    new_keys = set(key for key, value in iter_meta(source_file))
+
+    def pairs():
+        for key, value in old_pairs:
+            if key not in new_keys:
+                yield key, value
+        for key, value in iter_meta(source_file):
+            yield key, value
+
+    # Temporary file keeps extension, which determines format.
+    new_file = os.path.join(os.path.dirname(target_file),
+                            "new." + os.path.basename(target_file))
+    write_meta(new_file, pairs())
+    os.replace(new_file, target_file)
+
+
+class MetaJoiner:
+    def __init__(self, file_name, log=None):
+        self.file_name = file_name
+        self.log = log
+        self.pairs = iter_meta(file_name)
+        self.next_pair = None
+        self.index = None
+        self.index_file_name = file_name + ".index"
+        # Set if metadata file is broken. Then no metadata is given.
+        self.failed = False
+
+    def peek(self):
+        if self.next_pair is None:
+            self.next_pair = next(self.pairs, None)
+        return self.next_pair
+
+    # Returns list of metadata of documents (None for documents without
+    # metadata).
+    def get(self, text_ids):
+        if self.failed:
+            return [None] * len(text_ids)
+        try:
+            result = []
+            if self.index is None:
+                for text_id in text_ids:
+                    pair = self.peek()
+                    if pair is None or pair[0] != text_id:
+                        break
+                    result.append(pair[1])
+                    self.next_pair = None
+                if len(result) == len(text_ids):
+                    return result
+                self.build_index()
+            return result + self.lookup(text_ids[len(result):])
+        except ValueError as ex:
+            if self.log:
+                self.log("WARNING! Wasn't able to load metadata.")
+                self.log(str(ex))
+            self.failed = True
+            return [None] * len(text_ids)
+
+    def build_index(self):
+        if self.log:
+            self.log("Metadata isn't in order of documents, indexing it...")
+        self.remove_index()
+        self.index = sqlite3.connect(self.index_file_name)
+        self.index.execute("PRAGMA journal_mode=OFF")
+        self.index.execute("PRAGMA synchronous=OFF")
+        self.index.execute(
+            "CREATE TABLE meta (text_id TEXT PRIMARY KEY, info TEXT)")
+        batch = []
+        for key, value in iter_meta(self.file_name):
+            batch.append((key, json.dumps(value)))
+            if len(batch) >= QUERY_SIZE:
+                self.index.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)", batch)
+                batch = []
+        self.index.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)", batch)
+        self.index.commit()
+
+    def lookup(self, text_ids):
+        found = dict()
+        for i in range(0, len(text_ids), QUERY_SIZE):
+            part = text_ids[i: i + QUERY_SIZE]
+            found.update(self.index.execute(
+                "SELECT text_id, info FROM meta WHERE text_id IN (%s)" %
+                ",".join("?" * len(part)), part).fetchall())
+        return [json.loads(found[text_id]) if text_id in found else None
+                for text_id in text_ids]
+
+    def remove_index(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if os.path.exists(self.index_file_name):
+            os.remove(self.index_file_name)
+
+    def close(self):
+        self.remove_index()
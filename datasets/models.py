@@ -7,12 +7,22 @@ import logging
 from datetime import datetime
 import numpy as np
 from django.db import transaction
-from shutil import rmtree
-import struct
+from shutil import rmtree, move
 import re
 from django.contrib import admin
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
+from datasets import codec
+
+
+# Number of dictionary lines parsed at once in gather_dictionary.
+TERMS_CHUNK_SIZE = 100000
+# Number of terms inserted by one query.
+TERMS_BATCH_SIZE = 5000
+# Number of documents inserted by one query.
+DOCUMENTS_BATCH_SIZE = 500
+# Maximal number of index_id's in one "__in" filter.
+QUERY_IDS_SIZE = 900
 
 
 class Dataset(models.Model):
@@ -36,25 +46,22 @@ class Dataset(models.Model):
     def __str__(self):
         return self.name
 
+    # Loads dataset from its folder.
+    # Stages, whose inputs didn't change since previous reload (see
+    # datasets.hashes), are skipped. Terms and documents are kept in database
+    # if they didn't change, and models are kept if neither changed.
     def reload(self):
+        from datasets.hashes import StageHashes, hash_file, hash_strings
         self.prepare_log()
         self.log("Loading dataset " + self.text_id + "...")
+        hashes = StageHashes(self.get_folder())
 
-        Term.objects.filter(dataset=self).delete()
-        Document.objects.filter(dataset=self).delete()
-        Modality.objects.filter(dataset=self).delete()
-        from models.models import ArtmModel
-        ArtmModel.objects.filter(dataset=self).delete()
-
-        try:
-            meta_file = os.path.join(self.get_folder(), "meta", "meta.json")
-            with open(meta_file) as f:
-                self.docs_info = json.load(f)
-        except BaseException as ex:
-            self.log("WARNING! Wasn't able to load meta.json")
-            self.log(str(ex))
+        # Metadata is read along with documents (see datasets.meta).
+        from datasets.meta import find_meta_file
+        self.meta_file_name = find_meta_file(self.get_folder())
+        if self.meta_file_name is None:
+            self.log("WARNING! Wasn't able to find meta.json or meta.jsonl")
             self.time_provided = False
-            self.docs_info = {}
 
         try:
             preprocessing_params = json.loads(self.preprocessing_params)
@@ -65,20 +72,55 @@ class Dataset(models.Model):
 
         # Preprocessing
         custom_vocab = False
+        vw_file_name = os.path.join(self.get_folder(), "vw.txt")
+        vocab_file_name = os.path.join(self.get_folder(), "vocab.txt")
         if "parse" in preprocessing_params:
-            self.preprocess_parse(preprocessing_params["parse"])
+            self.preprocess_parse(preprocessing_params["parse"], hashes)
+        vw_hash = hash_file(vw_file_name)
         if "filter" in preprocessing_params:
-            self.preprocess_filter(preprocessing_params["filter"])
+            key = hash_strings(vw_hash, json.dumps(
+                preprocessing_params["filter"], sort_keys=True))
+            if hashes.changed("filter", key) or \
+                    not os.path.exists(vocab_file_name):
+                hashes.reset("filter")
+                self.preprocess_filter(preprocessing_params["filter"])
+                hashes.set("filter", key)
+            else:
+                self.log("Filtering skipped: vw.txt didn't change.")
             custom_vocab = True
         if "custom_vocab" in preprocessing_params and preprocessing_params[
                 "custom_vocab"]:
             self.log("Will use custom vocab.txt")
             custom_vocab = True
 
-        self.create_batches()
-        self.gather_dictionary(custom_vocab=custom_vocab)
-        self.load_documents()
+        batches_folder = os.path.join(self.get_folder(), "batches")
+        if hashes.changed("batches", vw_hash) or \
+                not os.path.exists(batches_folder):
+            hashes.reset("batches")
+            self.create_batches()
+            hashes.set("batches", vw_hash)
+        else:
+            self.log("Creating batches skipped: vw.txt didn't change.")
+
+        key = self.get_dictionary_key(vw_hash, custom_vocab)
+        if (hashes.changed("dictionary", key) or
+                not os.path.exists(os.path.join(batches_folder,
+                                                "dictionary.txt")) or
+                Term.objects.filter(dataset=self).count() !=
+                self.terms_count):
+            hashes.reset("dictionary")
+            self.gather_dictionary(custom_vocab=custom_vocab, hashes=hashes)
+            hashes.set("dictionary", key)
+        else:
+            self.log("Creating dictionary skipped: vw.txt didn't change.")
+            self.vocabulary_changed = False
+            self.load_terms_index()
+
+        self.load_documents(hashes)
 
+        if self.vocabulary_changed or self.documents_changed:
+            from models.models import ArtmModel
+            ArtmModel.objects.filter(dataset=self).delete()
         self.log("Loaded " + str(self.documents_count) + " documents.")
 
         # Creating folder for models
@@ -95,25 +137,354 @@ class Dataset(models.Model):
         # Counting weights for terms.
         self.log("Counting weights for terms.")
         self.reset_terms_weights()
+        self.log("Counting statistics.")
+        self.reset_stats()
+
+    # Appends new documents to loaded dataset without full reload.
+    # append_folder must contain vw.txt with new documents, and may contain
+    # documents/, wordpos/ and meta/meta.json (or meta/meta.jsonl) for them,
+    # in the same format as dataset itself. Metadata is required if dataset
+    # has time of documents. New terms and documents get index_id's after
+    # existing ones, so existing models stay valid: their matrices are padded
+    # for new terms and documents. If dataset vocabulary was filtered or
+    # custom, new terms aren't added.
+    def append(self, append_folder):
+        self.prepare_log()
+        self.log("Appending documents to dataset " + self.text_id + "...")
+        folder = self.get_folder()
+        append_vw_file_name = os.path.join(append_folder, "vw.txt")
+        if not os.path.exists(append_vw_file_name):
+            raise ValueError("FATAL ERROR! vw.txt file wasn't found.")
+
+        # New documents without metadata would have no time, which
+        # temporal visualizations of dataset need.
+        from datasets.meta import find_meta_file, merge_meta
+        self.meta_file_name = find_meta_file(append_folder)
+        if self.meta_file_name is None and self.time_provided:
+            raise ValueError("FATAL ERROR! Dataset has time of documents, "
+                             "but meta file wasn't found.")
+
+        for subfolder in ["documents", "wordpos"]:
+            source = os.path.join(append_folder, subfolder)
+            for root, dirs, files in os.walk(source):
+                target = os.path.join(folder, subfolder,
+                                      os.path.relpath(root, source))
+                if not os.path.exists(target):
+                    os.makedirs(target)
+                for file_name in files:
+                    move(os.path.join(root, file_name),
+                         os.path.join(target, file_name))
+
+        if self.meta_file_name is not None:
+            merge_meta(folder, append_folder)
+
+        try:
+            preprocessing_params = json.loads(self.preprocessing_params)
+        except BaseException:
+            preprocessing_params = {}
+        extend_vocabulary = not ("filter" in preprocessing_params or
+                                 preprocessing_params.get("custom_vocab"))
+
+        old_terms_count = self.terms_count
+        old_documents_count = self.documents_count
+        self.load_terms_index()
+        self.append_terms(append_vw_file_name, extend_vocabulary)
+
+        from datasets.postings import (PostingsBuilder, new_segment_folder,
+                                       clear_new_segment, add_segment)
+        from datasets.textstore import TextStoreWriter
+        # Inverted index and search indexes of new documents and terms are
+        # built as new segments of existing indexes, which are published
+        # only when everything else is written, together with new number of
+        # documents.
+        self.build_missing_indexes()
+        index_folders = [self.get_inverted_index_folder()] + [
+            self.get_search_index_folder(name)
+            for name in Dataset.SEARCH_INDEXES]
+        for index_folder in index_folders:
+            clear_new_segment(index_folder)
+
+        try:
+            self.log("Loading new documents...")
+            index_builder = PostingsBuilder(
+                new_segment_folder(index_folders[0]), values_dtype=np.uint16)
+            text_store = TextStoreWriter(self.get_text_store_folder())
+            new_hashes = self.insert_documents(
+                append_vw_file_name, old_documents_count, index_builder,
+                text_store)
+            self.text_store = text_store.close()
+            self.log("Updating inverted index...")
+            index_builder.finish(self.terms_count)
+
+            self.log("Updating search indexes...")
+            Dataset.write_search_index(
+                new_segment_folder(self.get_search_index_folder("terms")),
+                Term.objects.filter(dataset=self,
+                                    index_id__gte=old_terms_count).order_by(
+                    "index_id").values_list("index_id", "text").iterator())
+            new_documents = Document.objects.filter(
+                dataset=self, index_id__gte=old_documents_count).order_by(
+                "index_id")
+            for name in ["titles", "text_ids"]:
+                field = Dataset.SEARCH_INDEXES[name][1]
+                Dataset.write_search_index(
+                    new_segment_folder(self.get_search_index_folder(name)),
+                    new_documents.values_list("index_id", field).iterator())
+
+            # Keeping vw.txt, batches and dictionary consistent with
+            # database, so new models are built over all documents.
+            with open(append_vw_file_name, "r", encoding="utf-8") as source:
+                with open(os.path.join(folder, "vw.txt"), "a+",
+                          encoding="utf-8") as target:
+                    target.seek(0, os.SEEK_END)
+                    if target.tell() > 0:
+                        target.seek(target.tell() - 1)
+                        if target.read(1) != "\n":
+                            target.write("\n")
+                    for line in source:
+                        if len(line) > 1:
+                            target.write(line.rstrip("\n") + "\n")
+            self.append_batches(append_vw_file_name)
+            self.save_dictionary()
+            self.update_hashes_after_append(new_hashes)
+        except BaseException:
+            for index_folder in index_folders:
+                clear_new_segment(index_folder)
+            raise
+
+        for index_folder in index_folders:
+            add_segment(index_folder)
+        self.documents_count += len(new_hashes)
+        self.save()
+
+        self.reset_terms_weights()
+        self.reset_stats()
+
+        from models.models import ArtmModel
+        for model in ArtmModel.objects.filter(dataset=self):
+            self.log("Expanding matrices of model " + str(model.id) + "...")
+            model.dataset = self
+            model.expand_matrices()
+
+        self.log("Appended %d documents and %d terms." % (
+            self.documents_count - old_documents_count,
+            self.terms_count - old_terms_count))
+        self.creation_time = datetime.now()
+        self.status = 0
+        self.save()
 
-    def preprocess_parse(self, params):
+    # Batches and dictionary are consistent with vw.txt after append, so
+    # next reload doesn't need to recompute them.
+    # Key of dictionary stage in StageHashes. Dictionary depends on vw.txt
+    # and, if custom vocabulary is used, on vocab.txt.
+    def get_dictionary_key(self, vw_hash, custom_vocab):
+        from datasets.hashes import hash_file, hash_strings
+        vocab_file_name = os.path.join(self.get_folder(), "vocab.txt")
+        return hash_strings(vw_hash, custom_vocab,
+                            hash_file(vocab_file_name) if custom_vocab else "")
+
+    # Whether reload uses vocab.txt instead of all terms of vw.txt.
+    def uses_custom_vocab(self):
+        try:
+            preprocessing_params = json.loads(self.preprocessing_params)
+        except BaseException:
+            return False
+        return ("filter" in preprocessing_params or
+                bool(preprocessing_params.get("custom_vocab")))
+
+    def update_hashes_after_append(self, new_hashes):
+        from datasets.hashes import StageHashes, hash_file
+        hashes = StageHashes(self.get_folder())
+        documents_hashes = hashes.load_documents_hashes()
+        hashes.reset_documents_hashes()
+        if documents_hashes is None:
+            return
+        vw_hash = hash_file(os.path.join(self.get_folder(), "vw.txt"))
+        hashes.set("batches", vw_hash)
+        hashes.set("dictionary", self.get_dictionary_key(
+            vw_hash, self.uses_custom_vocab()))
+        hashes.set("vocabulary", Dataset.hash_vocabulary(os.path.join(
+            self.get_folder(), "batches", "dictionary.txt")))
+        hashes.save_documents_hashes(list(documents_hashes) + new_hashes)
+
+    def append_untrusted(self, append_folder):
+        try:
+            self.append(append_folder)
+        except BaseException:
+            import traceback
+            self.error_message = traceback.format_exc()
+            self.status = 2
+            self.save()
+        finally:
+            rmtree(append_folder, ignore_errors=True)
+
+    # Builds self.terms_index (as gather_dictionary does) from terms saved
+    # in database.
+    def load_terms_index(self):
+        self.terms_index = dict()
+        for term in Term.objects.filter(dataset=self).select_related(
+                "modality"):
+            self.terms_index[term.text] = term
+            self.terms_index[term.text + "$#" + term.modality.name] = term
+            self.terms_index[term.index_id] = term
+
+    # Counts terms in new documents. Updates frequencies of existing terms and
+    # creates new terms (and modalities) with index_id's after existing ones.
+    @transaction.atomic
+    def append_terms(self, vw_file_name, extend_vocabulary):
+        self.log("Counting terms in new documents...")
+        tf = dict()
+        df = dict()
+        with open(vw_file_name, "r", encoding="utf-8") as f:
+            for line in f:
+                document_terms = set()
+                current_modality = '@default_class'
+                for term in line.split()[1:]:
+                    if term[0] == '|':
+                        current_modality = term[1:]
+                        continue
+                    parsed_term = term.split(':')
+                    key = (parsed_term[0], current_modality)
+                    if ':' in term:
+                        count = int(float(parsed_term[1]))
+                    else:
+                        count = 1
+                    tf[key] = tf.get(key, 0) + count
+                    document_terms.add(key)
+                for key in document_terms:
+                    df[key] = df.get(key, 0) + 1
+
+        modalities_index = {
+            modality.name: modality
+            for modality in Modality.objects.filter(dataset=self)}
+        new_terms = []
+        updated_ids = []
+        updated_tf = []
+        updated_df = []
+        for key, count in tf.items():
+            text, modality_name = key
+            term = self.terms_index.get(text + "$#" + modality_name)
+            if term is not None:
+                updated_ids.append(term.id)
+                updated_tf.append(models.F("token_tf") + count)
+                updated_df.append(models.F("token_df") + df[key])
+                continue
+            if not extend_vocabulary:
+                continue
+            if modality_name not in modalities_index:
+                modality = Modality()
+                modality.index_id = self.modalities_count
+                self.modalities_count += 1
+                modality.name = modality_name
+                modality.dataset = self
+                modality.save()
+                modalities_index[modality_name] = modality
+            modality = modalities_index[modality_name]
+            modality.terms_count += 1
+            new_terms.append(Term(dataset=self,
+                                  text=text,
+                                  modality=modality,
+                                  index_id=self.terms_count + len(new_terms),
+                                  token_tf=count,
+                                  token_df=df[key]))
+
+        self.log("Updating frequencies of %d terms..." % len(updated_ids))
+        Dataset.update_terms(updated_ids, {"token_tf": updated_tf,
+                                           "token_df": updated_df})
+
+        self.log("Saving " + str(len(new_terms)) + " new terms...")
+        Term.objects.bulk_create(new_terms, batch_size=TERMS_BATCH_SIZE)
+        for index_id, term_id in Term.objects.filter(
+                dataset=self, index_id__gte=self.terms_count).values_list(
+                "index_id", "id"):
+            new_terms[index_id - self.terms_count].id = term_id
+        for term in new_terms:
+            self.terms_index[term.text] = term
+            self.terms_index[term.text + "$#" + term.modality.name] = term
+            self.terms_index[term.index_id] = term
+        for modality in modalities_index.values():
+            modality.save()
+        self.terms_count += len(new_terms)
+        self.save()
+
+    # Adds ARTM batches for new documents to batches of dataset.
+    def append_batches(self, vw_file_name):
+        import artm
+        self.log("Creating ARTM batches for new documents...")
+        batches_folder = os.path.join(self.get_folder(), "batches")
+        new_batches_folder = batches_folder + ".new"
+        if os.path.exists(new_batches_folder):
+            rmtree(new_batches_folder)
+        os.makedirs(new_batches_folder)
+        artm.BatchVectorizer(
+            data_path=vw_file_name,
+            data_format="vowpal_wabbit",
+            batch_size=10000,
+            collection_name=self.text_id,
+            target_folder=new_batches_folder
+        )
+        for file_name in os.listdir(new_batches_folder):
+            if file_name.endswith(".batch"):
+                move(os.path.join(new_batches_folder, file_name),
+                     os.path.join(batches_folder, file_name))
+        rmtree(new_batches_folder)
+
+    # Writes terms of dataset to batches/dictionary.txt in order of index_id,
+    # in format of artm.Dictionary.save_text.
+    def save_dictionary(self):
+        dictionary_file_name = os.path.join(
+            self.get_folder(), "batches", "dictionary.txt")
+        with open(dictionary_file_name, "r", encoding="utf-8") as f:
+            header = [f.readline(), f.readline()]
+        terms = Term.objects.filter(dataset=self).order_by(
+            "index_id").values_list("text", "modality__name", "token_value",
+                                    "token_tf", "token_df")
+        with open(dictionary_file_name + ".new", "w",
+                  encoding="utf-8") as f:
+            f.write("".join(header))
+            for text, modality_name, value, tf, df in terms.iterator():
+                f.write("%s, %s, %s, %d, %d\n" %
+                        (text, modality_name, repr(value), tf, df))
+        os.replace(dictionary_file_name + ".new", dictionary_file_name)
+
+    # Documents, parsed by previous reload with the same parameters, aren't
+    # parsed again if their texts didn't change.
+    def preprocess_parse(self, params, hashes=None):
+        from datasets.hashes import hash_file, hash_strings
         self.log("Parsing documents...")
         from algo.preprocessing.Parser import Parser
-        parser = Parser(self.get_folder())
+        parser = Parser(self.get_folder(), language=self.language)
         if "store_order" in params:
             parser.store_order = params["store_order"]
         if "hashtags" in params:
             parser.hashtags = params["hashtags"]
         if "bigrams" in params:
             parser.bigrams = params["bigrams"]
+        parser.workers = getattr(settings, "DATASET_PARSER_WORKERS",
+                                 os.cpu_count() or 1)
+        parser.use_lemma_cache(getattr(
+            settings, "LEMMA_CACHE_FILE",
+            os.path.join(settings.DATA_DIR, "lemmas.sqlite3")))
+        key = hash_strings(json.dumps(params, sort_keys=True), hash_file(
+            os.path.join(self.get_folder(), "meta", "meta.vw.txt")))
+        if hashes is not None:
+            if not hashes.changed("parse", key):
+                parser.previous_hashes = hashes.load_parse_hashes()
+            hashes.reset("parse")
         self.log("Parsing initialized.")
         parser.process()
-        self.log("Parsing done.")
+        if hashes is not None:
+            hashes.save_parse_hashes(parser.documents_hashes)
+            hashes.set("parse", key)
+        self.log("Parsing done. %d of %d documents weren't changed." %
+                 (parser.reused_count, len(parser.documents_hashes)))
 
     def preprocess_filter(self, params):
         from algo.preprocessing.VocabFilter import VocabFilter
         self.log("Filtering words...")
-        filter = VocabFilter(os.path.join(self.get_folder(), "vw.txt"))
+        filter = VocabFilter(
+            os.path.join(self.get_folder(), "vw.txt"),
+            memory_limit=getattr(settings, "VOCAB_FILTER_MEMORY_LIMIT", None))
         self.log("Filtering initilized.")
         if "lower_bound" in params:
             filter.lower_bound = int(params["lower_bound"])
@@ -148,8 +519,11 @@ class Dataset(models.Model):
         )
         self.log("Batches created.")
 
+    # If order of terms in new dictionary is the same as in database (and
+    # so is vocabulary), terms in database are kept and only their
+    # frequencies are updated.
     @transaction.atomic
-    def gather_dictionary(self, custom_vocab=False):
+    def gather_dictionary(self, custom_vocab=False, hashes=None):
         import artm
 
         self.log("Creating ARTM dictionary...")
@@ -160,30 +534,42 @@ class Dataset(models.Model):
             dictionary.gather(batches_folder, vocab_file_path=vocab_file_path)
         else:
             dictionary.gather(batches_folder)
-            vocab_file = open(vocab_file_path, "w", encoding="utf-8")
         dictionary_file_name = os.path.join(
             self.get_folder(), "batches", "dictionary.txt")
         dictionary.save_text(dictionary_file_name)
 
+        vocabulary_hash = Dataset.hash_vocabulary(dictionary_file_name)
+        if (hashes is not None and
+                hashes.get("vocabulary") == vocabulary_hash and
+                Term.objects.filter(dataset=self).count() ==
+                self.terms_count):
+            self.log("Vocabulary didn't change. Updating terms...")
+            self.vocabulary_changed = False
+            self.update_terms_stats(dictionary_file_name)
+            self.load_terms_index()
+            return
+
+        self.vocabulary_changed = True
+        if hashes is not None:
+            hashes.reset("vocabulary")
+            hashes.reset_documents_hashes()
+        from models.models import ArtmModel
+        ArtmModel.objects.filter(dataset=self).delete()
+        Term.objects.filter(dataset=self).delete()
+        Modality.objects.filter(dataset=self).delete()
+        if os.path.exists(self.get_terms_weights_folder()):
+            rmtree(self.get_terms_weights_folder())
+
         self.log("Saving terms to database...")
-        term_index_id = -3
+        if not custom_vocab:
+            vocab_file = open(vocab_file_path, "w", encoding="utf-8")
         self.modalities_count = 0
         self.terms_index = dict()
         modalities_index = dict()
-        with open(dictionary_file_name, "r", encoding='utf-8') as f:
-            for line in f:
-                term_index_id += 1
-                if term_index_id < 0:
-                    continue
-                parsed = line.replace(',', ' ').split()
-                term = Term()
-                term.dataset = self
-                term.text = parsed[0]
-                term.index_id = term_index_id
-                term.token_value = float(parsed[2])
-                term.token_tf = int(parsed[3].split('.')[0])
-                term.token_df = int(parsed[4].split('.')[0])
-                modality_name = parsed[1]
+        terms = []
+        for chunk in Dataset.read_dictionary(dictionary_file_name):
+            counts = chunk["class_id"].value_counts()
+            for modality_name in chunk["class_id"].unique():
                 if modality_name not in modalities_index:
                     modality = Modality()
                     modality.index_id = self.modalities_count
@@ -192,28 +578,49 @@ class Dataset(models.Model):
                     modality.dataset = self
                     modality.save()
                     modalities_index[modality_name] = modality
-                modality = modalities_index[modality_name]
-                term.modality = modality
-                modality.terms_count += 1
-
-                term.save()
-
-                if not custom_vocab:
-                    vocab_file.write("%s %s\n" % (parsed[0], parsed[1]))
-
-                self.terms_index[term.text] = term
-                self.terms_index[term.text + "$#" + term.modality.name] = term
-                self.terms_index[term.index_id] = term
-
-                if term_index_id % 10000 == 0:
-                    self.log(str(term_index_id))
-                    # print(term_index_id)
+                modalities_index[modality_name].terms_count += int(
+                    counts[modality_name])
+
+            chunk_terms = [
+                Term(dataset=self,
+                     text=text,
+                     modality=modalities_index[modality_name],
+                     index_id=len(terms) + i,
+                     token_value=token_value,
+                     token_tf=token_tf,
+                     token_df=token_df)
+                for i, (text, modality_name, token_value, token_tf, token_df)
+                in enumerate(zip(
+                    chunk["token"],
+                    chunk["class_id"],
+                    chunk["token_value"].tolist(),
+                    chunk["token_tf"].astype(np.int64).tolist(),
+                    chunk["token_df"].astype(np.int64).tolist()))]
+            Term.objects.bulk_create(chunk_terms, batch_size=TERMS_BATCH_SIZE)
+            terms.extend(chunk_terms)
+
+            if not custom_vocab:
+                vocab_file.write(''.join(
+                    token + ' ' + modality_name + '\n'
+                    for token, modality_name
+                    in zip(chunk["token"], chunk["class_id"])))
+            self.log(str(len(terms)))
 
         if not custom_vocab:
             vocab_file.close()
 
-        self.terms_count = term_index_id + 1
-        self.terms_count = term_index_id + 1
+        # bulk_create doesn't set primary keys on SQLite, so they are fetched
+        # back with one query.
+        for index_id, term_id in Term.objects.filter(
+                dataset=self).values_list("index_id", "id"):
+            terms[index_id].id = term_id
+
+        for term in terms:
+            self.terms_index[term.text] = term
+            self.terms_index[term.text + "$#" + term.modality.name] = term
+            self.terms_index[term.index_id] = term
+
+        self.terms_count = len(terms)
 
         self.log("Saving modalities...")
         max_modality_size = 0
@@ -232,31 +639,391 @@ class Dataset(models.Model):
             modality.save()
 
         self.normalize_modalities_weights()
-
-    @transaction.atomic
-    def load_documents(self):
+        if hashes is not None:
+            hashes.set("vocabulary", vocabulary_hash)
+
+    # Returns hash of sequence of pairs (token, modality) in dictionary.
+    def hash_vocabulary(dictionary_file_name):
+        import hashlib
+        h = hashlib.sha1()
+        for chunk in Dataset.read_dictionary(dictionary_file_name):
+            h.update(''.join(
+                token + ' ' + modality_name + '\n'
+                for token, modality_name
+                in zip(chunk["token"], chunk["class_id"])).encode("utf-8"))
+        return h.hexdigest()
+
+    # Updates token_value, token_tf and token_df of terms from dictionary,
+    # whose terms are in the same order as in database.
+    def update_terms_stats(self, dictionary_file_name):
+        index_id = 0
+        updated_count = 0
+        for chunk in Dataset.read_dictionary(dictionary_file_name):
+            stats = list(zip(
+                chunk["token_value"].tolist(),
+                chunk["token_tf"].astype(np.int64).tolist(),
+                chunk["token_df"].astype(np.int64).tolist()))
+            terms = Term.objects.filter(
+                dataset=self, index_id__gte=index_id,
+                index_id__lt=index_id + len(stats)).order_by(
+                "index_id").values_list(
+                "id", "token_value", "token_tf", "token_df")
+            changed_ids = []
+            changed_stats = []
+            for (term_id, *old_stats), new_stats in zip(terms, stats):
+                if tuple(old_stats) != new_stats:
+                    changed_ids.append(term_id)
+                    changed_stats.append(new_stats)
+            Dataset.update_terms(changed_ids, {
+                name: [new_stats[i] for new_stats in changed_stats]
+                for i, name in enumerate(
+                    ["token_value", "token_tf", "token_df"])})
+            updated_count += len(changed_ids)
+            index_id += len(stats)
+        self.log("Updated frequencies of %d terms." % updated_count)
+
+    # Sets fields of terms with given ids by one UPDATE with CASE per chunk
+    # of ids. values maps name of field to list of values (or expressions),
+    # one per id. Chunks are small enough, so that all parameters of query
+    # (id and value in each WHEN, and operand of expression) fit into
+    # QUERY_IDS_SIZE.
+    def update_terms(term_ids, values):
+        from django.db.models import Case, When
+        chunk_size = max(1, QUERY_IDS_SIZE // (1 + 3 * len(values)))
+        for begin in range(0, len(term_ids), chunk_size):
+            ids = term_ids[begin: begin + chunk_size]
+            Term.objects.filter(id__in=ids).update(**{
+                name: Case(
+                    *[When(id=term_id, then=value) for term_id, value in zip(
+                        ids, field_values[begin: begin + chunk_size])],
+                    default=models.F(name),
+                    output_field=Term._meta.get_field(name))
+                for name, field_values in values.items()})
+
+    # Reads dictionary.txt, saved by artm.Dictionary.save_text, as sequence
+    # of pandas DataFrames with columns
+    # token, class_id, token_value, token_tf, token_df.
+    def read_dictionary(dictionary_file_name, chunk_size=TERMS_CHUNK_SIZE):
+        import pandas as pd
+        import csv
+        return pd.read_csv(
+            dictionary_file_name,
+            sep=',',
+            skipinitialspace=True,
+            skiprows=2,
+            header=None,
+            names=["token", "class_id", "token_value", "token_tf", "token_df"],
+            dtype={"token": str, "class_id": str, "token_value": np.float64,
+                   "token_tf": np.float64, "token_df": np.float64},
+            quoting=csv.QUOTE_NONE,
+            na_filter=False,
+            encoding="utf-8",
+            chunksize=chunk_size)
+
+    # If hashes are given, documents which didn't change since previous load
+    # are kept in database.
+    def load_documents(self, hashes=None):
+        from datasets.postings import PostingsBuilder
+        from datasets.textstore import TextStoreWriter
         vw_file_name = os.path.join(self.get_folder(), "vw.txt")
         self.log(
             "Loading documents in Vowpal Wabbit format from " +
             vw_file_name)
-        doc_id = 0
-        with open(vw_file_name, "r", encoding="utf-8") as f:
-            for line in f:
-                if len(line) <= 1:
+
+        previous_hashes = None
+        if hashes is not None:
+            previous_hashes = hashes.load_documents_hashes()
+            hashes.reset_documents_hashes()
+        index_builder = None
+        if previous_hashes is None:
+            Document.objects.filter(dataset=self).delete()
+            index_builder = PostingsBuilder(self.get_inverted_index_folder(),
+                                            values_dtype=np.uint16)
+        text_store = TextStoreWriter(self.get_text_store_folder(),
+                                     reset=(previous_hashes is None))
+
+        documents_hashes = self.insert_documents(
+            vw_file_name, 0, index_builder, text_store, previous_hashes)
+        self.documents_count = len(documents_hashes)
+        Document.objects.filter(
+            dataset=self, index_id__gte=self.documents_count).delete()
+        text_store.truncate(self.documents_count)
+        self.text_store = text_store.close()
+        self.save()
+        self.documents_changed = (
+            previous_hashes is None or
+            self.changed_documents_count > 0 or
+            len(previous_hashes) != self.documents_count)
+
+        if index_builder is not None:
+            self.log("Building inverted index...")
+            index_builder.finish(self.terms_count)
+            self.log("Inverted index built.")
+            self.log("Building search indexes...")
+            self.build_search_indexes()
+            self.log("Search indexes built.")
+        elif self.documents_changed:
+            self.log("%d documents changed. Rebuilding indexes..." %
+                     self.changed_documents_count)
+            self.build_inverted_index()
+            self.build_search_index("titles")
+            self.build_search_index("text_ids")
+            self.log("Indexes rebuilt.")
+        else:
+            self.log("Documents didn't change.")
+
+        if hashes is not None:
+            hashes.save_documents_hashes(documents_hashes)
+
+    # Parses documents from Vowpal Wabbit file, saves them to database with
+    # index_id's starting from first_index_id and adds their bags of words to
+    # index_builder (if it is given). Texts of documents are written to
+    # text_store (TextStoreWriter) instead of database. Documents, whose hash
+    # equals hash in previous_hashes, are skipped; other documents replace
+    # ones with the same index_id's. Returns list of hashes of all documents
+    # in file.
+    def insert_documents(self, vw_file_name, first_index_id, index_builder,
+                         text_store, previous_hashes=None):
+        from datasets.loader import (read_chunks, attach_meta, parse_chunks,
+                                     ROW_FIELDS)
+        chunk_size = getattr(settings, "DATASET_LOADER_CHUNK_SIZE", 1000)
+        workers = getattr(settings, "DATASET_LOADER_WORKERS",
+                          os.cpu_count() or 1)
+
+        self.open_wordpos_pack()
+        documents_hashes = []
+        self.changed_documents_count = 0
+        meta = None
+        if getattr(self, "meta_file_name", None) is not None:
+            from datasets.meta import MetaJoiner
+            meta = MetaJoiner(self.meta_file_name, self.log)
+        chunks = attach_meta(
+            read_chunks(vw_file_name, chunk_size, first_index_id), meta)
+        for rows in parse_chunks(self, chunks, workers, previous_hashes):
+            documents = []
+            for index_id, values, document_hash, doc_info in rows:
+                documents_hashes.append(document_hash)
+                if values is None:
                     continue
-                doc = Document()
+                doc = Document(**dict(zip(ROW_FIELDS, values)))
                 doc.dataset = self
-                doc.index_id = doc_id
-                doc.fetch_vw(line)
-                if doc.text_id in self.docs_info:
-                    doc.fetch_meta(self.docs_info[doc.text_id])
-                doc.save()
-                doc_id += 1
-                if doc_id % 1000 == 0:
-                    self.log(str(doc_id))
-
-        self.documents_count = doc_id
-        self.save()
+                doc.index_id = index_id
+                text_store.put(index_id, doc.text)
+                doc.text = None
+                if doc_info is not None:
+                    doc.fetch_meta(doc_info)
+                documents.append(doc)
+            with transaction.atomic():
+                if previous_hashes is not None:
+                    index_ids = [doc.index_id for doc in documents]
+                    for i in range(0, len(index_ids), QUERY_IDS_SIZE):
+                        Document.objects.filter(
+                            dataset=self, index_id__in=index_ids[
+                                i: i + QUERY_IDS_SIZE]).delete()
+                Document.objects.bulk_create(
+                    documents, batch_size=DOCUMENTS_BATCH_SIZE)
+            if index_builder is not None:
+                Dataset.add_to_inverted_index(
+                    index_builder,
+                    [doc.index_id for doc in documents],
+                    [doc.bag_of_words for doc in documents])
+            self.changed_documents_count += len(documents)
+            self.log(str(len(documents_hashes)))
+        if meta is not None:
+            meta.close()
+            if meta.failed:
+                self.time_provided = False
+        return documents_hashes
+
+    # Texts of documents are kept in compressed store (see datasets.textstore)
+    # instead of database. Documents loaded before store was introduced keep
+    # texts in database.
+    def get_text_store_folder(self):
+        return os.path.join(self.get_folder(), "texts")
+
+    # Returns TextStore, or None if dataset has no store.
+    def get_text_store(self):
+        from datasets.textstore import TextStore
+        if getattr(self, "text_store", None) is None:
+            folder = self.get_text_store_folder()
+            if not TextStore.exists(folder):
+                return None
+            self.text_store = TextStore(folder)
+        return self.text_store
+
+    # Opens packed container of positions of words, written by Parser (see
+    # algo.preprocessing.WordposPack), and maps its keys to index_id's of
+    # terms. Documents missing in container (or all documents, if there is
+    # no container) are read from wordpos/ files.
+    def open_wordpos_pack(self):
+        from algo.preprocessing.WordposPack import WordposPack
+        self.wordpos_pack = None
+        folder = os.path.join(self.get_folder(), "wordpos_pack")
+        if WordposPack.exists(folder):
+            self.wordpos_pack = WordposPack(folder)
+            self.wordpos_terms = self.wordpos_pack.map_keys(dict(
+                (key, term.index_id)
+                for key, term in self.terms_index.items()))
+
+    # Inverted index maps term.index_id to list of index_id's of documents,
+    # containing this term (sorted by document index_id), and counts of the
+    # term in these documents. It is stored as memory-mapped CSR matrix.
+    def get_inverted_index_folder(self):
+        return os.path.join(self.get_folder(), "inverted_index")
+
+    # Returns None if index wasn't built yet (see schedule_indexes_build).
+    def get_inverted_index(self):
+        from datasets.postings import Postings
+        folder = self.get_inverted_index_folder()
+        if not Postings.exists(folder):
+            self.schedule_indexes_build()
+            return None
+        return Postings(folder)
+
+    # Builds inverted index from bags of words stored in database.
+    # Is needed only for datasets loaded before inverted index was introduced.
+    def build_inverted_index(self):
+        from datasets.postings import PostingsBuilder
+        index_builder = PostingsBuilder(self.get_inverted_index_folder(),
+                                        values_dtype=np.uint16)
+        documents = Document.objects.filter(dataset=self).order_by(
+            "index_id").values_list("index_id", "bag_of_words")
+        index_ids = []
+        bags = []
+        for index_id, bag_of_words in documents.iterator():
+            index_ids.append(index_id)
+            bags.append(bag_of_words)
+            if len(index_ids) == DOCUMENTS_BATCH_SIZE:
+                Dataset.add_to_inverted_index(index_builder, index_ids, bags)
+                index_ids = []
+                bags = []
+        Dataset.add_to_inverted_index(index_builder, index_ids, bags)
+        index_builder.finish(self.terms_count)
+
+    def add_to_inverted_index(index_builder, index_ids, bags):
+        bags = [codec.decode(bag, codec.BOW_DTYPE) for bag in bags]
+        if len(bags) == 0:
+            return
+        index_builder.add(
+            np.concatenate([bag["term"] for bag in bags]),
+            np.repeat(index_ids, [len(bag) for bag in bags]),
+            np.concatenate([bag["count"] for bag in bags]))
+
+    # Search indexes are trigram indexes (see datasets.trigrams) for
+    # substring search over fields of terms and documents of dataset.
+    # Index name -> (model, field).
+    SEARCH_INDEXES = {
+        "terms": ("Term", "text"),
+        "titles": ("Document", "title"),
+        "text_ids": ("Document", "text_id"),
+    }
+
+    def get_search_index_folder(self, name):
+        return os.path.join(self.get_folder(), "search_index", name)
+
+    # Returns None if index wasn't built yet (see schedule_indexes_build).
+    def get_search_index(self, name):
+        from datasets.trigrams import TrigramIndex
+        folder = self.get_search_index_folder(name)
+        if not TrigramIndex.exists(folder):
+            self.schedule_indexes_build()
+            return None
+        return TrigramIndex(folder)
+
+    # Indexes of datasets loaded before they were introduced are built when
+    # they are first needed: in background, as reload is, and never inside
+    # request. Meanwhile dataset is shown as being processed and isn't
+    # searched. Status is changed with one conditional update, so build is
+    # started once.
+    def schedule_indexes_build(self):
+        if not settings.THREADING:
+            return
+        if Dataset.objects.filter(id=self.id, status=0).update(status=1) == 0:
+            return
+        self.status = 1
+        from threading import Thread
+        Thread(target=Dataset.build_indexes_untrusted, args=(self, ),
+               daemon=True).start()
+
+    def build_indexes_untrusted(self):
+        try:
+            self.build_missing_indexes()
+            Dataset.objects.filter(id=self.id).update(status=0)
+        except BaseException:
+            import traceback
+            Dataset.objects.filter(id=self.id).update(
+                status=2, error_message=traceback.format_exc())
+
+    def build_missing_indexes(self):
+        from datasets.postings import Postings
+        from datasets.trigrams import TrigramIndex
+        if not Postings.exists(self.get_inverted_index_folder()):
+            self.build_inverted_index()
+        for name in Dataset.SEARCH_INDEXES:
+            if not TrigramIndex.exists(self.get_search_index_folder(name)):
+                self.build_search_index(name)
+
+    def build_search_indexes(self):
+        for name in Dataset.SEARCH_INDEXES:
+            self.build_search_index(name)
+
+    def build_search_index(self, name):
+        model_name, field = Dataset.SEARCH_INDEXES[name]
+        objects = globals()[model_name].objects.filter(dataset=self)
+        values = objects.order_by("index_id").values_list("index_id", field)
+        Dataset.write_search_index(self.get_search_index_folder(name),
+                                   values.iterator())
+
+    # Writes search index of pairs (index_id, value of field) to folder.
+    def write_search_index(folder, values):
+        from datasets.trigrams import TrigramIndexBuilder
+        builder = TrigramIndexBuilder(folder)
+        index_ids = []
+        strings = []
+        for index_id, string in values:
+            index_ids.append(index_id)
+            strings.append(string)
+            if len(index_ids) == TERMS_BATCH_SIZE:
+                builder.add(index_ids, strings)
+                index_ids = []
+                strings = []
+        builder.add(index_ids, strings)
+        builder.finish()
+
+    # Returns list of terms or documents of dataset, whose field contains
+    # query as substring (case-insensitive). Objects are ordered by index_id.
+    # Documents are returned without texts, word indexes and bags of words
+    # (see Document.brief). If index wasn't built yet, nothing is found.
+    def search_substring(self, name, query):
+        model = globals()[Dataset.SEARCH_INDEXES[name][0]]
+        index = self.get_search_index(name)
+        if index is None:
+            return []
+        index_ids = index.search(query).tolist()
+        objects = model.objects.filter(dataset=self)
+        if model == Document:
+            objects = Document.brief(objects)
+        objects = Document.get_by_index_ids(objects, index_ids)
+        result = []
+        for index_id in index_ids:
+            if index_id in objects:
+                objects[index_id].dataset = self
+                result.append(objects[index_id])
+        return result
+
+    # Returns arrays of values of given fields of all documents, indexed by
+    # index_id (None for missing documents). Only these fields are read from
+    # database, and rows are written to arrays as they are read.
+    def get_documents_columns(self, *fields):
+        columns = [np.empty(self.documents_count, dtype=object)
+                   for field in fields]
+        for index_id, *values in Document.objects.filter(
+                dataset=self).values_list("index_id", *fields).iterator():
+            if index_id >= self.documents_count:
+                continue
+            for column, value in zip(columns, values):
+                column[index_id] = value
+        return columns
 
     def reload_untrusted(self):
         try:
@@ -267,30 +1034,24 @@ class Dataset(models.Model):
             self.status = 2
             self.save()
 
-    def upload_from_archive(self, archive):
-        archive_name = str(archive)
+    # Returns folder, to which uploaded archive of new dataset is extracted
+    # (see datasets.upload). Raises ValueError if archive can't be uploaded.
+    def get_upload_folder(archive_name):
         parsed = archive_name.split('.')
-        if parsed[1] != 'zip':
+        if len(parsed) < 2 or parsed[0] == "" or parsed[1] != 'zip':
             raise ValueError("Must be zip archive")
-        self.text_id = parsed[0]
-        self.name = parsed[0]
-        self.prepare_log("Loading dataset %s from archive..." % self.text_id)
-
         if len(Dataset.objects.filter(text_id=parsed[0])) != 0:
             raise ValueError("Dataset " + parsed[0] + " already exists.")
-        zip_file_name = os.path.join(self.get_folder(), archive_name)
-        with open(os.path.join(self.get_folder(), archive_name), 'wb+') as f:
-            for chunk in archive.chunks():
-                f.write(chunk)
-        self.log("Archive uploaded.")
-
-        import zipfile
-        zip_ref = zipfile.ZipFile(zip_file_name, 'r')
-        zip_ref.extractall(self.get_folder())
-        zip_ref.close()
-        self.log("Archive unpacked. Dataset name: " + self.text_id)
+        return os.path.join(settings.DATA_DIR, "datasets", parsed[0])
 
-        os.remove(zip_file_name)
+    # Registers dataset from uploaded archive, which is extracted while it is
+    # received by datasets.upload.ArchiveUploadHandler.
+    def upload_from_archive(self, archive):
+        archive.check()
+        self.text_id = str(archive).split('.')[0]
+        self.name = self.text_id
+        self.prepare_log("Loading dataset %s from archive..." % self.text_id)
+        self.log("Archive unpacked. Dataset name: " + self.text_id)
 
     def get_batches(self):
         import artm
@@ -355,12 +1116,56 @@ class Dataset(models.Model):
             # term.index_id
         return terms_index
 
+    # Returns dict index_id -> tuple of requested fields for terms with given
+    # index_id's. Terms are fetched with queries of bounded size, because
+    # SQLite limits number of query parameters.
+    def get_terms(self, index_ids, *fields):
+        ret = dict()
+        index_ids = list(index_ids)
+        for i in range(0, len(index_ids), QUERY_IDS_SIZE):
+            for values in Term.objects.filter(
+                    dataset=self,
+                    index_id__in=index_ids[i: i + QUERY_IDS_SIZE]
+                    ).values_list("index_id", *fields):
+                ret[values[0]] = values[1:]
+        return ret
+
+    # Returns array of index_id's of terms with given labels (-1 for terms
+    # which aren't in dictionary). Label is text of term, or pair of text and
+    # name of modality (in any order), which distinguishes equal texts in
+    # different modalities. Plain texts are resolved as in get_terms_index.
+    def get_terms_ids(self, labels, modality=None):
+        labels = list(labels)
+        if modality:
+            query_set = Term.objects.filter(dataset=self, modality=modality)
+        else:
+            query_set = Term.objects.filter(
+                dataset=self).order_by("-modality__weight_naming")
+        terms = query_set.values_list("text", "modality__name", "index_id")
+
+        if len(labels) > 0 and isinstance(labels[0], tuple):
+            names = set(Modality.objects.filter(
+                dataset=self).values_list("name", flat=True))
+            text_position = 0
+            if all(label[0] in names for label in labels):
+                text_position = 1
+            index = dict(((text, name), index_id)
+                         for text, name, index_id in terms.iterator())
+            keys = [(label[text_position], label[1 - text_position])
+                    for label in labels]
+        else:
+            index = dict((text, index_id)
+                         for text, name, index_id in terms.iterator())
+            keys = labels
+        return np.array([index.get(key, -1) for key in keys], dtype=np.int64)
+
     def check_terms_order(self, index, full=True):
         if self.terms_count != len(index):
             return False
         if full:
-            for term in Term.objects.filter(dataset=self):
-                if index[term.index_id] != term.text:
+            for index_id, text in Term.objects.filter(
+                    dataset=self).values_list("index_id", "text").iterator():
+                if index[index_id] != text:
                     return False
         else:
             import random
@@ -417,38 +1222,54 @@ class Dataset(models.Model):
     # Note. Each modality has two weights: for distance counting (spectrum)
     # and for top terms ranking (naming). In some procedures those weights are
     # used. To speed up those procedures, we count all weights for terms once
-    # in reset_terms_weights and store in file. This function just read
+    # in reset_terms_weights and store in file. This function just maps
     # corresonding array from file.
     def get_terms_weights(self, mode):
-        if not os.path.exists(os.path.join(
-                self.get_folder(), "terms_weights")):
+        if mode not in ["spectrum", "naming"]:
+            return None
+        file_name = os.path.join(self.get_terms_weights_folder(),
+                                 mode + ".npy")
+        if not os.path.exists(file_name):
             self.reset_terms_weights()
+        return np.load(file_name, mmap_mode='r')
 
-        if mode == "spectrum":
-            return np.load(os.path.join(self.get_folder(),
-                                        "terms_weights", "spectrum.npy"))
-        elif mode == "naming":
-            return np.load(os.path.join(self.get_folder(),
-                                        "terms_weights", "naming.npy"))
+    def get_terms_weights_folder(self):
+        return os.path.join(self.get_folder(), "terms_weights")
 
-    # Counts weights for terms and stores them in file.
+    # Counts weights and modalities of terms and stores them in files.
+    # Modalities of all terms are read in one query, and weights are taken
+    # from arrays of weights of modalities.
     def reset_terms_weights(self):
-        folder = os.path.join(self.get_folder(), "terms_weights")
+        folder = self.get_terms_weights_folder()
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        weights_spectrum = np.zeros(self.terms_count)
-        weights_naming = np.zeros(self.terms_count)
-
-        for modality in Modality.objects.filter(dataset=self):
-            ws = modality.weight_spectrum
-            wn = modality.weight_naming
-            for term in Term.objects.filter(modality=modality):
-                weights_spectrum[term.index_id] = ws
-                weights_naming[term.index_id] = wn
-
-        np.save(os.path.join(folder, "spectrum.npy"), weights_spectrum)
-        np.save(os.path.join(folder, "naming.npy"), weights_naming)
+        modalities = list(Modality.objects.filter(dataset=self).values_list(
+            "index_id", "weight_spectrum", "weight_naming"))
+        modalities_count = max([m[0] for m in modalities] + [0]) + 1
+        modality_spectrum = np.zeros(modalities_count)
+        modality_naming = np.zeros(modalities_count)
+        for index_id, ws, wn in modalities:
+            modality_spectrum[index_id] = ws
+            modality_naming[index_id] = wn
+
+        mask = np.zeros(self.terms_count, dtype=np.int32)
+        terms = np.array(list(Term.objects.filter(dataset=self).values_list(
+            "index_id", "modality__index_id").iterator()),
+            dtype=np.int64).reshape(-1, 2)
+        mask[terms[:, 0]] = terms[:, 1]
+
+        # New files are written first, so readers never see missing file.
+        for name, array in [("spectrum", modality_spectrum[mask]),
+                            ("naming", modality_naming[mask]),
+                            ("modalities", mask)]:
+            file_name = os.path.join(folder, name + ".npy")
+            np.save(file_name + ".new.npy", array)
+            os.replace(file_name + ".new.npy", file_name)
+
+        old_mask_file = os.path.join(self.get_folder(), "modalities_mask.npy")
+        if os.path.exists(old_mask_file):
+            os.remove(old_mask_file)
 
     def delete_cached_distances(self):
         from models.models import ArtmModel
@@ -469,18 +1290,39 @@ class Dataset(models.Model):
                 print("Removing trash: %s" % folder_to_remove)
                 rmtree(folder_to_remove)
 
+    # Statistics for page of dataset are computed on reload and stored in
+    # file (see datasets.stats), so page doesn't iterate over all terms and
+    # documents.
+    def get_stats_file_name(self):
+        return os.path.join(self.get_folder(), "stats.json")
+
+    def reset_stats(self):
+        from datasets.stats import (count_terms_stats, count_documents_stats,
+                                    save_stats)
+        stats = count_terms_stats(
+            Term.objects.filter(dataset=self).order_by(
+                "-token_tf").values_list("token_tf", "text").iterator())
+        stats.update(count_documents_stats(
+            Document.objects.filter(dataset=self).values_list(
+                "time", "terms_count").iterator()))
+        save_stats(self.get_stats_file_name(), stats)
+
+    def get_stats(self):
+        from datasets.stats import load_stats
+        stats = load_stats(self.get_stats_file_name())
+        if stats is None:
+            self.reset_stats()
+            stats = load_stats(self.get_stats_file_name())
+        return stats
+
+    # Returns array of index_id's of modalities of terms (see
+    # reset_terms_weights).
     def get_modalities_mask(self):
-        path = os.path.join(self.get_folder(), "modalities_mask.npy")
-        if os.path.exists(path):
-            return np.load(path)
-        else:
-            ans = np.zeros(self.terms_count, dtype=np.int32)
-            i = 0
-            for term in Term.objects.filter(dataset=self):
-                ans[i] = term.modality.index_id
-                i += 1
-            np.save(path, ans)
-            return ans
+        file_name = os.path.join(self.get_terms_weights_folder(),
+                                 "modalities.npy")
+        if not os.path.exists(file_name):
+            self.reset_terms_weights()
+        return np.load(file_name, mmap_mode='r')
 
 
 @receiver(pre_delete, sender=Dataset, dispatch_uid='dataset_delete_signal')
@@ -590,30 +1432,51 @@ class Document(models.Model):
             with open(text_file, "r", encoding="utf-8") as f2:
                 self.text = f2.read()
 
+            wordpos_pack = getattr(self.dataset, "wordpos_pack", None)
+            records = None
+            if wordpos_pack is not None:
+                records = wordpos_pack.get(self.text_id)
             wordpos_file = os.path.join(
                 self.dataset.get_folder(), "wordpos", self.text_id)
-            if os.path.exists(wordpos_file):
-                word_index_list = []
+            if records is not None:
+                terms = self.dataset.wordpos_terms[records["key"]]
+                known = terms >= 0
+                positions = records["pos"][known]
+                lengths = records["length"][known]
+                terms = terms[known]
+                order = np.lexsort((terms, -lengths.astype(np.int64),
+                                    positions))
+                self.word_index = codec.encode_word_index(
+                    positions[order], lengths[order], terms[order])
+            elif os.path.exists(wordpos_file):
+                positions = []
+                lengths = []
+                terms = []
                 with open(wordpos_file, "r", encoding="utf-8") as f2:
-                    for line in f2.readlines():
+                    for line in f2:
                         parsed = line.split()
                         if len(parsed) < 3:
                             continue
                         key = parsed[2]
                         if key in self.dataset.terms_index:
-                            term_iid = self.dataset.terms_index[key].index_id
-                            word_index_list.append(
-                                (int(parsed[0]), -int(parsed[1]), term_iid))
-                word_index_list.sort()
-                self.word_index = bytes()
-                for pos, length, tid in word_index_list:
-                    self.word_index += struct.pack('I', pos) + struct.pack(
-                        'B', -length) + struct.pack('I', tid)
+                            positions.append(int(parsed[0]))
+                            lengths.append(int(parsed[1]))
+                            terms.append(
+                                self.dataset.terms_index[key].index_id)
+                # Sort by position, longer terms first.
+                order = np.lexsort((terms, np.negative(lengths), positions))
+                self.word_index = codec.encode_word_index(
+                    np.take(positions, order),
+                    np.take(lengths, order),
+                    np.take(terms, order))
             else:
                 self.dataset.log(
                     "WARNING! No wordpos for file " + self.text_id)
 
         bow = BagOfWords()
+        positions = []
+        lengths = []
+        terms = []
         current_modality = '@default_class'
         for term in parsed_vw[1:]:
             if term[0] == '|':
@@ -630,16 +1493,19 @@ class Document(models.Model):
                     self.terms_count += count
                     bow.add_term(term_index_id, count)
                     if not text_found:
-                        self.word_index += \
-                            struct.pack('I', len(self.text)) + \
-                            struct.pack('B', len(parsed_term[0])) + \
-                            struct.pack('I', term_index_id)
+                        positions.append(len(self.text))
+                        lengths.append(len(parsed_term[0]))
+                        terms.append(term_index_id)
                 except BaseException:
                     pass
             if not text_found:
                 self.text += term + " "
+        if not text_found:
+            self.word_index = codec.encode_word_index(
+                positions, lengths, terms)
         self.bag_of_words = bow.to_bytes(self.dataset.terms_index)
-        self.unique_terms_count = len(self.bag_of_words) // 7
+        self.unique_terms_count = \
+            len(self.bag_of_words) // codec.BOW_DTYPE.itemsize
 
     def objects_safe(request):
         if request.user.is_anonymous():
@@ -649,23 +1515,31 @@ class Document(models.Model):
                     Document.objects.filter(
                     dataset__is_public=False, dataset__owner=request.user))
 
+    # Fields, which are enough to show document in lists and visualizations.
+    BRIEF_FIELDS = ("id", "index_id", "dataset", "title", "url", "snippet",
+                    "time", "text_id", "terms_count", "unique_terms_count")
+
+    # Returns queryset of documents with deferred text, word index and bag of
+    # words, so listing code doesn't load them.
+    def brief(documents):
+        return documents.only(*Document.BRIEF_FIELDS)
+
+    # Returns dict index_id -> object for objects from queryset (of one
+    # dataset) with given index_id's, fetched in bulk.
+    def get_by_index_ids(objects, index_ids):
+        result = dict()
+        for i in range(0, len(index_ids), QUERY_IDS_SIZE):
+            for obj in objects.filter(
+                    index_id__in=index_ids[i: i + QUERY_IDS_SIZE]):
+                result[obj.index_id] = obj
+        return result
+
     def count_term(self, iid):
-        bow = self.bag_of_words
-        left = 0
-        right = len(bow) // 7
-        if right == 0:
-            return 0
-        while True:
-            pos = (left + right) // 2
-            bow_iid = struct.unpack('I', bow[7 * pos: 7 * pos + 4])[0]
-            if bow_iid == iid:
-                return struct.unpack('H', bow[7 * pos + 4: 7 * pos + 6])[0]
-            elif bow_iid > iid:
-                right = pos
-            else:
-                left = pos + 1
-            if left >= right:
-                return 0
+        bow = codec.decode(self.bag_of_words, codec.BOW_DTYPE)
+        pos = np.searchsorted(bow["term"], iid)
+        if pos < len(bow) and bow["term"][pos] == iid:
+            return int(bow["count"][pos])
+        return 0
 
     def fetch_tags(self):
         tag_modalities = Modality.objects.filter(
@@ -679,104 +1553,97 @@ class Document(models.Model):
         for modality in tag_modalities:
             tag_names[modality.index_id] = modality.name
 
-        bow = self.bag_of_words
-        unique_terms_count = len(bow) // 7
-
-        for i in range(unique_terms_count):
-            bow_iid = struct.unpack('I', bow[7 * i: 7 * i + 4])[0]
-            modality_iid = struct.unpack('B', bow[7 * i + 6: 7 * i + 7])[0]
-            if modality_iid in tag_names:
-                term = Term.objects.filter(
-                    dataset=self.dataset, index_id=bow_iid)[0]
-                if modality_iid in tag_strings:
-                    tag_strings[modality_iid] += ', '
-                else:
-                    tag_strings[modality_iid] = ''
-                tag_strings[modality_iid] += '<a href="/term?id=' + \
-                    str(term.id) + '">' + term.text + '</a>'
+        bow = codec.decode(self.bag_of_words, codec.BOW_DTYPE)
+        bow = bow[Document.modalities_mask(tag_names)[bow["modality"]]]
+        terms = self.dataset.get_terms(bow["term"].tolist(), "id", "text")
+
+        for bow_iid, modality_iid in zip(bow["term"].tolist(),
+                                         bow["modality"].tolist()):
+            term_id, term_text = terms[bow_iid]
+            if modality_iid in tag_strings:
+                tag_strings[modality_iid] += ', '
+            else:
+                tag_strings[modality_iid] = ''
+            tag_strings[modality_iid] += '<a href="/term?id=' + \
+                str(term_id) + '">' + term_text + '</a>'
 
         ret = []
         for tag_id, tag_string in tag_strings.items():
             ret.append({"name": tag_names[tag_id], "string": tag_string})
         return ret
 
+    # Returns boolean mask over modalities index_id's (which are 1 byte).
+    def modalities_mask(modalities_ids):
+        mask = np.zeros(256, dtype=bool)
+        mask[list(modalities_ids)] = True
+        return mask
+
     # Returns set of index_id's of words in this document which are modlities.
     def get_tags_ids(self):
-        tag_ids = set()
-        ret = set()
-        for modality in Modality.objects.filter(
-                dataset=self.dataset, is_tag=True):
-            tag_ids.add(modality.index_id)
-        bow = self.bag_of_words
-        for i in range(len(bow) // 7):
-            modality_iid = struct.unpack('B', bow[7 * i + 6: 7 * i + 7])[0]
-            if modality_iid in tag_ids:
-                ret.add(struct.unpack('I', bow[7 * i: 7 * i + 4])[0])
-        return ret
+        tag_ids = [modality.index_id for modality in Modality.objects.filter(
+            dataset=self.dataset, is_tag=True)]
+        bow = codec.decode(self.bag_of_words, codec.BOW_DTYPE)
+        mask = Document.modalities_mask(tag_ids)[bow["modality"]]
+        return set(bow["term"][mask].tolist())
 
     def fetch_bow(self, cut_bow):
-        bow = self.bag_of_words
-        unique_terms_count = len(bow) // 7
-        bow_entries = []
-        for i in range(unique_terms_count):
-            bow_iid = struct.unpack('I', bow[7 * i: 7 * i + 4])[0]
-            bow_count = struct.unpack('H', bow[7 * i + 4: 7 * i + 6])[0]
-            bow_entries.append((-bow_count, bow_iid))
-        bow_entries.sort()
-        bow_send = ""
-        prfx = "<a href = '/term?ds=" + str(self.dataset.id) + "&iid="
-        rest = unique_terms_count
-        for x in bow_entries:
-            cnt = -x[0]
-            iid = x[1]
-            if cnt <= cut_bow:
-                bow_send += str(rest) + " terms, which occured " + \
-                    str(cut_bow) + " times or less, aren't shown."
-                break
-            bow_send += prfx + str(iid) + "'>" + \
-                Term.objects.filter(dataset=self.dataset,
-                                    index_id=iid)[0].text + \
-                "</a>: " + str(cnt) + "<br>"
-            rest -= 1
+        bow = codec.decode(self.bag_of_words, codec.BOW_DTYPE)
+        unique_terms_count = len(bow)
+        # Most frequent terms first, ties are ordered by index_id.
+        bow = bow[np.lexsort((bow["term"], -bow["count"].astype(np.int64)))]
+        bow = bow[bow["count"] > cut_bow]
+        terms = self.dataset.get_terms(bow["term"].tolist(), "text")
 
+        prfx = "<a href = '/term?ds=" + str(self.dataset.id) + "&iid="
+        bow_send = ''.join([
+            prfx + str(iid) + "'>" + terms[iid][0] + "</a>: " +
+            str(cnt) + "<br>"
+            for iid, cnt in zip(bow["term"].tolist(), bow["count"].tolist())])
+        rest = unique_terms_count - len(bow)
+        if rest > 0:
+            bow_send += str(rest) + " terms, which occured " + \
+                str(cut_bow) + " times or less, aren't shown."
         return bow_send
 
+    # Text is read from text store of dataset, so it isn't loaded with
+    # document from database.
     def get_text(self):
+        text_store = self.dataset.get_text_store()
+        if text_store is not None:
+            text = text_store.get(self.index_id)
+            if text is not None:
+                return text
         return self.text
 
     # Returns positions of terms as list of triples:
     #     (position, length, term.index_id).
     def get_word_index(self, no_overlap=True):
-        wi = self.word_index
-        if wi is None:
+        if self.word_index is None:
             return None
 
-        count = len(wi) // 9
+        wi = codec.decode(self.word_index, codec.WORD_INDEX_DTYPE)
+        entries = zip(wi["pos"].tolist(), wi["length"].tolist(),
+                      wi["term"].tolist())
+        if not no_overlap:
+            return list(entries)
+
         last_pos = -1
         ret = []
-        for i in range(count):
-            pos = struct.unpack('I', wi[9 * i: 9 * i + 4])[0]
-            length = struct.unpack('B', wi[9 * i + 4: 9 * i + 5])[0]
-            if no_overlap:
-                if pos < last_pos:
-                    continue
-                else:
-                    last_pos = pos + length
-            ret.append((pos, length, struct.unpack(
-                'I', wi[9 * i + 5: 9 * i + 9])[0]))
-
+        for pos, length, term_index_id in entries:
+            if pos < last_pos:
+                continue
+            last_pos = pos + length
+            ret.append((pos, length, term_index_id))
         return ret
 
     def get_concordance(self, terms):
-        text = self.text
-        wi = self.word_index
+        text = self.get_text()
+        terms = set(terms)
         conc = ""
         cur_pos = 0
-        for i in range(len(wi) // 9):
-            term_index_id = struct.unpack('I', wi[9 * i + 5: 9 * i + 9])[0]
+        for pos, length, term_index_id in self.get_word_index(
+                no_overlap=False):
             if term_index_id in terms:
-                pos = struct.unpack('I', wi[9 * i: 9 * i + 4])[0]
-                length = struct.unpack('B', wi[9 * i + 4: 9 * i + 5])[0]
                 conc += text[cur_pos: pos] + "<b>" + \
                     text[pos: pos + length] + "</b>"
                 cur_pos = pos + length
@@ -841,48 +1708,33 @@ class Term(models.Model):
     token_value = models.FloatField(default=0)
     token_tf = models.IntegerField(default=0)
     token_df = models.IntegerField(default=0)
-    documents = models.BinaryField(null=True)
-    documents_defined = models.BooleanField(default=False)
 
     def __str__(self):
         return self.text
 
-    def count_documents_index(self):
-        if self.documents_defined:
-            return
-        self.documents_defined = True
-        self.save()
-        relations = []
-        documents = Document.objects.filter(dataset=self.dataset)
-
-        temp_count = 0
-
-        self.documents = bytes()
-        for document in documents:
-            count = document.count_term(self.index_id)
-            if count != 0:
-                relations.append((count, document.index_id))
-                if temp_count < 5:
-                    self.documents += struct.pack('I', document.index_id) + \
-                        struct.pack('H', count)
-                    temp_count += 1
-                    self.save()
-
-        relations.sort(reverse=True)
-
-        self.documents = bytes()
-        for count, document_index_id in relations:
-            self.documents += struct.pack('I', document_index_id) + \
-                struct.pack('H', count)
-
-        self.save()
-
+    # Returns index_id's of documents containing this term and counts of the
+    # term in them. The most frequent occurences go first.
+    def get_documents_index(self):
+        index = self.dataset.get_inverted_index()
+        if index is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        doc_ids, counts = index.get(self.index_id)
+        order = np.lexsort((-doc_ids.astype(np.int64),
+                            -counts.astype(np.int64)))
+        return doc_ids[order], counts[order]
+
+    # Yields documents containing term, in order of get_documents_index.
+    # Documents are fetched in bulk, QUERY_IDS_SIZE at once.
     def get_documents(self):
-        self.count_documents_index()
-        for i in range(len(self.documents) // 6):
-            doc_iid = struct.unpack('I', self.documents[6 * i: 6 * i + 4])[0]
-            yield Document.objects.get(dataset_id=self.dataset_id,
-                                       index_id=doc_iid)
+        doc_ids, counts = self.get_documents_index()
+        doc_ids = doc_ids.tolist()
+        objects = Document.objects.filter(dataset_id=self.dataset_id)
+        for i in range(0, len(doc_ids), QUERY_IDS_SIZE):
+            chunk = doc_ids[i: i + QUERY_IDS_SIZE]
+            documents = Document.get_by_index_ids(objects, chunk)
+            for doc_iid in chunk:
+                if doc_iid in documents:
+                    yield documents[doc_iid]
 
     def objects_safe(request):
         if request.user.is_anonymous():
@@ -910,8 +1762,8 @@ class BagOfWords():
             self.bow[word_id] += count
 
     def to_bytes(self, terms_index):
-        ret = bytes()
-        for word_id, count in sorted(self.bow.items()):
-            ret += struct.pack('I', word_id) + struct.pack('H', count) + \
-                struct.pack('B', terms_index[word_id].modality.index_id)
-        return ret
+        word_ids = sorted(self.bow)
+        return codec.encode_bow(
+            word_ids,
+            [self.bow[word_id] for word_id in word_ids],
+            [terms_index[word_id].modality.index_id for word_id in word_ids])
@@ -0,0 +1,242 @@
+# Memory-mapped posting lists.
+#
+# Posting lists are stored in a folder as CSR matrix in three numpy files:
+#     indptr.npy - int64, rows_count + 1 offsets;
+#     ids.npy    - ids of postings, row i is ids[indptr[i]:indptr[i + 1]];
+#     values.npy - values attached to postings (optional).
+# Inside each row postings are kept in order in which they were added.
+#
+# PostingsBuilder accepts postings in chunks of arbitrary order, spills them to
+# temporary files and then places them with counting sort, so memory used by
+# build doesn't depend on number of postings.
+#
+# Postings added later (for example, for documents appended to dataset) are
+# kept as segments: lists in subfolders of folder segments/, which are read
+# after base lists. So adding postings costs time proportional to their
+# number, not to size of lists. Segment is built in new_segment_folder and
+# becomes visible when add_segment renames it into place. Rebuild of lists
+# removes all segments.
+
+import os
+import numpy as np
+from shutil import rmtree
+
+
+SEGMENTS_FOLDER = "segments"
+
+
+# Returns folders of segments of lists (or of other index using segments), in
+# order of addition.
+def list_segments(folder):
+    segments_folder = os.path.join(folder, SEGMENTS_FOLDER)
+    if not os.path.exists(segments_folder):
+        return []
+    return [os.path.join(segments_folder, name)
+            for name in sorted(os.listdir(segments_folder))
+            if name.isdigit()]
+
+
+def new_segment_folder(folder):
+    return os.path.join(folder, SEGMENTS_FOLDER, "new")
+
+
+# Removes unfinished segment and its temporary folders.
+def clear_new_segment(folder):
+    segments_folder = os.path.join(folder, SEGMENTS_FOLDER)
+    if not os.path.exists(segments_folder):
+        return
+    for name in os.listdir(segments_folder):
+        if not name.isdigit():
+            rmtree(os.path.join(segments_folder, name))
+
+
+# Publishes segment built in new_segment_folder(folder).
+def add_segment(folder):
+    segments = list_segments(folder)
+    number = 1
+    if len(segments) > 0:
+        number = int(os.path.basename(segments[-1])) + 1
+    os.rename(new_segment_folder(folder),
+              os.path.join(folder, SEGMENTS_FOLDER, "%06d" % number))
+
+
+class Postings:
+    def __init__(self, folder):
+        self.folder = folder
+        self.indptr = np.load(os.path.join(folder, "indptr.npy"),
+                              mmap_mode='r')
+        self.ids = np.load(os.path.join(folder, "ids.npy"), mmap_mode='r')
+        values_file = os.path.join(folder, "values.npy")
+        if os.path.exists(values_file):
+            self.values = np.load(values_file, mmap_mode='r')
+        else:
+            self.values = None
+        self.segments = [Postings(segment)
+                         for segment in list_segments(folder)]
+
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, "ids.npy"))
+
+    @property
+    def rows_count(self):
+        return len(self.indptr) - 1
+
+    # Returns ids of row, or pair (ids, values) if values are stored.
+    def get(self, row):
+        result = self.get_base(row)
+        if len(self.segments) == 0:
+            return result
+        parts = [result] + [segment.get(row) for segment in self.segments]
+        if self.values is None:
+            return np.concatenate(parts)
+        return (np.concatenate([ids for ids, values in parts]),
+                np.concatenate([values for ids, values in parts]))
+
+    def get_base(self, row):
+        if row < 0 or row >= self.rows_count:
+            ids = self.ids[0:0]
+            begin = end = 0
+        else:
+            begin = int(self.indptr[row])
+            end = int(self.indptr[row + 1])
+            ids = self.ids[begin: end]
+        if self.values is None:
+            return ids
+        return ids, self.values[begin: end]
+
+    def length(self, row):
+        length = sum(segment.length(row) for segment in self.segments)
+        if row < 0 or row >= self.rows_count:
+            return length
+        return length + int(self.indptr[row + 1] - self.indptr[row])
+
+    # Yields all postings as chunks (rows, ids, values) in order of rows.
+    def chunks(self, chunk_size=1000000):
+        lengths = np.diff(self.indptr)
+        row = 0
+        while row < self.rows_count:
+            end_row = int(np.searchsorted(
+                self.indptr, self.indptr[row] + chunk_size, side='right'))
+            end_row = min(max(end_row - 1, row + 1), self.rows_count)
+            begin = int(self.indptr[row])
+            end = int(self.indptr[end_row])
+            rows = np.repeat(np.arange(row, end_row), lengths[row: end_row])
+            values = None
+            if self.values is not None:
+                values = np.array(self.values[begin: end])
+            yield rows, np.array(self.ids[begin: end]), values
+            row = end_row
+        for segment in self.segments:
+            for chunk in segment.chunks(chunk_size):
+                yield chunk
+
+
+class PostingsBuilder:
+    def __init__(self, folder, ids_dtype=np.uint32, values_dtype=None):
+        self.folder = folder
+        self.ids_dtype = np.dtype(ids_dtype)
+        self.values_dtype = None
+        if values_dtype is not None:
+            self.values_dtype = np.dtype(values_dtype)
+        self.temp_folder = folder + ".tmp"
+        if os.path.exists(self.temp_folder):
+            rmtree(self.temp_folder)
+        os.makedirs(self.temp_folder)
+        self.temp_files = {
+            name: open(os.path.join(self.temp_folder, name), "wb")
+            for name in ["rows", "ids", "values"]
+        }
+        self.chunk_sizes = []
+
+    # Adds postings: ids[i] (with values[i]) to row rows[i].
+    def add(self, rows, ids, values=None):
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        self.temp_files["rows"].write(rows.tobytes())
+        self.temp_files["ids"].write(
+            np.asarray(ids, dtype=self.ids_dtype).tobytes())
+        if self.values_dtype is not None:
+            self.temp_files["values"].write(
+                np.asarray(values, dtype=self.values_dtype).tobytes())
+        self.chunk_sizes.append(len(rows))
+
+    # Adds all postings from existing lists.
+    def add_postings(self, postings):
+        for rows, ids, values in postings.chunks():
+            self.add(rows, ids, values)
+
+    def read_chunks(self):
+        files = {name: open(os.path.join(self.temp_folder, name), "rb")
+                 for name in self.temp_files}
+        try:
+            for size in self.chunk_sizes:
+                rows = np.fromfile(files["rows"], dtype=np.int64, count=size)
+                ids = np.fromfile(files["ids"], dtype=self.ids_dtype,
+                                  count=size)
+                values = None
+                if self.values_dtype is not None:
+                    values = np.fromfile(files["values"],
+                                         dtype=self.values_dtype, count=size)
+                yield rows, ids, values
+        finally:
+            for f in files.values():
+                f.close()
+
+    # Writes posting lists to folder, replacing existing ones (with their
+    # segments). Lists are written to new folder, which then replaces old one
+    # by renames, so readers never see partially written lists, and old lists
+    # are kept if build fails.
+    def finish(self, rows_count):
+        for f in self.temp_files.values():
+            f.close()
+
+        lengths = np.zeros(rows_count, dtype=np.int64)
+        for rows, ids, values in self.read_chunks():
+            lengths += np.bincount(rows, minlength=rows_count)[:rows_count]
+        indptr = np.zeros(rows_count + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        total = int(indptr[-1])
+
+        new_folder = self.folder + ".new"
+        if os.path.exists(new_folder):
+            rmtree(new_folder)
+        os.makedirs(new_folder)
+        np.save(os.path.join(new_folder, "indptr.npy"), indptr)
+        out_ids = np.lib.format.open_memmap(
+            os.path.join(new_folder, "ids.npy"), mode="w+",
+            dtype=self.ids_dtype, shape=(total, ))
+        out_values = None
+        if self.values_dtype is not None:
+            out_values = np.lib.format.open_memmap(
+                os.path.join(new_folder, "values.npy"), mode="w+",
+                dtype=self.values_dtype, shape=(total, ))
+
+        cursor = indptr[:-1].copy()
+        for rows, ids, values in self.read_chunks():
+            order = np.argsort(rows, kind="mergesort")
+            rows = rows[order]
+            # Rank of each posting among postings of the same row in chunk.
+            rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+            positions = cursor[rows] + rank
+            out_ids[positions] = ids[order]
+            if out_values is not None:
+                out_values[positions] = values[order]
+            cursor += np.bincount(rows, minlength=rows_count)[:rows_count]
+
+        out_ids.flush()
+        if out_values is not None:
+            out_values.flush()
+        del out_ids
+        del out_values
+        rmtree(self.temp_folder)
+        if os.path.exists(self.folder):
+            old_folder = self.folder + ".old"
+            if os.path.exists(old_folder):
+                rmtree(old_folder)
+            os.rename(self.folder, old_folder)
+            os.rename(new_folder, self.folder)
+            rmtree(old_folder)
+        else:
+            os.rename(new_folder, self.folder)
+        return Postings(self.folder)
@@ -0,0 +1,127 @@
+# Conjunctive search of documents by words, using inverted indexes of
+# datasets (see Dataset.get_inverted_index).
+
+import numpy as np
+
+
+# Merges posting lists of several terms (e.g. the same word in different
+# modalities) into one list, summing counts.
+def union(postings):
+    if len(postings) == 1:
+        return postings[0]
+    ids = np.concatenate([ids for ids, counts in postings])
+    counts = np.concatenate([counts for ids, counts in postings])
+    ids, inverse = np.unique(ids, return_inverse=True)
+    return ids, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+# Intersection switches to galloping when the other list is at least this
+# many times longer than current intersection.
+GALLOP_RATIO = 32
+
+
+# Returns position of the first element of sorted values, which is not less
+# than target, given that all elements before start are less than it.
+# Probes positions start, start + 1, start + 3, start + 7, ... until it passes
+# target, then bisects the last gap, so cost is O(log d), where d is distance
+# from start to the result.
+def gallop(values, target, start):
+    end = start
+    step = 1
+    while end < len(values) and values[end] < target:
+        start = end + 1
+        end += step
+        step *= 2
+    end = min(end, len(values))
+    return start + int(np.searchsorted(values[start: end], target))
+
+
+# Returns positions of sorted targets in sorted values (as searchsorted does),
+# galloping from the position of previous target.
+def gallop_positions(values, targets):
+    positions = np.zeros(len(targets), dtype=np.int64)
+    position = 0
+    for i, target in enumerate(targets.tolist()):
+        position = gallop(values, target, position)
+        positions[i] = position
+    return positions
+
+
+# Intersects posting lists, sorted by ids.
+# Starts from the rarest list and looks up postings of current intersection
+# in longer lists. In much longer lists postings are found by galloping, so
+# cost of step is O(m log(n / m)), where m is the size of current
+# intersection and n is the size of list; otherwise all postings are found
+# with one vectorized binary search.
+# Returns ids present in all lists and matrix of counts (lists x ids).
+def intersect(postings):
+    order = sorted(range(len(postings)), key=lambda i: len(postings[i][0]))
+    ids, counts = postings[order[0]]
+    ids = np.asarray(ids)
+    counts = np.zeros((len(postings), len(ids)), dtype=np.int64)
+    counts[order[0]] = postings[order[0]][1]
+
+    for i in order[1:]:
+        if len(ids) == 0:
+            break
+        other_ids, other_counts = postings[i]
+        if len(other_ids) >= GALLOP_RATIO * len(ids):
+            positions = gallop_positions(other_ids, ids)
+        else:
+            positions = np.searchsorted(other_ids, ids)
+        found = positions < len(other_ids)
+        found[found] = other_ids[positions[found]] == ids[found]
+        ids = ids[found]
+        counts = counts[:, found]
+        counts[i] = other_counts[positions[found]]
+    return ids, counts
+
+
+# Searches documents of datasets, containing all words.
+# terms is list of tuples (dataset_id, text, term.index_id) of terms, whose
+# text is one of words.
+# Returns arrays dataset_ids, document_ids (index_id's inside dataset) and
+# scores (tf-idf) of found documents, sorted by score descending, and dict
+# which maps dataset_id to list of index_id's of matched terms.
+def search(datasets, terms, words):
+    words = list(set(words))
+    terms_by_dataset = dict()
+    for dataset_id, text, index_id in terms:
+        terms_by_dataset.setdefault(dataset_id, dict()).setdefault(
+            text, []).append(index_id)
+
+    found_datasets = [np.zeros(0, dtype=np.int64)]
+    found_documents = [np.zeros(0, dtype=np.int64)]
+    found_scores = [np.zeros(0)]
+    matched_terms = dict()
+    for dataset in datasets:
+        if dataset.id not in terms_by_dataset:
+            continue
+        words_terms = terms_by_dataset[dataset.id]
+        if any(word not in words_terms for word in words):
+            continue
+        index = dataset.get_inverted_index()
+        if index is None:
+            continue
+        postings = [union([index.get(index_id)
+                           for index_id in words_terms[word]])
+                    for word in words]
+        ids, counts = intersect(postings)
+        if len(ids) == 0:
+            continue
+
+        documents_count = max(dataset.documents_count, 1)
+        idf = np.array([np.log(1 + documents_count / max(len(p[0]), 1))
+                        for p in postings])
+        found_datasets.append(np.full(len(ids), dataset.id, dtype=np.int64))
+        found_documents.append(ids.astype(np.int64))
+        found_scores.append(np.dot(idf, np.log1p(counts)))
+        matched_terms[dataset.id] = [index_id for word in words
+                                     for index_id in words_terms[word]]
+
+    dataset_ids = np.concatenate(found_datasets)
+    document_ids = np.concatenate(found_documents)
+    scores = np.concatenate(found_scores)
+    order = np.lexsort((document_ids, dataset_ids, -scores))
+    return (dataset_ids[order], document_ids[order], scores[order],
+            matched_terms)
@@ -0,0 +1,92 @@
+# Statistics of dataset shown on its page, computed once on reload.
+#
+# Snapshot is small JSON file stats.json in dataset folder:
+#     term_freq      - step histogram of terms frequencies: for each distinct
+#                      frequency (in descending order) number of terms with
+#                      greater frequency and the frequency itself;
+#     term_samples   - up to TERM_SAMPLES terms for each frequency;
+#     terms_count    - number of terms;
+#     lengths        - histogram of lengths of documents (in terms):
+#                      left edges of bins and numbers of documents;
+#     timeline       - days (YYYY-MM-DD) and numbers of documents per day,
+#                      if documents have time.
+
+import os
+import json
+import numpy as np
+from collections import Counter
+
+
+# Number of sample terms shown for each frequency.
+TERM_SAMPLES = 100
+
+# Number of bins in histogram of lengths of documents.
+LENGTH_BINS = 50
+
+
+# terms is iterable of pairs (frequency, text) in descending order of
+# frequency.
+def count_terms_stats(terms):
+    counts = []
+    freqs = []
+    samples = dict()
+    terms_count = 0
+    prev_freq = None
+    for freq, text in terms:
+        if freq != prev_freq:
+            prev_freq = freq
+            counts.append(terms_count)
+            freqs.append(freq)
+            block = []
+            samples[freq] = block
+        if len(block) < TERM_SAMPLES:
+            block.append(text)
+            if len(block) >= TERM_SAMPLES:
+                block.append("...")
+        terms_count += 1
+    return {"term_freq": [counts, freqs],
+            "term_samples": samples,
+            "terms_count": terms_count}
+
+
+# documents is iterable of pairs (time, length), where time is datetime or
+# None.
+def count_documents_stats(documents):
+    days = Counter()
+    lengths = []
+    for time, length in documents:
+        if time is not None:
+            days[time.date()] += 1
+        lengths.append(length)
+    lengths = np.array(lengths, dtype=np.int64)
+    if len(lengths) > 0:
+        edges = np.unique(np.linspace(
+            0, lengths.max() + 1, LENGTH_BINS + 1).astype(np.int64))
+        if len(edges) < 2:
+            edges = np.array([0, 1])
+        histogram = np.histogram(lengths, edges)[0]
+        edges = edges[:-1]
+    else:
+        edges = histogram = np.zeros(0, dtype=np.int64)
+    days = sorted(days.items())
+    return {"lengths": [edges.tolist(), histogram.tolist()],
+            "timeline": [[str(day) for day, count in days],
+                         [count for day, count in days]]}
+
+
+def save_stats(file_name, stats):
+    with open(file_name + ".new", "w", encoding="utf-8") as f:
+        json.dump(stats, f)
+    os.replace(file_name + ".new", file_name)
+
+
+# Returns snapshot, or None if it wasn't computed.
+def load_stats(file_name):
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, "r", encoding="utf-8") as f:
+        stats = json.load(f)
+    # JSON keys are strings.
+    stats["term_samples"] = {int(freq): terms for freq, terms
+                             in stats["term_samples"].items()}
+    return stats
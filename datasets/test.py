@@ -1,7 +1,25 @@
 from django.test import TestCase
 import unittest
+import tempfile
+import os
+import io
+import json
+import zipfile
+import numpy as np
+from datetime import datetime
 
 from .models import BagOfWords
+from . import codec
+from .search import intersect, union, gallop_positions
+from .trigrams import TrigramIndex, TrigramIndexBuilder
+from .postings import (Postings, PostingsBuilder, new_segment_folder,
+                       add_segment)
+from .hashes import StageHashes, hash_document
+from .textstore import TextStoreWriter
+from .archive import extract_archive
+from .stats import count_terms_stats, count_documents_stats
+from .meta import iter_json_object, write_meta, find_meta_file, MetaJoiner
+from algo.preprocessing.WordposPack import WordposPack, WordposPackBuilder
 
 
 class ModalityMock:
@@ -43,3 +61,294 @@ class TestBagOfWords(unittest.TestCase):
         term2_bytes = b'\x02\x00\x00\x00\x01\x01\x00'
         self.assertEqual(bow.to_bytes(self.terms_index),
                          term2_bytes + term9_bytes)
+
+
+class TestCodec(unittest.TestCase):
+    def test_bow_roundtrip(self):
+        blob = codec.encode_bow([2, 9], [257, 8], [0, 1])
+        self.assertEqual(blob, b'\x02\x00\x00\x00\x01\x01\x00' +
+                         b'\x09\x00\x00\x00\x08\x00\x01')
+        bow = codec.decode(blob, codec.BOW_DTYPE)
+        self.assertEqual(bow["term"].tolist(), [2, 9])
+        self.assertEqual(bow["count"].tolist(), [257, 8])
+        self.assertEqual(bow["modality"].tolist(), [0, 1])
+
+    def test_word_index_compatible_with_struct(self):
+        import struct
+        entries = [(0, 5, 3), (7, 255, 70000)]
+        expected = b''.join(
+            struct.pack('I', pos) + struct.pack('B', length) +
+            struct.pack('I', term) for pos, length, term in entries)
+        blob = codec.encode_word_index(*zip(*entries))
+        self.assertEqual(blob, expected)
+        wi = codec.decode(blob, codec.WORD_INDEX_DTYPE)
+        self.assertEqual(list(zip(wi["pos"].tolist(), wi["length"].tolist(),
+                                  wi["term"].tolist())), entries)
+
+    def test_decode_empty_and_incomplete(self):
+        self.assertEqual(len(codec.decode(None, codec.BOW_DTYPE)), 0)
+        self.assertEqual(len(codec.decode(b'', codec.BOW_DTYPE)), 0)
+        blob = codec.encode_topic_documents([1, 2], [0.5, 0.5]) + b'\x00'
+        docs = codec.decode(blob, codec.TOPIC_DOCUMENTS_DTYPE)
+        self.assertEqual(docs["document"].tolist(), [1, 2])
+
+    def test_saturation(self):
+        blob = codec.encode_bow([1], [70000], [0])
+        self.assertEqual(codec.decode(blob, codec.BOW_DTYPE)["count"][0],
+                         65535)
+
+
+class TestSearch(unittest.TestCase):
+    def test_union(self):
+        ids, counts = union([
+            (np.array([1, 3, 5]), np.array([1, 1, 2])),
+            (np.array([3, 4]), np.array([2, 7]))])
+        self.assertEqual(ids.tolist(), [1, 3, 4, 5])
+        self.assertEqual(counts.tolist(), [1, 3, 7, 2])
+
+    def test_intersect(self):
+        ids, counts = intersect([
+            (np.array([1, 2, 3, 5, 8, 13]), np.array([1, 1, 1, 1, 1, 1])),
+            (np.array([2, 3, 13]), np.array([4, 5, 6])),
+            (np.array([0, 2, 13, 20]), np.array([7, 8, 9, 10]))])
+        self.assertEqual(ids.tolist(), [2, 13])
+        self.assertEqual(counts.tolist(), [[1, 1], [4, 6], [8, 9]])
+
+    def test_gallop(self):
+        values = np.array([2, 3, 3, 7, 10, 11, 40, 41, 42, 100])
+        targets = np.array([0, 3, 4, 11, 12, 42, 100, 101])
+        self.assertEqual(gallop_positions(values, targets).tolist(),
+                         np.searchsorted(values, targets).tolist())
+
+        long_ids = np.arange(0, 10000, 3)
+        ids, counts = intersect([
+            (long_ids, np.ones(len(long_ids), dtype=np.int64)),
+            (np.array([5, 9, 300, 9999]), np.array([1, 2, 3, 4]))])
+        self.assertEqual(ids.tolist(), [9, 300, 9999])
+        self.assertEqual(counts.tolist(), [[1, 1, 1], [2, 3, 4]])
+
+    def test_intersect_empty(self):
+        ids, counts = intersect([
+            (np.array([1, 2]), np.array([1, 1])),
+            (np.array([], dtype=np.int64), np.array([], dtype=np.int64))])
+        self.assertEqual(len(ids), 0)
+
+
+class TestPostings(unittest.TestCase):
+    def test_segments(self):
+        folder = os.path.join(tempfile.mkdtemp(), "postings")
+        builder = PostingsBuilder(folder, values_dtype=np.uint16)
+        builder.add([1, 0, 1], [0, 1, 2], [5, 6, 7])
+        builder.finish(2)
+        builder = PostingsBuilder(new_segment_folder(folder),
+                                  values_dtype=np.uint16)
+        builder.add([2, 1], [3, 4], [8, 9])
+        builder.finish(3)
+        add_segment(folder)
+
+        postings = Postings(folder)
+        ids, values = postings.get(1)
+        self.assertEqual(ids.tolist(), [0, 2, 4])
+        self.assertEqual(values.tolist(), [5, 7, 9])
+        self.assertEqual(postings.get(2)[0].tolist(), [3])
+        self.assertEqual(postings.length(1), 3)
+
+        # Rebuild removes segments and replaces lists as a whole.
+        builder = PostingsBuilder(folder)
+        builder.add([0], [1])
+        self.assertEqual(builder.finish(1).get(1).tolist(), [])
+        self.assertEqual(sorted(os.listdir(os.path.dirname(folder))),
+                         ["postings"])
+
+
+class TestTrigramIndex(unittest.TestCase):
+    strings = ["Apple", "pineapple", "APPLET", "pear", "ябЛоко", "a"]
+
+    def setUp(self):
+        self.folder = os.path.join(tempfile.mkdtemp(), "index")
+        builder = TrigramIndexBuilder(self.folder)
+        builder.add(range(4), self.strings[:4])
+        builder.finish()
+        builder = TrigramIndexBuilder(new_segment_folder(self.folder))
+        builder.add(range(4, 6), self.strings[4:])
+        builder.finish()
+        add_segment(self.folder)
+        self.index = TrigramIndex(self.folder)
+
+    def test_search(self):
+        for query in ["apple", "pPl", "ЯБЛ", "ea", "a", "", "plum"]:
+            expected = [i for i, string in enumerate(self.strings)
+                        if query.lower() in string.lower()]
+            self.assertEqual(self.index.search(query).tolist(), expected)
+
+
+class TestHashes(unittest.TestCase):
+    def test_stage_hashes(self):
+        folder = tempfile.mkdtemp()
+        hashes = StageHashes(folder)
+        self.assertTrue(hashes.changed("batches", "a"))
+        hashes.set("batches", "a")
+        self.assertFalse(StageHashes(folder).changed("batches", "a"))
+        hashes.reset("batches")
+        self.assertTrue(StageHashes(folder).changed("batches", "a"))
+
+    def test_document_hash(self):
+        folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(folder, "documents"))
+        file_name = os.path.join(folder, "documents", "doc")
+        with open(file_name, "w") as f:
+            f.write("text")
+        line = "doc |word text"
+        first = hash_document(folder, "doc", line, {"title": "Doc"})
+        self.assertEqual(first,
+                         hash_document(folder, "doc", line, {"title": "Doc"}))
+        self.assertNotEqual(first,
+                            hash_document(folder, "doc", line, None))
+        with open(file_name, "w") as f:
+            f.write("new text")
+        self.assertNotEqual(first,
+                            hash_document(folder, "doc", line,
+                                          {"title": "Doc"}))
+
+
+class TestWordposPack(unittest.TestCase):
+    def test_pack(self):
+        folder = tempfile.mkdtemp()
+        builder = WordposPackBuilder(os.path.join(folder, "shard"))
+        builder.add("b", [5], [3], ["two$#word"])
+        shard = builder.finish()
+
+        builder = WordposPackBuilder(os.path.join(folder, "part"))
+        builder.add("a", [0, 4], [3, 7], ["one$#word", "two$#word"])
+        builder.add_from(shard, "b")
+        part = builder.finish()
+        builder = WordposPackBuilder(os.path.join(folder, "pack"))
+        builder.add("c", [1], [2], ["three$#word"])
+        builder.add_pack(part)
+        pack = builder.finish()
+
+        self.assertEqual(len(pack), 3)
+        self.assertIsNone(pack.get("d"))
+        records = pack.get("b")
+        self.assertEqual(records["pos"].tolist(), [5])
+        self.assertEqual([pack.keys[key] for key in records["key"]],
+                         ["two$#word"])
+        terms = pack.map_keys({"two$#word": 7})
+        self.assertEqual(terms[pack.get("a")["key"]].tolist(), [-1, 7])
+
+
+class TestTextStore(unittest.TestCase):
+    def test_store(self):
+        folder = os.path.join(tempfile.mkdtemp(), "texts")
+        writer = TextStoreWriter(folder)
+        texts = ["text %d " % i * (i * 100) for i in range(50)]
+        for i, text in enumerate(texts):
+            writer.put(i, text)
+        store = writer.close()
+        self.assertEqual([store.get(i) for i in range(50)], texts)
+        self.assertIsNone(store.get(50))
+
+        writer = TextStoreWriter(folder)
+        writer.put(3, "новый")
+        writer.put(51, "appended")
+        store = writer.close()
+        self.assertEqual(store.get(3), "новый")
+        self.assertEqual(store.get(4), texts[4])
+        self.assertIsNone(store.get(50))
+        self.assertEqual(store.get(51), "appended")
+
+        writer = TextStoreWriter(folder)
+        writer.truncate(10)
+        self.assertEqual(len(writer.close()), 10)
+
+
+class TestArchive(unittest.TestCase):
+    def test_extract(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("vw.txt", "doc |word text\n" * 1000)
+            for i in range(10):
+                zf.writestr("documents/doc%d" % i, "text %d" % i)
+        data = buffer.getvalue()
+        folder = tempfile.mkdtemp()
+        chunks = [data[i: i + 100] for i in range(0, len(data), 100)]
+        self.assertEqual(extract_archive(chunks, folder, workers=4), 11)
+        with open(os.path.join(folder, "documents", "doc7")) as f:
+            self.assertEqual(f.read(), "text 7")
+
+        with self.assertRaises(ValueError):
+            extract_archive([data], folder, max_size=1000)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zf:
+            zf.writestr("../outside", "text")
+        with self.assertRaises(ValueError):
+            extract_archive([buffer.getvalue()], folder)
+
+    def test_stored_with_descriptor(self):
+        # ZipFile writes data descriptors to stream which can't seek.
+        class Stream(io.RawIOBase):
+            def __init__(self):
+                self.data = io.BytesIO()
+
+            def writable(self):
+                return True
+
+            def write(self, data):
+                return self.data.write(data)
+
+        stream = Stream()
+        texts = [b"PK\x07\x08" + bytes(range(256)) * i for i in range(5)]
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED) as zf:
+            for i, text in enumerate(texts):
+                zf.writestr("documents/doc%d" % i, text)
+        data = stream.data.getvalue()
+        folder = tempfile.mkdtemp()
+        chunks = [data[i: i + 7] for i in range(0, len(data), 7)]
+        self.assertEqual(extract_archive(chunks, folder), 5)
+        for i, text in enumerate(texts):
+            with open(os.path.join(folder, "documents", "doc%d" % i),
+                      "rb") as f:
+                self.assertEqual(f.read(), text)
+
+
+class TestMeta(unittest.TestCase):
+    def test_json_object(self):
+        file_name = os.path.join(tempfile.mkdtemp(), "meta.json")
+        meta = {"doc%d" % i: {"title": "title %d" % i, "time": 1000 + i}
+                for i in range(100)}
+        with open(file_name, "w") as f:
+            json.dump(meta, f)
+        self.assertEqual(dict(iter_json_object(file_name, block_size=7)),
+                         meta)
+
+    def test_joiner(self):
+        folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(folder, "meta"))
+        file_name = os.path.join(folder, "meta", "meta.jsonl")
+        write_meta(file_name, [("doc%d" % i, {"title": "title %d" % i})
+                               for i in range(10)])
+        self.assertEqual(find_meta_file(folder), file_name)
+        joiner = MetaJoiner(file_name)
+        self.assertEqual(joiner.get(["doc0", "doc1"]),
+                         [{"title": "title 0"}, {"title": "title 1"}])
+        self.assertIsNone(joiner.index)
+        # Out of order and missing documents are looked up in index.
+        self.assertEqual(joiner.get(["doc2", "doc5", "doc3", "doc10"]),
+                         [{"title": "title 2"}, {"title": "title 5"},
+                          {"title": "title 3"}, None])
+        joiner.close()
+        self.assertFalse(os.path.exists(file_name + ".index"))
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        stats = count_terms_stats([(5, "a"), (5, "b"), (3, "c"), (1, "d")])
+        self.assertEqual(stats["term_freq"], [[0, 2, 3], [5, 3, 1]])
+        self.assertEqual(stats["term_samples"][5], ["a", "b"])
+
+        stats = count_documents_stats([(datetime(2017, 1, 2, 3), 10),
+                                       (datetime(2017, 1, 2, 5), 3),
+                                       (datetime(2016, 5, 1), 100)])
+        self.assertEqual(stats["timeline"],
+                         [["2016-05-01", "2017-01-02"], [1, 2]])
+        self.assertEqual(sum(stats["lengths"][1]), 3)
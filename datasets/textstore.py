@@ -0,0 +1,158 @@
+# Compressed store of full texts of documents, addressed by index_id.
+#
+# Texts are kept out of database, so querysets of documents don't carry them.
+# Store is a folder with append-only files:
+#     blocks.bin    - blocks of texts in UTF-8, each compressed with zlib;
+#     blocks.idx    - int64, offset of each block in blocks.bin;
+#     documents.idx - record (block, offset, length) for each index_id, where
+#                     offset and length are in bytes of uncompressed block;
+#                     block is -1 if there is no text for index_id.
+# Changed document gets new text appended and its record overwritten, so old
+# text stays in blocks.bin until store is rebuilt on full reload.
+
+import os
+import zlib
+import numpy as np
+from collections import OrderedDict
+from shutil import rmtree
+
+
+DOCUMENT_DTYPE = np.dtype([("block", "<i8"), ("offset", "<u4"),
+                           ("length", "<u4")])
+
+# Size of uncompressed block, in bytes. Texts aren't split between blocks.
+BLOCK_SIZE = 1 << 16
+
+# Number of decompressed blocks kept in memory by reader.
+CACHED_BLOCKS = 16
+
+
+class TextStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self.documents = TextStore.load_array(
+            os.path.join(folder, "documents.idx"), DOCUMENT_DTYPE)
+        self.blocks = TextStore.load_array(
+            os.path.join(folder, "blocks.idx"), np.dtype("<i8"))
+        self.blocks_file_name = os.path.join(folder, "blocks.bin")
+        self.blocks_size = os.path.getsize(self.blocks_file_name)
+        self.cache = OrderedDict()
+
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, "documents.idx"))
+
+    def load_array(file_name, dtype):
+        if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_name, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return len(self.documents)
+
+    # Returns text of document, or None if it isn't stored.
+    def get(self, index_id):
+        if index_id < 0 or index_id >= len(self.documents):
+            return None
+        block, offset, length = self.documents[index_id].tolist()
+        if block < 0:
+            return None
+        data = self.get_block(block)
+        return data[offset: offset + length].decode("utf-8")
+
+    def get_block(self, block):
+        try:
+            data = self.cache[block]
+            self.cache.move_to_end(block)
+            return data
+        except KeyError:
+            pass
+        begin = int(self.blocks[block])
+        if block + 1 < len(self.blocks):
+            end = int(self.blocks[block + 1])
+        else:
+            end = self.blocks_size
+        with open(self.blocks_file_name, "rb") as f:
+            f.seek(begin)
+            data = zlib.decompress(f.read(end - begin))
+        self.cache[block] = data
+        if len(self.cache) > CACHED_BLOCKS:
+            self.cache.popitem(last=False)
+        return data
+
+
+class TextStoreWriter:
+    # If reset is True, existing store is deleted.
+    def __init__(self, folder, reset=False):
+        self.folder = folder
+        if reset and os.path.exists(folder):
+            rmtree(folder)
+        os.makedirs(folder, exist_ok=True)
+        self.blocks_file = open(os.path.join(folder, "blocks.bin"), "ab")
+        self.blocks_index_file = open(os.path.join(folder, "blocks.idx"),
+                                      "ab")
+        self.blocks_count = self.blocks_index_file.tell() // 8
+        self.documents_file_name = os.path.join(folder, "documents.idx")
+        self.buffer = []
+        self.buffer_size = 0
+        # Records of documents, which will be written on close.
+        self.index_ids = []
+        self.records = []
+        self.documents_count = None
+
+    def put(self, index_id, text):
+        data = text.encode("utf-8")
+        if self.buffer_size > 0 and self.buffer_size + len(data) > BLOCK_SIZE:
+            self.flush_block()
+        self.index_ids.append(index_id)
+        self.records.append((self.blocks_count, self.buffer_size, len(data)))
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+
+    def flush_block(self):
+        if self.buffer_size == 0:
+            return
+        self.blocks_index_file.write(
+            np.array([self.blocks_file.tell()], dtype="<i8").tobytes())
+        self.blocks_file.write(zlib.compress(b"".join(self.buffer)))
+        self.blocks_count += 1
+        self.buffer = []
+        self.buffer_size = 0
+
+    # Forgets texts of documents with index_id >= documents_count on close.
+    def truncate(self, documents_count):
+        self.documents_count = documents_count
+
+    def close(self):
+        self.flush_block()
+        self.blocks_file.close()
+        self.blocks_index_file.close()
+
+        # Records are written after blocks, so interrupted write doesn't
+        # leave records pointing to missing blocks.
+        index_ids = np.array(self.index_ids, dtype=np.int64)
+        count = 0
+        if os.path.exists(self.documents_file_name):
+            count = (os.path.getsize(self.documents_file_name) //
+                     DOCUMENT_DTYPE.itemsize)
+        new_count = max(count, int(index_ids.max()) + 1
+                        if len(index_ids) > 0 else 0)
+        if self.documents_count is not None:
+            new_count = self.documents_count
+        with open(self.documents_file_name, "ab") as f:
+            if new_count > count:
+                empty = np.zeros(new_count - count, dtype=DOCUMENT_DTYPE)
+                empty["block"] = -1
+                f.write(empty.tobytes())
+            elif new_count < count:
+                f.truncate(new_count * DOCUMENT_DTYPE.itemsize)
+        keep = index_ids < new_count
+        if np.any(keep):
+            documents = np.memmap(self.documents_file_name,
+                                  dtype=DOCUMENT_DTYPE, mode='r+')
+            records = np.array(self.records, dtype=np.int64)[keep]
+            documents["block"][index_ids[keep]] = records[:, 0]
+            documents["offset"][index_ids[keep]] = records[:, 1]
+            documents["length"][index_ids[keep]] = records[:, 2]
+            documents.flush()
+            del documents
+        return TextStore(self.folder)
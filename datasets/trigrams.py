@@ -0,0 +1,150 @@
+# Trigram index for case-insensitive substring search in short strings
+# (texts of terms, titles and names of documents).
+#
+# Index is stored in folder:
+#     ids.npy      - ids of indexed strings (index_id's of objects);
+#     offsets.npy  - int64, offsets of strings in strings.bin;
+#     strings.bin  - lowercased strings in UTF-8, each followed by "\n";
+#     trigrams/    - posting lists (see datasets.postings), which map hash of
+#                    trigram to positions of strings containing this trigram;
+#     segments/    - indexes of strings added later, in the same format (see
+#                    segments in datasets.postings).
+# Query is answered by intersection of posting lists of its trigrams, then
+# candidates are checked against stored strings, so collisions of hashes
+# don't lead to false matches. Queries shorter than trigram are answered by
+# scan of strings.bin, which is still much faster than scan of table.
+
+import os
+import re
+import zlib
+import numpy as np
+from shutil import rmtree
+
+from datasets.postings import Postings, PostingsBuilder, list_segments
+
+
+# Number of posting lists. Trigrams are hashed into them.
+TRIGRAM_BUCKETS = 1 << 20
+
+
+def normalize(string):
+    return string.lower().replace("\n", " ")
+
+
+# Returns sorted array of hashes of all trigrams of normalized string.
+def trigram_hashes(string):
+    hashes = set()
+    for i in range(len(string) - 2):
+        hashes.add(zlib.crc32(string[i: i + 3].encode("utf-8")) &
+                   (TRIGRAM_BUCKETS - 1))
+    return np.array(sorted(hashes), dtype=np.int64)
+
+
+class TrigramIndex:
+    def __init__(self, folder):
+        self.folder = folder
+        self.ids = np.load(os.path.join(folder, "ids.npy"), mmap_mode='r')
+        self.offsets = np.load(os.path.join(folder, "offsets.npy"),
+                               mmap_mode='r')
+        self.trigrams = Postings(os.path.join(folder, "trigrams"))
+        strings_file = os.path.join(folder, "strings.bin")
+        if os.path.getsize(strings_file) > 0:
+            self.strings = np.memmap(strings_file, dtype=np.uint8, mode='r')
+        else:
+            self.strings = np.zeros(0, dtype=np.uint8)
+        self.segments = [TrigramIndex(segment)
+                         for segment in list_segments(folder)]
+
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, "ids.npy"))
+
+    def __len__(self):
+        return len(self.ids) + sum(len(segment) for segment in self.segments)
+
+    # Returns ids of strings, which contain query, in order of addition.
+    def search(self, query):
+        found = self.search_base(query)
+        if len(self.segments) == 0:
+            return found
+        return np.concatenate(
+            [found] + [segment.search(query) for segment in self.segments])
+
+    def search_base(self, query):
+        query = normalize(query)
+        if len(query) < 3:
+            return self.ids[self.scan(query)]
+
+        postings = [self.trigrams.get(h) for h in trigram_hashes(query)]
+        postings.sort(key=len)
+        candidates = np.asarray(postings[0])
+        for other in postings[1:]:
+            if len(candidates) == 0:
+                break
+            positions = np.searchsorted(other, candidates)
+            found = positions < len(other)
+            found[found] = other[positions[found]] == candidates[found]
+            candidates = candidates[found]
+
+        pattern = query.encode("utf-8")
+        matched = [
+            position for position in candidates.tolist()
+            if pattern in self.strings[
+                self.offsets[position]: self.offsets[position + 1]].tobytes()
+        ]
+        return self.ids[np.array(matched, dtype=np.int64)]
+
+    # Returns positions of all strings which contain query.
+    def scan(self, query):
+        if len(query) == 0:
+            return np.arange(len(self.ids))
+        pattern = re.compile(re.escape(query.encode("utf-8")))
+        starts = np.array(
+            [match.start() for match in pattern.finditer(self.strings)],
+            dtype=np.int64)
+        return np.unique(np.searchsorted(self.offsets, starts,
+                                         side='right') - 1)
+
+
+class TrigramIndexBuilder:
+    def __init__(self, folder):
+        self.folder = folder
+        self.temp_folder = folder + ".new"
+        if os.path.exists(self.temp_folder):
+            rmtree(self.temp_folder)
+        os.makedirs(self.temp_folder)
+        self.trigrams = PostingsBuilder(
+            os.path.join(self.temp_folder, "trigrams"))
+        self.strings_file = open(
+            os.path.join(self.temp_folder, "strings.bin"), "wb")
+        self.ids = []
+        self.offsets = [0]
+        self.size = 0
+
+    def add(self, ids, strings):
+        rows = []
+        positions = []
+        for id, string in zip(ids, strings):
+            string = normalize(string)
+            data = string.encode("utf-8") + b"\n"
+            hashes = trigram_hashes(string)
+            rows.append(hashes)
+            positions.append(np.full(len(hashes), len(self.ids),
+                                     dtype=np.int64))
+            self.strings_file.write(data)
+            self.size += len(data)
+            self.offsets.append(self.size)
+            self.ids.append(id)
+        if len(rows) > 0:
+            self.trigrams.add(np.concatenate(rows), np.concatenate(positions))
+
+    def finish(self):
+        self.strings_file.close()
+        np.save(os.path.join(self.temp_folder, "ids.npy"),
+                np.array(self.ids, dtype=np.int64))
+        np.save(os.path.join(self.temp_folder, "offsets.npy"),
+                np.array(self.offsets, dtype=np.int64))
+        self.trigrams.finish(TRIGRAM_BUCKETS)
+        if os.path.exists(self.folder):
+            rmtree(self.folder)
+        os.rename(self.temp_folder, self.folder)
+        return TrigramIndex(self.folder)
@@ -0,0 +1,152 @@
+# Upload handler, which extracts uploaded zip archive while it is being
+# received (see datasets.archive), so Django neither keeps archive in memory
+# nor saves it to temporary file.
+#
+# Chunks of upload are passed through bounded queue to extraction, which runs
+# in separate thread. Handler must be installed before request.POST or
+# request.FILES is read, so views which use it are exempt from CSRF
+# middleware (which reads request.POST) and check CSRF token themselves, after
+# handler is installed (see handle_archive_upload and
+# datasets.views.dataset_create).
+
+import os
+import queue
+from shutil import rmtree
+from threading import Thread
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (FileUploadHandler,
+                                             StopFutureHandlers)
+from datasets.archive import extract_archive
+
+
+# Number of received chunks, which wait for extraction.
+QUEUE_SIZE = 16
+
+# Seconds to wait for next chunk. If upload is interrupted, extraction stops
+# after this time.
+CHUNK_TIMEOUT = 600
+
+
+# Uploaded archive, already extracted to folder. If extraction failed, error
+# is its exception, and folder is removed if it was created by extraction.
+class ExtractedArchive(UploadedFile):
+    def __init__(self, name, size, folder, error):
+        super().__init__(name=name, size=size)
+        self.folder = folder
+        self.error = error
+        self.taken = False
+
+    # Raises exception of extraction, if it failed. Otherwise marks archive
+    # as taken by view, so its folder is kept (see handle_archive_upload).
+    def check(self):
+        if self.error is not None:
+            raise self.error
+        self.taken = True
+
+
+class ArchiveUploadHandler(FileUploadHandler):
+    # get_folder is called with name of uploaded file and returns folder, to
+    # which archive is extracted. It may raise ValueError to reject archive,
+    # then the rest of upload is dropped.
+    def __init__(self, get_folder, field_name="archive", request=None):
+        super().__init__(request)
+        self.get_folder = get_folder
+        self.archive_field_name = field_name
+        self.active = False
+        self.archive = None
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        if field_name != self.archive_field_name:
+            return
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.active = True
+        self.folder = None
+        self.error = None
+        self.thread = None
+        self.created = False
+        try:
+            self.folder = self.get_folder(os.path.basename(file_name))
+        except ValueError as e:
+            self.error = e
+        else:
+            self.chunks = queue.Queue(QUEUE_SIZE)
+            self.finished = False
+            self.thread = Thread(target=self.extract, daemon=True)
+            self.thread.start()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        if self.thread is not None:
+            self.put(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        if self.thread is not None:
+            self.put(None)
+            self.thread.join()
+        self.archive = ExtractedArchive(self.file_name, file_size,
+                                        self.folder, self.error)
+        return self.archive
+
+    # Passes chunk (or None at the end of file) to extraction. If extraction
+    # stopped waiting for it, chunk is dropped.
+    def put(self, chunk):
+        try:
+            self.chunks.put(chunk, timeout=CHUNK_TIMEOUT)
+        except queue.Full:
+            pass
+
+    # Yields received chunks until the end of file.
+    def read_chunks(self):
+        while not self.finished:
+            try:
+                chunk = self.chunks.get(timeout=CHUNK_TIMEOUT)
+            except queue.Empty:
+                raise ValueError("Upload was interrupted.")
+            if chunk is None:
+                self.finished = True
+            else:
+                yield chunk
+
+    def extract(self):
+        self.created = not os.path.exists(self.folder)
+        try:
+            extract_archive(
+                self.read_chunks(), self.folder,
+                workers=getattr(settings, "DATASET_UPLOAD_WORKERS", 1),
+                max_size=getattr(settings, "DATASET_UPLOAD_MAX_SIZE", None))
+        except BaseException as e:
+            self.error = e
+            self.discard()
+        # Chunks after the end of archive (or after error) are dropped, so
+        # receiving doesn't block.
+        try:
+            for chunk in self.read_chunks():
+                pass
+        except ValueError:
+            pass
+
+    # Removes extracted folder, if it was created by extraction.
+    def discard(self):
+        if self.created:
+            rmtree(self.folder, ignore_errors=True)
+            self.created = False
+
+
+# Calls view with handler of archive installed. get_folder is passed to
+# ArchiveUploadHandler. If view doesn't take extracted archive (for example,
+# CSRF check fails, or view rejects request), its folder is removed.
+def handle_archive_upload(request, get_folder, view, *args):
+    handler = ArchiveUploadHandler(get_folder, request=request)
+    request.upload_handlers.insert(0, handler)
+    try:
+        return view(request, *args)
+    finally:
+        if handler.archive is not None and not handler.archive.taken:
+            handler.discard()
@@ -5,18 +5,25 @@ from django.http import (
     HttpResponseNotFound,
     HttpResponseForbidden)
 from datasets.models import Dataset, Document, Term, Modality
+from datasets.upload import handle_archive_upload
 from models.models import ArtmModel, Topic
 from django.conf import settings
 import visartm.views as general_views
 from threading import Thread
 from datetime import datetime
 from django.contrib.auth.decorators import login_required, permission_required
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 import os
+from shutil import rmtree
 from django.contrib.auth.models import User
 import numpy as np
 from django.conf import settings
 
 
+# Number of documents on one page of global search results.
+SEARCH_PAGE_SIZE = 20
+
+
 def datasets_list(request):
     datasets = Dataset.objects.filter(is_public=True)
     if request.user.is_authenticated:
@@ -46,6 +53,57 @@ def dataset_reload(request):
     return redirect("/dataset?dataset=" + dataset.text_id)
 
 
+# See dataset_create.
+@csrf_exempt
+@login_required
+def dataset_append(request):
+    dataset = Dataset.get_dataset(request, modify=True)
+    if not dataset:
+        return HttpResponseForbidden()
+    if request.method == 'GET':
+        context = Context({'dataset': dataset})
+        return render(request, "datasets/append_dataset.html", context)
+
+    append_folder = os.path.join(dataset.get_folder(), "append")
+
+    def get_append_folder(archive_name):
+        if os.path.exists(append_folder):
+            raise ValueError("Documents are already being appended.")
+        return append_folder
+
+    return handle_archive_upload(request, get_append_folder,
+                                 dataset_append_protected, dataset,
+                                 append_folder)
+
+
+@csrf_protect
+def dataset_append_protected(request, dataset, append_folder):
+    try:
+        request.FILES['archive'].check()
+    except ValueError as e:
+        return HttpResponseForbidden(str(e))
+    from datasets.meta import find_meta_file
+    if dataset.time_provided and find_meta_file(append_folder) is None:
+        rmtree(append_folder)
+        return HttpResponseForbidden(
+            "Documents of dataset have time, so archive must contain "
+            "meta file with time of new documents.")
+
+    dataset.status = 1
+    dataset.creation_time = datetime.now()
+    dataset.save()
+
+    if settings.THREADING:
+        t = Thread(
+            target=Dataset.append_untrusted, args=(
+                dataset, append_folder), daemon=True)
+        t.start()
+    else:
+        dataset.append_untrusted(append_folder)
+
+    return redirect("/dataset?dataset=" + dataset.text_id)
+
+
 @login_required
 def dataset_delete(request):
     dataset = Dataset.get_dataset(request, modify=True)
@@ -68,9 +126,21 @@ def dataset_delete(request):
              dataset.id))
 
 
+# Uploaded archive is extracted while it is received, by handler which must
+# be installed before request.POST is read, so CSRF token is checked after
+# that (see datasets.upload).
+@csrf_exempt
 @login_required
 @permission_required('datasets.add_dataset')
 def dataset_create(request):
+    if request.method == 'POST':
+        return handle_archive_upload(request, Dataset.get_upload_folder,
+                                     dataset_create_protected)
+    return dataset_create_protected(request)
+
+
+@csrf_protect
+def dataset_create_protected(request):
     if request.method == 'GET':
         existing_datasets = [
             dataset.text_id for dataset in Dataset.objects.all()]
@@ -95,7 +165,10 @@ def dataset_create(request):
             return HttpResponseForbidden(
                 "Dataset %s already exists. Try another name." %
                 name)
-        dataset.upload_from_archive(request.FILES['archive'])
+        try:
+            dataset.upload_from_archive(request.FILES['archive'])
+        except ValueError as e:
+            return HttpResponseForbidden(str(e))
     else:
         dataset.text_id = request.POST['unreg_name']
 
@@ -208,59 +281,36 @@ def visual_dataset(request):
     if mode == 'terms':
         terms = Term.objects.filter(dataset=dataset)
         if "search" in request.GET and len(search_query) >= 2:
-            terms = terms.filter(text__icontains=search_query).order_by("text")
+            terms = sorted(dataset.search_substring("terms", search_query),
+                           key=lambda term: term.text)
             context['search'] = True
         else:
             terms = terms.order_by("-token_tf")[:250]
         context['terms'] = terms
     elif mode == 'stats':
-        terms = Term.objects.filter(dataset=dataset).order_by("-token_tf")
-        count_values = []
-        freq_values = []
-        term_freq_dict = {}
-
-        # Amount of terms in dataset can be very big, so the plot cannot be
-        # drawn without aggregation to blocks
-        prev_freq = None
-        for count, term in enumerate(terms):
-            freq = term.token_tf
-
-            if freq != prev_freq:
-                prev_freq = freq
-                prev_count = count
-                count_values.append(count)
-                freq_values.append(freq)
-                freq_block = []
-                term_freq_dict[freq] = freq_block
-
-            # TODO transfer magic to constants/configuration
-            if len(freq_block) < 100:
-                freq_block.append(term.text)
-                if len(freq_block) >= 100:
-                    freq_block.append('...')
+        stats = dataset.get_stats()
+        count_values, freq_values = stats["term_freq"]
 
+        # Amount of terms in dataset can be very big, so the plot is drawn
+        # from blocks of terms with equal frequency.
         # Workaround: use area-step mode as bar mode with
         # configurable bar widths.
         context['stats'] = {
             'term_freq': [
                 ['count', 0] +
-                [x for x in count_values[1:] for _ in (0, 1)] + [count],
+                [x for x in count_values[1:] for _ in (0, 1)] +
+                [max(stats["terms_count"] - 1, 0)],
                 ['freq'] + [x for x in freq_values for _ in (0, 1)]
             ],
-            'term_freq_dict': term_freq_dict
+            'term_freq_dict': stats["term_samples"],
+            'lengths': [['length'] + stats["lengths"][0],
+                        ['count'] + stats["lengths"][1]]
         }
 
         if dataset.time_provided:
-            import itertools
-            date_list = ['date']
-            count_list = ['count']
-            documents = Document.objects.filter(
-                dataset=dataset).order_by("time")
-            for dt, grp in itertools.groupby(
-                    documents, key=lambda x: x.time.date()):
-                date_list.append(str(dt))
-                count_list.append(len(list(grp)))
-            context['stats']['timeline'] = [date_list, count_list]
+            context['stats']['timeline'] = [
+                ['date'] + stats["timeline"][0],
+                ['count'] + stats["timeline"][1]]
 
     elif mode == 'modalities':
         context['modalities'] = Modality.objects.filter(
@@ -288,9 +338,9 @@ def visual_dataset(request):
             context['assessment']['problems_to_assess'] = []
 
     elif mode == 'docs':
-        docs = Document.objects.filter(dataset=dataset)
         if "search" in request.GET and len(search_query) >= 2:
-            context['documents'] = docs.filter(title__icontains=search_query)
+            context['documents'] = dataset.search_substring(
+                "titles", search_query)
             context['search'] = True
         else:
             context['documents'] = True
@@ -312,16 +362,12 @@ def document_all_topics(request):
 
     topics_count = [int(x) for x in model.topics_count.split()]
     target_layer = model.layers_count
-    theta = model.get_theta()
+    theta_layer = model.get_document_theta(document.index_id, target_layer)
     topics_index = Topic.objects.filter(
         model=model, layer=target_layer).order_by("index_id")
-    shift = 0
-    for i in range(1, target_layer):
-        shift += topics_count[i]
     topics_list = []
     for topic_index_id in range(0, topics_count[target_layer]):
-        topics_list.append(
-            (theta[shift + topic_index_id, document.index_id], topic_index_id))
+        topics_list.append((theta_layer[topic_index_id], topic_index_id))
     topics_list.sort(reverse=True)
     context['topics'] = [{"weight": 100 * i[0],
                           "topic": topics_index[i[1]]} for i in topics_list]
@@ -331,6 +377,17 @@ def document_all_topics(request):
         Context(context))
 
 
+# Returns dict term.index_id -> row of phi for topics of layer, for terms
+# from word index of document. Only these rows are read from phi (which may
+# be sparse, see models.matrices).
+def get_phi_layer(phi, word_index, shift, topics_count):
+    from models.matrices import get_rows
+    term_ids = sorted(set(term_index_id for start_pos, length, term_index_id
+                          in word_index))
+    rows = get_rows(phi, term_ids, slice(shift, shift + topics_count))
+    return dict(zip(term_ids, rows))
+
+
 def visual_document(request):
     if 'id' in request.GET:
         document = Document.objects.get(id=request.GET['id'])
@@ -375,8 +432,9 @@ def visual_document(request):
         topics_count = [int(x) for x in model.topics_count.split()]
         target_layer = model.layers_count
         phi = model.get_phi()
-        theta = model.get_theta()
-        theta_t = theta.transpose()
+        # Only row of document is read from theta.
+        theta_t_layer = model.get_document_theta(
+            document.index_id, target_layer)
 
         topics_index = Topic.objects.filter(
             model=model, layer=target_layer).order_by("index_id")
@@ -390,8 +448,7 @@ def visual_document(request):
 
         for topic_index_id in range(0, topics_count[target_layer]):
             topics_list.append(
-                (theta[shift + topic_index_id, document.index_id],
-                 topic_index_id))
+                (theta_t_layer[topic_index_id], topic_index_id))
         topics_list.sort(reverse=True)
 
         topics = []
@@ -459,11 +516,8 @@ def visual_document(request):
 
         elif hl_mode == "words":
             if model is not None:
-                phi_layer = phi[:, shift: shift + topics_count[target_layer]]
-                theta_t_layer = theta_t[
-                    document.index_id,
-                    shift: shift + topics_count[target_layer]
-                ]
+                phi_layer = get_phi_layer(
+                    phi, wi, shift, topics_count[target_layer])
 
                 entries = []
 
@@ -501,11 +555,8 @@ def visual_document(request):
             text = new_text
         elif hl_mode == "paragraphs":
             if model is not None:
-                phi_layer = phi[:, shift: shift + topics_count[target_layer]]
-                theta_t_layer = theta_t[
-                    document.index_id,
-                    shift: shift + topics_count[target_layer]
-                ]
+                phi_layer = get_phi_layer(
+                    phi, wi, shift, topics_count[target_layer])
                 lines = text.split('\n')
                 text = ""
                 start_pos = 0
@@ -561,16 +612,17 @@ def document_segments(request):
         topics_list.append(topic)
         class_index[topic_index_id] = class_id
 
+    text = document.get_text()
     new_text = ""
     cur_pos = 0
     for start_index, end_index, topic_index_id in segments:
         new_text += "%s<span class='tpc%d'>%s</span>" % (
-            document.text[int(cur_pos): int(start_index)],
+            text[int(cur_pos): int(start_index)],
             class_index[int(topic_index_id)],
-            document.text[int(start_index): int(end_index)]
+            text[int(start_index): int(end_index)]
         )
         cur_pos = end_index
-    new_text += document.text[int(cur_pos):]
+    new_text += text[int(cur_pos):]
 
     context["text"] = new_text.split("\n")
     context["topics_count"] = len(topics_list)
@@ -611,7 +663,8 @@ def visual_term(request):
         topics_index = Topic.objects.filter(
             model=model, layer=model.layers_count).order_by("index_id")
 
-        phi_row = model.get_phi()[term.index_id]
+        from models.matrices import get_row
+        phi_row = get_row(model.get_phi(), term.index_id)
         p_tw = phi_row[shift: shift + topics_count[model.layers_count]]
         p_tw = p_tw * np.array([t.probability for t in topics_index])
         p_tw = p_tw / np.sum(p_tw)
@@ -634,12 +687,6 @@ def visual_term(request):
         if weight_sum == 0:
             context['topics_all_zeros'] = True
 
-    if not term.documents_defined:
-        t = Thread(
-            target=Term.count_documents_index, args=(
-                term, ), daemon=True)
-        t.start()
-
     return render(request, 'datasets/term.html', Context(context))
 
 
@@ -710,19 +757,26 @@ def global_search(request):
         if len(search_query) < 3:
             context['message'] = "Query is too short."
         else:
-            docs_safe = Document.objects_safe(request)
             terms_safe = Term.objects_safe(request)
 
-            documents_file_name = docs_safe.filter(
-                text_id__icontains=search_query)
+            documents_file_name = []
+            documents_title = []
+            terms = []
+            # Datasets being loaded or failed to load aren't searched.
+            for dataset in Dataset.objects_safe(request).filter(
+                    status=0).order_by("id"):
+                documents_file_name.extend(
+                    dataset.search_substring("text_ids", search_query))
+                documents_title.extend(
+                    dataset.search_substring("titles", search_query))
+                terms.extend(dataset.search_substring("terms", search_query))
+
             context["documents_file_name"] = documents_file_name
             total_found += len(documents_file_name)
 
-            documents_title = docs_safe.filter(title__icontains=search_query)
             context["documents_title"] = documents_title
             total_found += len(documents_title)
 
-            terms = terms_safe.filter(text__icontains=search_query)
             if len(terms) != 0:
                 context["terms"] = terms
                 total_found += len(terms)
@@ -734,35 +788,62 @@ def global_search(request):
 
             parsed = search_query.split()
             if len(parsed) > 1:
-                query_length = len(parsed)
-                terms_try = terms_safe.filter(text=parsed[0])
+                from datasets.search import search
+                query_terms = list(terms_safe.filter(
+                    text__in=parsed).values_list(
+                    "dataset_id", "text", "index_id"))
+                datasets = Dataset.objects_safe(request).filter(
+                    id__in=set(term[0] for term in query_terms), status=0)
+                dataset_ids, document_ids, scores, matched_terms = search(
+                    datasets, query_terms, parsed)
+
+                # Documents and concordances are fetched only for the page
+                # of results being shown.
+                pages_count = (len(document_ids) - 1) // SEARCH_PAGE_SIZE + 1
+                try:
+                    page = min(max(int(request.GET["page"]), 1), pages_count)
+                except BaseException:
+                    page = 1
+                page_slice = slice((page - 1) * SEARCH_PAGE_SIZE,
+                                   page * SEARCH_PAGE_SIZE)
+                page_results = list(zip(dataset_ids[page_slice].tolist(),
+                                        document_ids[page_slice].tolist()))
+                # Bags of words and texts aren't loaded: texts for
+                # concordances are read from text store.
+                page_documents = dict()
+                for dataset in datasets.filter(
+                        id__in=set(d for d, i in page_results)):
+                    for document in Document.objects.filter(
+                            dataset=dataset,
+                            index_id__in=[i for d, i in page_results
+                                          if d == dataset.id]).defer(
+                            "text", "bag_of_words"):
+                        document.dataset = dataset
+                        page_documents[(dataset.id, document.index_id)] = \
+                            document
+
                 documents = []
-                for term in terms_try:
-                    try:
-                        other_terms = [
-                            terms_safe.get(
-                                dataset=term.dataset,
-                                text=parsed[i]).index_id for i in range(
-                                1,
-                                query_length)]
-                    except BaseException:
+                for dataset_id, index_id in page_results:
+                    # Posting may refer to document which is already deleted
+                    # or not inserted yet.
+                    document = page_documents.get((dataset_id, index_id))
+                    if document is None:
                         continue
-                    conc = [term.index_id] + other_terms
-
-                    for document in term.get_documents():
-                        match = True
-                        for iid in other_terms:
-                            if document.count_term(iid) == 0:
-                                match = False
-                        if match:
-                            documents.append({
-                                "document": document,
-                                "concordance": document.get_concordance(conc)
-                            })
+                    documents.append({
+                        "document": document,
+                        "concordance": document.get_concordance(
+                            matched_terms[dataset_id])
+                    })
 
                 if len(documents) != 0:
                     context["documents"] = documents
-                    total_found += len(documents)
+                    context["documents_page"] = page
+                    context["documents_pages_count"] = pages_count
+                    if page > 1:
+                        context["documents_prev_page"] = page - 1
+                    if page < pages_count:
+                        context["documents_next_page"] = page + 1
+                    total_found += len(document_ids)
 
         if total_found > 0:
             context['message'] = "Found " + str(total_found) + " results."
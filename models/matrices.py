@@ -0,0 +1,220 @@
+# Process-wide cache of matrices of models (phi, theta, psi).
+#
+# Matrices are opened from files as read-only memory-mapped arrays, so
+# reading a row doesn't read the whole matrix. Opened arrays are shared by
+# all requests served by process. Entry is keyed by model id and file name,
+# and is valid while modification time of file stays the same. Least
+# recently used matrices are dropped when total size of opened matrices
+# exceeds MODEL_MATRICES_CACHE_SIZE.
+#
+# Because readers keep files mapped, matrices must never be overwritten in
+# place: save_matrix writes new file and renames it over old one.
+#
+# Sparse matrix (phi or theta in sparse storage mode) is one .csr file with
+# consecutive .npy records of shape, data, indices and indptr of CSR matrix,
+# each aligned to SPARSE_ALIGNMENT bytes. It is replaced by rename as well,
+# so all parts which reader maps belong to the same matrix. Functions get_row,
+# get_rows, get_column and transpose read matrix in the same way whether it
+# is dense array or sparse matrix, and return dense arrays.
+
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+SPARSE_ALIGNMENT = 64
+
+# Number of rows of dense matrix converted to sparse at once.
+SPARSE_BLOCK_SIZE = 1 << 16
+
+
+class MatrixCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        # (model_id, file_name) -> (mtime, array)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, model_id, file_name):
+        key = (model_id, file_name)
+        mtime = os.stat(file_name).st_mtime_ns
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.entries.move_to_end(key)
+                return entry[1]
+        array = load_matrix(file_name)
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (mtime, array)
+            self.size += get_size(array)
+            # The newest matrix is kept even if it alone exceeds limit.
+            while self.size > self.max_size and len(self.entries) > 1:
+                self.remove(next(iter(self.entries)))
+        return array
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= get_size(entry[1])
+
+    def invalidate(self, model_id):
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] == model_id:
+                    self.remove(key)
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        from django.conf import settings
+        _cache = MatrixCache(getattr(settings, "MODEL_MATRICES_CACHE_SIZE",
+                                     1 << 32))
+    return _cache
+
+
+def save_matrix(file_name, array):
+    new_file_name = file_name + ".new.npy"
+    np.save(new_file_name, array)
+    os.replace(new_file_name, file_name)
+
+
+def load_matrix(file_name):
+    if file_name.endswith(".csr"):
+        return load_sparse_matrix(file_name)
+    return np.load(file_name, mmap_mode='r')
+
+
+def get_size(matrix):
+    if is_sparse(matrix):
+        return (matrix.data.nbytes + matrix.indices.nbytes +
+                matrix.indptr.nbytes)
+    return matrix.nbytes
+
+
+def load_sparse_matrix(file_name):
+    from scipy.sparse import csr_matrix
+    parts = []
+    with open(file_name, "rb") as f:
+        for i in range(4):
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            offset = f.tell()
+            size = int(np.prod(shape)) * dtype.itemsize
+            if size == 0:
+                parts.append(np.zeros(shape, dtype=dtype))
+            else:
+                parts.append(np.memmap(file_name, dtype=dtype, mode='r',
+                                       offset=offset, shape=shape))
+            f.seek(align(offset + size))
+    shape, data, indices, indptr = parts
+    return csr_matrix((data, indices, indptr), shape=tuple(shape.tolist()),
+                      copy=False)
+
+
+def align(position):
+    return -(-position // SPARSE_ALIGNMENT) * SPARSE_ALIGNMENT
+
+
+# Converts matrix to CSR, dropping elements not greater than threshold. If
+# top is given, only top elements of each row of dense matrix are kept (more
+# if there are equal elements).
+def to_sparse(matrix, threshold=0, dtype=np.float32, top=None):
+    from scipy.sparse import csr_matrix, vstack
+    if is_sparse(matrix):
+        matrix = matrix.tocsr().astype(dtype)
+        matrix.data[matrix.data <= threshold] = 0
+        matrix.eliminate_zeros()
+        return matrix
+    blocks = []
+    for begin in range(0, matrix.shape[0], SPARSE_BLOCK_SIZE):
+        block = np.asarray(matrix[begin: begin + SPARSE_BLOCK_SIZE])
+        keep = block > threshold
+        if top is not None and top < block.shape[1]:
+            kth = -np.partition(-block, top - 1, axis=1)[:, top - 1]
+            keep &= block >= kth[:, np.newaxis]
+        blocks.append(csr_matrix(np.where(keep, block, 0).astype(dtype)))
+    if len(blocks) == 0:
+        return csr_matrix(matrix.shape, dtype=dtype)
+    return vstack(blocks, format="csr")
+
+
+def save_sparse_matrix(file_name, matrix):
+    matrix = matrix.tocsr()
+    new_file_name = file_name + ".new"
+    with open(new_file_name, "wb") as f:
+        for array in [np.array(matrix.shape, dtype=np.int64), matrix.data,
+                      matrix.indices, matrix.indptr]:
+            np.lib.format.write_array(f, np.ascontiguousarray(array))
+            f.write(b"\0" * (align(f.tell()) - f.tell()))
+    os.replace(new_file_name, file_name)
+
+
+def is_sparse(matrix):
+    return hasattr(matrix, "toarray")
+
+
+def get_rows(matrix, rows, columns=slice(None)):
+    if is_sparse(matrix):
+        return matrix[rows][:, columns].toarray()
+    return np.asarray(matrix[rows][:, columns])
+
+
+def get_row(matrix, row):
+    if is_sparse(matrix):
+        return matrix.getrow(row).toarray().ravel()
+    return np.asarray(matrix[row])
+
+
+def get_column(matrix, column):
+    if is_sparse(matrix):
+        return matrix.getcol(column).toarray().ravel()
+    return np.asarray(matrix[:, column])
+
+
+# Transposed sparse matrix is converted to CSR, so its rows are read fast.
+def transpose(matrix):
+    if is_sparse(matrix):
+        return matrix.transpose().tocsr()
+    return matrix.transpose()
+
+
+# Accumulates, for each column of matrix read by blocks of rows, up to top
+# rows with the largest values, so matrix is read once for all columns.
+class TopRows:
+    def __init__(self, top):
+        self.top = top
+        self.rows = None
+        self.values = None
+
+    # Adds block of rows: values is dense array (rows x columns).
+    def add(self, rows, values):
+        rows = np.repeat(np.asarray(rows)[:, np.newaxis], values.shape[1],
+                         axis=1)
+        if self.rows is not None:
+            rows = np.vstack((self.rows, rows))
+            values = np.vstack((self.values, values))
+        if rows.shape[0] > self.top:
+            best = np.argpartition(-values, self.top - 1, axis=0)[:self.top]
+            columns = np.arange(values.shape[1])
+            rows = rows[best, columns]
+            values = values[best, columns]
+        self.rows = rows
+        self.values = values
+
+    # Returns rows and values for column, in descending order of values.
+    def get(self, column):
+        if self.rows is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        order = np.argsort(-self.values[:, column], kind="mergesort")
+        return self.rows[order, column], self.values[order, column]
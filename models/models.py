@@ -1,5 +1,6 @@
 from django.db import models
 from datasets.models import Dataset, Term, Document, Modality
+from datasets import codec
 from django.contrib.auth.models import User
 from datetime import datetime
 import os
@@ -11,7 +12,6 @@ import re
 from shutil import rmtree
 from django.db import transaction
 import traceback
-import struct
 import time
 import algo.arranging.metrics as metrics
 from models.bigartm_config import BANNED_WORDS
@@ -20,6 +20,14 @@ from django.dispatch import receiver
 from django.contrib import admin
 
 
+# Number of terms (rows of phi) read at once in reload.
+PHI_BLOCK_SIZE = 1 << 12
+
+# Number of documents (columns of theta) copied at once in gather_theta, and
+# read at once when all documents are compared with topics or each other.
+THETA_BLOCK_SIZE = 1 << 16
+
+
 class ArtmModel(models.Model):
     dataset = models.ForeignKey(Dataset, null=False)
     creation_time = models.DateTimeField(null=False, default=datetime.now)
@@ -262,35 +270,11 @@ class ArtmModel(models.Model):
                 phi = phi_raw.values
                 self.log("Matrix phi has correct index")
             else:
-                self.log(("WARNING! Matrix phi has wrong index. Will restore. "
-                          "In case of equal terms in different "
-                          "modalitites there will be errors."))
+                self.log("WARNING! Matrix phi has wrong index. Will restore.")
                 topics_count = phi_raw.shape[1]
                 phi = np.zeros((self.dataset.terms_count, topics_count))
-                self.log("Building terms index...")
-                terms_index = self.dataset.get_terms_index()
-                self.log("Terms index built.")
-
-                ctr = 0
-                for row in phi_raw.iterrows():
-                    term_text = row[0]
-                    try:
-                        term_matrix_id = terms_index[term_text]
-                    except BaseException:
-                        try:
-                            self.log(
-                                "WARNING! Word " + term_text +
-                                " don't belong to dataset dictionary.")
-                        except BaseException:
-                            self.log(("WARNING! Word (coludn't show) don't "
-                                      "belong to dataset dictionary."))
-                        continue
-                    for j in range(topics_count):
-                        phi[term_matrix_id][j] = row[1][j]
-
-                    if ctr % 10000 == 0:
-                        self.log(str(ctr))
-                    ctr += 1
+                self.put_phi_rows(phi, phi_raw,
+                                  self.dataset.get_terms_ids(phi_raw.index))
         else:
             self.log(("WARNING! Phi wasn't detected. "
                       "Will try load from matrices for modalities."))
@@ -303,8 +287,6 @@ class ArtmModel(models.Model):
                         modality.name +
                         ". Will load.")
                     phi_raw = pd.read_pickle(phi_path)
-                    terms_index = self.dataset.get_terms_index(
-                        modality=modality)
                     if phi is None:
                         topics_count = phi_raw.shape[1]
                         phi = np.zeros(
@@ -313,18 +295,8 @@ class ArtmModel(models.Model):
                         raise ValueError((
                             "Fatal error. "
                             "Matrices phi are of different width."))
-                    for row in phi_raw.iterrows():
-                        term_text = row[0]
-                        if term_text in terms_index:
-                            term_matrix_id = terms_index[term_text]
-                        else:
-                            self.log(
-                                "WARNING! Word " +
-                                term_text +
-                                " don't belong to dataset dictionary.")
-                            continue
-                        for j in range(topics_count):
-                            phi[term_matrix_id][j] = row[1][j]
+                    self.put_phi_rows(phi, phi_raw, self.dataset.get_terms_ids(
+                        phi_raw.index, modality=modality))
                 else:
                     self.log(
                         "Fatal error. Matrix for modality " +
@@ -336,39 +308,55 @@ class ArtmModel(models.Model):
 
         self.log("Matrix phi loaded.")
 
-        np.save(os.path.join(self.get_folder(), "phi.npy"), phi)
+        self.save_phi(phi)
+        self.invalidate_matrices()
         self.log("Matrix phi saved in numpy format.")
 
+    # Copies rows of phi_raw (DataFrame) to rows terms_ids of phi. Rows of
+    # terms, which aren't in dataset dictionary (terms_ids is -1), are skipped.
+    def put_phi_rows(self, phi, phi_raw, terms_ids):
+        known = terms_ids >= 0
+        unknown_count = len(terms_ids) - int(np.sum(known))
+        if unknown_count > 0:
+            self.log("WARNING! %d terms don't belong to dataset dictionary." %
+                     unknown_count)
+        phi[terms_ids[known]] = phi_raw.values[known]
+
+    # Columns of theta are matched with documents by index_id, or by text_id
+    # if there is no column with document index_id. Columns are copied by
+    # blocks into preallocated matrix, which is memory-mapped theta.npy if it
+    # is larger than THETA_MEMMAP_SIZE. Then it is saved as set by
+    # THETA_STORAGE (see save_theta). Layers of model must be known.
     def gather_theta(self):
         self.log("Loading matrix theta...")
         theta_raw = pd.read_pickle(os.path.join(self.get_folder(), "theta"))
         self.theta_index = theta_raw.index
-
-        if (1 in theta_raw
-                and theta_raw.shape[1] == self.dataset.documents_count):
-            self.log("Theta has correct index.")
-            theta = theta_raw.sort_index(axis=1).values
+        documents_count = self.dataset.documents_count
+        if theta_raw.shape[1] != documents_count:
+            self.log("WARNING! Not all documents are present in matrix.")
+
+        columns = ArtmModel.get_theta_columns(self.dataset, theta_raw.columns)
+        missing_count = documents_count - len(np.unique(columns[columns >= 0]))
+        if missing_count > 0:
+            self.log("WARNING! %d documents weren't found in matrix theta." %
+                     missing_count)
+
+        theta_path = os.path.join(self.get_folder(), "theta.npy")
+        topics_count = theta_raw.shape[0]
+        dtype = np.result_type(*theta_raw.dtypes)
+        if (topics_count * documents_count * dtype.itemsize >
+                getattr(settings, "THETA_MEMMAP_SIZE", 1 << 30)):
+            theta = np.lib.format.open_memmap(
+                theta_path + ".new", mode="w+", dtype=dtype,
+                shape=(topics_count, documents_count))
+            theta[:] = 0
         else:
-            self.log("Will load theta column by column.")
-            if theta_raw.shape[1] != self.dataset.documents_count:
-                self.log("WARNING! Not all documents are present in matrix.")
-            topics_count = theta_raw.shape[0]
-            theta = np.zeros((topics_count, self.dataset.documents_count))
-            for document in Document.objects.filter(dataset=self.dataset):
-                if document.index_id in theta_raw:
-                    column = theta_raw[document.index_id]
-                elif document.text_id in theta_raw:
-                    column = theta_raw[document.text_id]
-                else:
-                    self.log(
-                        "WARNING! Document " +
-                        document.text_id +
-                        " wasn't found in matrix theta.")
-                    continue
-
-                doc_matrix_id = document.index_id
-                for i in range(topics_count):
-                    theta[i][doc_matrix_id] = column[i]
+            theta = np.zeros((topics_count, documents_count), dtype=dtype)
+        for begin in range(0, len(columns), THETA_BLOCK_SIZE):
+            block = columns[begin: begin + THETA_BLOCK_SIZE]
+            known = np.nonzero(block >= 0)[0]
+            theta[:, block[known]] = \
+                theta_raw.iloc[:, begin + known].values
 
         self.log("Checking matrix theta...")
         ones = np.sum(theta, axis=0)
@@ -376,14 +364,77 @@ class ArtmModel(models.Model):
             self.log(str(ones))
             raise ValueError("Fuck! Not stochastic!")
 
-        self.log("Saving matrix theta...")
-        np.save(os.path.join(self.get_folder(), "theta.npy"), theta)
-        self.log("Matrix theta saved...")
-
         self.log("Counting topics probabilities using matrix theta")
         pt = np.sum(theta, axis=1) / self.dataset.documents_count
         np.save(os.path.join(self.get_folder(), "pt.npy"), pt)
 
+        self.log("Saving matrix theta...")
+        layers = [range(topics_count)]
+        if self.layers_count > 1:
+            layers = [self.get_layer_range(layer)
+                      for layer in range(1, self.layers_count + 1)]
+        self.save_theta(theta, layers)
+        self.invalidate_matrices()
+        self.log("Matrix theta saved...")
+
+    # Returns array of index_id's of documents for labels of columns of
+    # matrix theta (-1 for unknown documents). Label is index_id
+    # of document or its text_id; index_id's take precedence.
+    def get_theta_columns(dataset, labels):
+        labels = list(labels)
+        documents_count = dataset.documents_count
+        columns = np.full(len(labels), -1, dtype=np.int64)
+        by_index_id = np.zeros(documents_count, dtype=bool)
+        for i, label in enumerate(labels):
+            if (isinstance(label, (int, np.integer)) and
+                    0 <= label < documents_count):
+                columns[i] = label
+                by_index_id[label] = True
+        text_labels = [i for i in range(len(labels)) if columns[i] < 0]
+        if len(text_labels) > 0:
+            text_ids = dict(Document.objects.filter(
+                dataset=dataset).values_list("text_id", "index_id").iterator())
+            for i in text_labels:
+                index_id = text_ids.get(str(labels[i]), -1)
+                if index_id >= 0 and not by_index_id[index_id]:
+                    columns[i] = index_id
+        return columns
+
+    # Pads matrices phi and theta after documents were appended to dataset.
+    # New terms get zero rows in phi and new documents get zero columns in
+    # theta, until model is rebuilt.
+    def expand_matrices(self):
+        if self.has_phi():
+            from models.matrices import is_sparse
+            phi = self.get_phi()
+            new_rows = self.dataset.terms_count - phi.shape[0]
+            if new_rows > 0 and is_sparse(phi):
+                from scipy.sparse import csr_matrix, vstack
+                self.save_phi(vstack((phi, csr_matrix(
+                    (new_rows, phi.shape[1]), dtype=phi.dtype)), format="csr"))
+            elif new_rows > 0:
+                self.save_phi(np.vstack((phi, np.zeros(
+                    (new_rows, phi.shape[1]), dtype=phi.dtype))))
+
+        if self.has_theta():
+            from models.matrices import is_sparse, save_sparse_matrix
+            theta_t = self.get_theta_t()
+            new_rows = self.dataset.documents_count - theta_t.shape[0]
+            if new_rows > 0 and is_sparse(theta_t):
+                from scipy.sparse import csr_matrix, vstack
+                save_sparse_matrix(
+                    os.path.join(self.get_folder(), "theta.csr"),
+                    vstack((theta_t, csr_matrix(
+                        (new_rows, theta_t.shape[1]), dtype=theta_t.dtype))))
+            elif new_rows > 0:
+                theta = theta_t.transpose()
+                self.save_matrix("theta", np.hstack((theta, np.zeros(
+                    (theta.shape[0], new_rows), dtype=theta.dtype))))
+
+        self.invalidate_matrices()
+        self.delete_cached_distances()
+        self.reset_visuals()
+
     # Get probabilities of topics on certain layer
     def get_pt(self, layer=1):
         if layer == 0:
@@ -459,40 +510,53 @@ class ArtmModel(models.Model):
             return
 
         self.log("Extracting documents in topics for layer %d..." % layer)
+        from models.matrices import get_rows
         threshold_docs = self.threshold_docs / 100.0
-        topics_count = [int(x) for x in self.topics_count.split()]
-        total_topics_count = sum(topics_count) - 1
-        theta_t = self.get_theta().transpose()[:, self.get_layer_range(layer)]
-        document_bags = [[] for i in range(topics_count[self.layers_count])]
-        for doc_index_id in range(0, self.dataset.documents_count):
-            # doc_id = documents_index[doc_index_id].id
-            distr = theta_t[doc_index_id]
-            best_topic_id = distr.argmax()
-
-            document_bags[best_topic_id].append(
-                (distr[best_topic_id], doc_index_id))
+        layer_range = self.get_layer_range(layer)
+        theta_t = self.get_theta_t()
+        documents_count = theta_t.shape[0]
+
+        # Document gets into its best topic and into topics with weight
+        # greater than threshold. Rows of theta are read by blocks, so
+        # sparse theta is never made dense entirely.
+        topics = [np.zeros(0, dtype=np.int64)]
+        documents = [np.zeros(0, dtype=np.int64)]
+        weights = [np.zeros(0)]
+        for begin in range(0, documents_count, THETA_BLOCK_SIZE):
+            block = get_rows(
+                theta_t, slice(begin, begin + THETA_BLOCK_SIZE),
+                slice(layer_range.start, layer_range.stop))
+            # Documents without weights in layer (possible if theta is
+            # sparse) get into no topics.
+            selected = np.zeros(block.shape, dtype=bool)
+            rows = np.nonzero(block.max(axis=1) > 0)[0]
+            selected[rows, block[rows].argmax(axis=1)] = True
             if threshold_docs <= 0.5:
-                for topic_id in range(topics_count[self.layers_count]):
-                    if (distr[topic_id] > threshold_docs and
-                            topic_id != best_topic_id):
-                        document_bags[topic_id].append(
-                            distr[topic_id], doc_index_id)
-
-            if doc_index_id % 1000 == 0:
-                self.log(str(doc_index_id))
-
-        self.log("Building topics index...")
+                selected |= block > threshold_docs
+            rows, columns = np.nonzero(selected)
+            topics.append(columns)
+            documents.append(rows + begin)
+            weights.append(block[rows, columns])
+            self.log(str(begin + block.shape[0]))
+        topics = np.concatenate(topics)
+        documents = np.concatenate(documents)
+        weights = np.concatenate(weights)
+
+        # Documents of each topic go in descending order of weight.
+        order = np.lexsort((-documents, -weights, topics))
+        topics = topics[order]
+        documents = documents[order]
+        weights = weights[order]
+        bounds = np.searchsorted(topics, np.arange(len(layer_range) + 1))
 
         self.log("Saving topics...")
         for topic in Topic.objects.filter(
                 model=self, layer=layer).order_by("index_id"):
-            topic.documents = bytes()
-            document_bags[topic.index_id].sort(reverse=True)
-            for weight, doc_index_id in document_bags[topic.index_id]:
-                topic.documents += \
-                    struct.pack('I', doc_index_id) + \
-                    struct.pack('f', weight)
-            topic.documents_count = len(topic.documents) // 8
+            begin = bounds[topic.index_id]
+            end = bounds[topic.index_id + 1]
+            topic.documents = codec.encode_topic_documents(
+                documents[begin: end], weights[begin: end])
+            topic.documents_count = int(end - begin)
             topic.save()
 
     def build_topics_index(self):
@@ -518,14 +582,12 @@ class ArtmModel(models.Model):
 
         rmtree(self.get_visual_folder())
         rmtree(self.get_dist_folder())
+        self.invalidate_matrices()
 
         # Loading matrices
+        from models.matrices import get_rows, TopRows
         self.gather_phi()
         phi = self.get_phi()
-        phi_t = phi.transpose()
-
-        self.gather_theta()
-        theta = self.get_theta()
 
         self.layers_count = 1
         psi = [0]
@@ -534,18 +596,23 @@ class ArtmModel(models.Model):
             if os.path.exists(path):
                 self.log("Loading matrix psi" + str(i))
                 psi.append(pd.read_pickle(path).values)
-                np.save(os.path.join(path + ".npy"), psi[i])
+                self.save_matrix("psi" + str(i), psi[i])
                 self.layers_count = i + 1
             else:
                 break
 
         self.log("Counting topics...")
-        if self.layers_count == 1:
-            self.topics_count = "1 " + str(theta.shape[0])
-        else:
+        if self.layers_count > 1:
             self.topics_count = "1 " + str(psi[1].shape[1])
             for layer_id in range(1, self.layers_count):
                 self.topics_count += " " + str(psi[layer_id].shape[0])
+
+        # Layers are known before theta is gathered, as sparse theta is cut
+        # by layers.
+        self.gather_theta()
+        theta_t = self.get_theta_t()
+        if self.layers_count == 1:
+            self.topics_count = "1 " + str(theta_t.shape[1])
         self.log("Topics number: " + self.topics_count)
 
         terms_count = self.dataset.terms_count
@@ -591,12 +658,33 @@ class ArtmModel(models.Model):
         terms_weights = self.dataset.get_terms_weights("naming")
 
         # Number of unique terms in each document
-        # TODO: cache this value
-        nd = np.array([doc.terms_count for doc in Document.objects.filter(
-            dataset=self.dataset).order_by("index_id")])
+        nd = self.dataset.get_documents_columns(
+            "terms_count")[0].astype(np.float64)
 
         # Total number of unique words in collection
         n = np.sum(nd)
+        probabilities = np.asarray(theta_t.transpose().dot(nd)).ravel() / n
+
+        # Top terms of each modality and terms for title are found for all
+        # topics in one pass over phi by blocks of rows, so phi, which may
+        # not fit in memory, is read once rather than once per topic.
+        self.log("Finding top terms of topics...")
+        terms_modalities = np.array([term.modality_id
+                                     for term in terms_index])
+        terms_banned = np.array([term.text in banned_words
+                                 for term in terms_index], dtype=bool)
+        top_terms = dict((modality_id, TopRows(top_terms_size))
+                         for modality_id in np.unique(terms_modalities))
+        title_terms = TopRows(title_size)
+        for begin in range(0, phi.shape[0], PHI_BLOCK_SIZE):
+            block = get_rows(phi, slice(begin, begin + PHI_BLOCK_SIZE))
+            rows = np.arange(begin, begin + block.shape[0])
+            for modality_id, top in top_terms.items():
+                mask = terms_modalities[rows] == modality_id
+                top.add(rows[mask], block[mask])
+            mask = ~terms_banned[rows]
+            title_terms.add(rows[mask], block[mask] *
+                            terms_weights[rows[mask], np.newaxis])
 
         row_counter = 0
         for layer_id in range(1, self.layers_count + 1):
@@ -606,51 +694,31 @@ class ArtmModel(models.Model):
                 topic.index_id = topic_id
                 topic.layer = layer_id
                 topic.matrix_id = row_counter
-                topic.probability = np.dot(theta[row_counter], nd) / n
+                topic.probability = probabilities[row_counter]
                 topic.save()
 
                 # Naming and top words extracting
-                distr = phi_t[row_counter]
-                idx = np.argsort(distr)
-                idx = idx[::-1]
-                mc = self.dataset.modalities_count
-                top_terms_counter = dict()
-
-                for i in idx:
-                    weight = distr[i]
-                    if weight == 0:
-                        break
-                    term = terms_index[int(i)]
-                    mid = term.modality_id
-                    if mid not in top_terms_counter:
-                        top_terms_counter[mid] = 0
-                    if top_terms_counter[mid] < top_terms_size:
-                        relation = TopTerm()
-                        relation.topic = topic
-                        relation.term = term
-                        relation.weight = weight
-                        relation.weight_normed = weight * terms_weights[i]
-                        relation.save()
-
-                        top_terms_counter[mid] += 1
-                        if top_terms_counter[mid] == top_terms_size:
-                            mc -= 1
-                        if mc == 0:
-                            break
+                idx = []
+                weights = []
+                for top in top_terms.values():
+                    rows, values = top.get(row_counter)
+                    idx.append(rows[values > 0])
+                    weights.append(values[values > 0])
+                idx = np.concatenate(idx)
+                weights = np.concatenate(weights)
+                for j in np.argsort(-weights, kind="mergesort"):
+                    i = int(idx[j])
+                    relation = TopTerm()
+                    relation.topic = topic
+                    relation.term = terms_index[i]
+                    relation.weight = weights[j]
+                    relation.weight_normed = weights[j] * terms_weights[i]
+                    relation.save()
 
                 if 'topic' in topic_names[layer_id][topic_id]:
-                    terms_to_title = []
-                    title_counter = 0
-                    idx = np.argsort(phi_t[row_counter] * terms_weights)
-                    idx = idx[::-1]
-                    for i in idx:
-                        term = terms_index[int(i)]
-                        if title_counter < title_size:
-                            if term.text not in banned_words:
-                                title_counter += 1
-                                terms_to_title.append(term.text)
-                        else:
-                            break
+                    terms_to_title = [
+                        terms_index[int(i)].text
+                        for i in title_terms.get(row_counter)[0]]
                     topic.title = ', '.join(terms_to_title)
                     topic.title_multiline = '\n'.join(terms_to_title)
                 else:
@@ -719,9 +787,11 @@ class ArtmModel(models.Model):
         topics_index = Topic.objects.filter(
             model=self, layer=topic.layer).order_by("index_id")
 
+        from models.matrices import get_row
         phi_t = self.get_phi_t_norm(topic.layer)
-        target_row = phi_t[topic.index_id]
-        distances = [metric(target_row, row) for row in phi_t]
+        target_row = get_row(phi_t, topic.index_id)
+        distances = [metric(target_row, get_row(phi_t, i))
+                     for i in range(phi_t.shape[0])]
         idx = np.argsort(distances)
         return [
             {"distance": distances[int(i)],
@@ -750,13 +820,15 @@ class ArtmModel(models.Model):
             topics_count = [int(x) for x in self.topics_count.split()]
             ret = np.zeros((topics_count[layer], topics_count[layer]))
 
+            from models.matrices import get_row
             phi_t = self.get_phi_t_norm(layer)
 
             metric = metrics.get_metric_by_name(metric)
 
             for i in range(topics_count[layer]):
+                row = get_row(phi_t, i)
                 for j in range(topics_count[layer]):
-                    ret[i][j] = metric(phi_t[i], phi_t[j])
+                    ret[i][j] = metric(row, get_row(phi_t, j))
             np.save(matrix_name, ret)
         return ret
 
@@ -961,31 +1033,137 @@ class ArtmModel(models.Model):
             os.makedirs(path)
         return path
 
+    # Matrices are read-only memory-mapped arrays shared between requests
+    # (see models.matrices). Sparse matrices have extension ".csr".
+    def get_matrix(self, name, extension=".npy"):
+        from models.matrices import get_cache
+        return get_cache().get(
+            self.id, os.path.join(self.get_folder(), name + extension))
+
+    # Saves matrix without overwriting file, which may be mapped by readers.
+    def save_matrix(self, name, matrix):
+        from models.matrices import save_matrix
+        save_matrix(os.path.join(self.get_folder(), name + ".npy"), matrix)
+
+    # Drops cached matrices of model, including normalized phi kept in this
+    # object.
+    def invalidate_matrices(self):
+        from models.matrices import get_cache
+        get_cache().invalidate(self.id)
+        if hasattr(self, "phi_t_norm"):
+            del self.phi_t_norm
+
+    # Matrix phi is dense array in phi.npy, or sparse CSR matrix in phi.csr
+    # (see models.matrices), depending on PHI_STORAGE setting when it was
+    # saved. Code reading phi should use functions from models.matrices,
+    # which work with both forms.
     def get_phi(self):
-        return np.load(os.path.join(self.get_folder(), "phi.npy"))
+        if os.path.exists(os.path.join(self.get_folder(), "phi.csr")):
+            return self.get_matrix("phi", ".csr")
+        return self.get_matrix("phi")
+
+    def has_phi(self):
+        return (os.path.exists(os.path.join(self.get_folder(), "phi.npy")) or
+                os.path.exists(os.path.join(self.get_folder(), "phi.csr")))
+
+    # Saves phi in form given by PHI_STORAGE setting: "float64" or "float32"
+    # dense array, or "sparse" matrix without elements not greater than
+    # PHI_SPARSE_THRESHOLD.
+    def save_phi(self, phi):
+        from models.matrices import is_sparse, to_sparse, save_sparse_matrix
+        storage = getattr(settings, "PHI_STORAGE", "float64")
+        dense_file = os.path.join(self.get_folder(), "phi.npy")
+        sparse_file = os.path.join(self.get_folder(), "phi.csr")
+        if storage == "sparse":
+            save_sparse_matrix(sparse_file, to_sparse(
+                phi, getattr(settings, "PHI_SPARSE_THRESHOLD", 0)))
+            if os.path.exists(dense_file):
+                os.remove(dense_file)
+        else:
+            if is_sparse(phi):
+                phi = phi.toarray()
+            if storage == "float32":
+                phi = phi.astype(np.float32)
+            self.save_matrix("phi", phi)
+            if os.path.exists(sparse_file):
+                os.remove(sparse_file)
+
+    # Matrix theta is dense topics x documents array in theta.npy, or sparse
+    # documents x topics CSR matrix in theta.csr, depending on THETA_STORAGE
+    # setting when it was saved. Rows of get_theta_t() are documents in both
+    # cases; they should be read with functions from models.matrices.
+    def get_theta_t(self):
+        if os.path.exists(os.path.join(self.get_folder(), "theta.csr")):
+            return self.get_matrix("theta", ".csr")
+        return self.get_matrix("theta").transpose()
 
     def get_theta(self):
-        try:
-            return self.theta
-        except BaseException:
-            self.theta = np.load(os.path.join(self.get_folder(), "theta.npy"))
-            return self.theta
+        return self.get_theta_t().transpose()
+
+    def has_theta(self):
+        return (os.path.exists(os.path.join(self.get_folder(), "theta.npy")) or
+                os.path.exists(os.path.join(self.get_folder(), "theta.csr")))
+
+    # Saves theta, given as dense topics x documents array, in form given by
+    # THETA_STORAGE setting: "dense" array, or "sparse" matrix, which keeps
+    # for each document at most THETA_SPARSE_TOP topics of each layer (layers
+    # are ranges of rows of theta) with weights greater than
+    # THETA_SPARSE_THRESHOLD. Array written to memory-mapped file is renamed,
+    # not copied.
+    def save_theta(self, theta, layers):
+        from models.matrices import to_sparse, save_sparse_matrix
+        dense_file = os.path.join(self.get_folder(), "theta.npy")
+        sparse_file = os.path.join(self.get_folder(), "theta.csr")
+        # Writable memory-mapped array is temporary file of gather_theta.
+        written = isinstance(theta, np.memmap) and theta.mode != "r"
+        if getattr(settings, "THETA_STORAGE", "dense") == "sparse":
+            from scipy.sparse import hstack
+            theta_t = theta.transpose()
+            save_sparse_matrix(sparse_file, hstack([to_sparse(
+                theta_t[:, layer.start: layer.stop],
+                getattr(settings, "THETA_SPARSE_THRESHOLD", 0),
+                top=getattr(settings, "THETA_SPARSE_TOP", None))
+                for layer in layers], format="csr"))
+            if written:
+                os.remove(theta.filename)
+            if os.path.exists(dense_file):
+                os.remove(dense_file)
+        else:
+            if written:
+                theta.flush()
+                os.replace(theta.filename, dense_file)
+            else:
+                self.save_matrix("theta", theta)
+            if os.path.exists(sparse_file):
+                os.remove(sparse_file)
+
+    # Returns weights of topics of given layer in document.
+    def get_document_theta(self, document_index_id, layer):
+        from models.matrices import get_row
+        layer_range = self.get_layer_range(layer)
+        return get_row(self.get_theta_t(), document_index_id)[
+            layer_range.start: layer_range.stop]
 
     # Return phi transposed and normalized by modalities weights, for distance
-    # counting.
+    # counting. If phi is sparse, result is sparse too.
     def get_phi_t_norm(self, layer):
+        from models.matrices import is_sparse, transpose
         if not hasattr(self, "phi_t_norm"):
             self.phi_t_norm = dict()
         if layer not in self.phi_t_norm:
-            phi_t_norm = self.get_phi().transpose()[
-                self.get_layer_range(layer)]
+            layer_range = self.get_layer_range(layer)
+            phi_t_norm = transpose(
+                self.get_phi()[:, layer_range.start: layer_range.stop])
 
             if self.dataset.modalities_count > 1:
                 self.log("Normalizing phi according to modalitites weights...")
-                phi_t_norm = phi_t_norm * \
-                    self.dataset.get_terms_weights("spectrum")
+                weights = self.dataset.get_terms_weights("spectrum")
+                if is_sparse(phi_t_norm):
+                    phi_t_norm = phi_t_norm.multiply(weights).tocsr()
+                else:
+                    phi_t_norm = phi_t_norm * weights
                 self.log("Normalized.")
-                sums = np.sum(phi_t_norm, axis=1)
+                sums = np.asarray(phi_t_norm.sum(axis=1)).ravel()
                 if np.min(sums) < 0.95 or np.max(sums) > 1.05:
                     print(sums)
                     raise RuntimeError("Phi is not stochastic!")
@@ -993,20 +1171,8 @@ class ArtmModel(models.Model):
             self.phi_t_norm[layer] = phi_t_norm
         return self.phi_t_norm[layer]
 
-    def get_theta_t(self):
-        try:
-            return self.theta_t
-        except BaseException:
-            self.theta_t = self.get_theta().transpose()
-            return self.theta_t
-
     def get_psi(self, i):
-        return np.load(
-            os.path.join(
-                self.get_folder(),
-                "psi" +
-                str(i) +
-                ".npy"))
+        return self.get_matrix("psi" + str(i))
 
     def lower_topics_count(self):
         return int(self.topics_count.split()[-1])
@@ -1022,16 +1188,16 @@ class ArtmModel(models.Model):
     def group_matrix(self, group_by="day", named_groups=False):
         from algo.utils.date_namer import DateNamer
         # from models.models import Topic
-        documents = Document.objects.filter(dataset=self.dataset)
+        ids, times = self.dataset.get_documents_columns("id", "time")
         topics = Topic.objects.filter(
             model=self, layer=self.layers_count).order_by("spectrum_index")
         topics_count = len(topics)
         dn = DateNamer(group_by=group_by, lang=self.dataset.language)
 
-        dates_hashes = set()
-        for document in documents:
-            dates_hashes.add(dn.date_hash(document.time))
-        dates_hashes = sorted(dates_hashes)
+        # Documents without time (or missing) aren't grouped.
+        documents_dates = [None if time is None else dn.date_hash(time)
+                           for time in times.tolist()]
+        dates_hashes = sorted(set(documents_dates) - {None})
         dates = []
         dates_reverse_index = dict()
 
@@ -1048,9 +1214,11 @@ class ArtmModel(models.Model):
 
         for topic in topics:
             y = topic.spectrum_index
-            for document in topic.get_documents():
-                x = dates_reverse_index[dn.date_hash(document.time)]
-                cells[x][y].append(document.id)
+            for index_id in topic.get_documents_index_ids():
+                if documents_dates[index_id] is None:
+                    continue
+                x = dates_reverse_index[documents_dates[index_id]]
+                cells[x][y].append(ids[index_id])
 
         return cells, dates
 
@@ -1061,19 +1229,21 @@ class ArtmModel(models.Model):
             document_index_id,
             count=20,
             metric="euclidean"):
-        documents_count = self.dataset.documents_count
-        documents_index = Document.objects.filter(
-            dataset=self.dataset).order_by("index_id")
-        dist = np.zeros(documents_count)
+        from models.matrices import get_row, get_rows
         theta_t = self.get_theta_t()
-        self_distr = theta_t[document_index_id]
+        documents_count = theta_t.shape[0]
+        dist = np.zeros(documents_count)
+        self_distr = get_row(theta_t, document_index_id)
         metric = metrics.get_metric_by_name(metric)
-        for other_document_id in range(0, documents_count):
-            dist[other_document_id] = metric(
-                self_distr, theta_t[other_document_id])
+        for begin in range(0, documents_count, THETA_BLOCK_SIZE):
+            block = get_rows(theta_t, slice(begin, begin + THETA_BLOCK_SIZE))
+            for i, other_distr in enumerate(block):
+                dist[begin + i] = metric(self_distr, other_distr)
 
-        idx = np.argsort(dist)[1: count + 1]
-        return [documents_index[int(i)] for i in idx]
+        idx = [int(i) for i in np.argsort(dist)[1: count + 1]]
+        documents = Document.get_by_index_ids(Document.brief(
+            Document.objects.filter(dataset=self.dataset)), idx)
+        return [documents[i] for i in idx if i in documents]
 
     def segmentation_available(self, document):
         return os.path.exists(
@@ -1139,16 +1309,22 @@ class Topic(models.Model):
         self.title_short = new_title[0:30]
         self.save()
 
+    # Yields documents of topic without texts, word indexes and bags of words
+    # (see Document.brief).
     def get_documents(self):
-        all_documents = Document.objects.filter(dataset=self.model.dataset)
-        for i in range(self.documents_count):
-            doc_index_id = struct.unpack(
-                'I', self.documents[8 * i: 8 * i + 4])[0]
-            yield all_documents.get(index_id=doc_index_id)
+        dataset = self.model.dataset
+        index_ids = self.get_documents_index_ids()
+        documents = Document.get_by_index_ids(
+            Document.brief(Document.objects.filter(dataset=dataset)),
+            index_ids)
+        for doc_index_id in index_ids:
+            document = documents[doc_index_id]
+            document.dataset = dataset
+            yield document
 
     def get_documents_index_ids(self):
-        return [struct.unpack('I', self.documents[8 * i: 8 * i + 4])[0]
-                for i in range(self.documents_count)]
+        documents = codec.decode(self.documents, codec.TOPIC_DOCUMENTS_DTYPE)
+        return documents["document"][:self.documents_count].tolist()
 
     def top_words_html(self, count=10):
         ret = ""
@@ -1,3 +1,86 @@
-from django.test import TestCase
+import unittest
+import tempfile
+import os
+import numpy as np
 
-# Create your tests here.
+from .matrices import (MatrixCache, TopRows, save_matrix,
+                       save_sparse_matrix, to_sparse, get_row, get_column,
+                       transpose)
+
+
+class TestMatrixCache(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+
+    def test_cache(self):
+        phi_file = os.path.join(self.folder, "phi.npy")
+        theta_file = os.path.join(self.folder, "theta.npy")
+        save_matrix(phi_file, np.ones((10, 10)))
+        save_matrix(theta_file, np.zeros((10, 10)))
+
+        cache = MatrixCache(1000)
+        phi = cache.get(1, phi_file)
+        self.assertIs(cache.get(1, phi_file), phi)
+        with self.assertRaises(ValueError):
+            phi[0, 0] = 2
+
+        # Only the most recently used matrix fits into limit.
+        cache.get(1, theta_file)
+        self.assertEqual(list(cache.entries), [(1, theta_file)])
+
+        cache.invalidate(1)
+        self.assertEqual(cache.size, 0)
+
+
+class TestSparseMatrices(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+
+    def test_save(self):
+        file_name = os.path.join(self.folder, "phi.csr")
+        phi = to_sparse(np.array([[0.5, 0.0, 0.1], [0.0, 0.0, 0.0]]))
+        save_sparse_matrix(file_name, phi)
+        cache = MatrixCache(1000)
+        loaded = cache.get(1, file_name)
+        self.assertEqual(loaded.shape, (2, 3))
+        self.assertTrue(np.allclose(loaded.toarray(), phi.toarray()))
+        self.assertIs(cache.get(1, file_name), loaded)
+
+        # Matrix is replaced as a whole, even if number of elements changes.
+        save_sparse_matrix(file_name, to_sparse(np.zeros((4, 1))))
+        self.assertEqual(cache.get(1, file_name).shape, (4, 1))
+        self.assertEqual(cache.get(1, file_name).nnz, 0)
+
+    def test_sparse(self):
+        phi = np.array([[0.5, 0.0], [0.01, 0.2], [0.49, 0.8]])
+        sparse_phi = to_sparse(phi, threshold=0.1)
+        self.assertEqual(sparse_phi.nnz, 4)
+        for matrix in [phi, sparse_phi]:
+            self.assertTrue(np.allclose(get_row(matrix, 2), [0.49, 0.8]))
+            self.assertTrue(np.allclose(get_column(matrix, 1),
+                                        [0.0, 0.2, 0.8]))
+            self.assertTrue(np.allclose(get_row(transpose(matrix), 0),
+                                        get_column(matrix, 0), atol=0.02))
+
+    def test_sparse_top(self):
+        theta_t = np.array([[0.1, 0.5, 0.4], [0.2, 0.2, 0.6]])
+        sparse_theta_t = to_sparse(theta_t, top=1)
+        self.assertTrue(np.allclose(sparse_theta_t.toarray(),
+                                    [[0.0, 0.5, 0.0], [0.0, 0.0, 0.6]]))
+
+
+class TestTopRows(unittest.TestCase):
+    def test_blocks(self):
+        matrix = np.array([[0.1, 0.9], [0.7, 0.0], [0.3, 0.5], [0.8, 0.2]])
+        top = TopRows(2)
+        for begin in range(0, 4, 3):
+            top.add(np.arange(begin, min(begin + 3, 4)),
+                    matrix[begin: begin + 3])
+        rows, values = top.get(0)
+        self.assertEqual(rows.tolist(), [3, 1])
+        self.assertTrue(np.allclose(values, [0.8, 0.7]))
+        self.assertEqual(top.get(1)[0].tolist(), [0, 2])
@@ -62,7 +62,8 @@ def visual_model(request):
         ret += pd.read_pickle(os.path.join(model.get_folder(),
                                            "phi"))[0:head].to_html() + "<br>"
 
-        phi = model.get_phi()
+        from models.matrices import get_rows
+        phi = get_rows(model.get_phi(), list(range(head)))
         for i in range(head):
             for j in range(phi.shape[1]):
                 ret += ("%.05f " % phi[i][j])
@@ -72,9 +73,11 @@ def visual_model(request):
         ret += pd.read_pickle(os.path.join(model.get_folder(),
                                            "theta"))[0:head].to_html()
 
-        theta = model.get_theta()
+        theta_t = model.get_theta_t()
+        theta = get_rows(
+            theta_t, list(range(min(theta_t.shape[0], head)))).transpose()
         for i in range(min(theta.shape[0], head)):
-            for j in range(min(theta.shape[1], head)):
+            for j in range(theta.shape[1]):
                 ret += ("%.02e " % theta[i][j])
             ret += "<br>"
 
@@ -310,13 +313,13 @@ def visual_topic(request):
         for modality in Modality.objects.filter(dataset=model.dataset):
             mod_index[modality.id] = modality.name
 
+        from models.matrices import get_column
         ans = ""
-        phi = model.get_phi()
+        phi_column = get_column(model.get_phi(), topic.matrix_id)
         for term in terms:
             ans += "%s %s %f<br>" % (term.text,
                                      mod_index[term.modality_id],
-                                     phi[term.index_id,
-                                         topic.matrix_id])
+                                     phi_column[term.index_id])
         return HttpResponse(ans)
 
     if 'mode' in request.GET:
@@ -1,6 +1,6 @@
 from django.shortcuts import render
 from django.http import (HttpResponse, HttpResponseForbidden,
-                         HttpResponseRedirect)
+                         HttpResponseRedirect, StreamingHttpResponse)
 from algo.tools.vkloader import download_wall
 import algo.tools.converters as conv
 from django.conf import settings
@@ -13,16 +13,39 @@ import io
 from django.contrib.auth.decorators import login_required
 
 
-@contextmanager
-def get_temp_folder():
+def make_temp_folder():
     folder = os.path.join(
         settings.DATA_DIR, "temp", str(
             datetime.now().timestamp()))
     os.makedirs(folder)
+    return folder
+
+
+@contextmanager
+def get_temp_folder():
+    folder = make_temp_folder()
     yield folder
     rmtree(folder)
 
 
+# Returns response, which streams file from temp folder and then deletes
+# the folder, so converted files of any size aren't loaded into memory.
+def stream_file(file_name, folder, attachment_name):
+    def chunks():
+        try:
+            with open(file_name, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    yield chunk
+        finally:
+            rmtree(folder)
+
+    response = StreamingHttpResponse(
+        chunks(), content_type='application/octet-stream')
+    response['Content-Disposition'] = (
+        'attachment; filename=%s' % attachment_name)
+    return response
+
+
 def tools_list(request):
     return render(request, 'tools/tools_list.html')
 
@@ -30,7 +53,8 @@ def tools_list(request):
 @login_required
 def vw2uci(request):
     if request.method == 'POST':
-        with get_temp_folder() as folder:
+        folder = make_temp_folder()
+        try:
             vw_file = os.path.join(folder, "vw")
             docword_file = os.path.join(folder, "docword")
             vocab_file = os.path.join(folder, "vocab")
@@ -40,18 +64,16 @@ def vw2uci(request):
                     f.write(chunk)
 
             conv.vw2uci(vw_file, docword_file, vocab_file)
+            os.remove(vw_file)
 
-            outfile = io.BytesIO()
-            with zipfile.ZipFile(outfile, 'w') as zf:
+            zip_file = os.path.join(folder, "uci.zip")
+            with zipfile.ZipFile(zip_file, 'w') as zf:
                 zf.write(docword_file, "docword.%s.txt" % name)
                 zf.write(vocab_file, "vocab.%s.txt" % name)
-
-            zipped_file = outfile.getvalue()
-            response = HttpResponse(
-                zipped_file, content_type='application/octet-stream')
-            response['Content-Disposition'] = (
-                'attachment; filename=%s.uci.zip' % name)
-            return response
+        except BaseException:
+            rmtree(folder)
+            raise
+        return stream_file(zip_file, folder, "%s.uci.zip" % name)
 
     return render(request, 'tools/vw2uci.html')
 
@@ -64,7 +86,8 @@ class Logger:
 @login_required
 def uci2vw(request):
     if request.method == 'POST':
-        with get_temp_folder() as folder:
+        folder = make_temp_folder()
+        try:
             docword_file = os.path.join(folder, "docword")
             vocab_file = os.path.join(folder, "vocab")
             try:
@@ -86,13 +109,10 @@ def uci2vw(request):
                 logger = None
 
             conv.uci2vw(docword_file, vocab_file, output_file, logger=logger)
-
-            with open(output_file) as f:
-                response = HttpResponse(
-                    f.read(), content_type='application/octet-stream')
-            response['Content-Disposition'] = (
-                'attachment; filename=%s.txt' % name)
-            return response
+        except BaseException:
+            rmtree(folder)
+            raise
+        return stream_file(output_file, folder, "%s.txt" % name)
 
     return render(request, 'tools/uci2vw.html')
 
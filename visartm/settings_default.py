@@ -13,6 +13,46 @@ ALLOWED_HOSTS = ["127.0.0.1"]
 
 THREADING = True
 
+# Loading documents of dataset: number of worker processes which parse vw.txt
+# and number of documents parsed by worker at once.
+DATASET_LOADER_WORKERS = os.cpu_count() or 1
+DATASET_LOADER_CHUNK_SIZE = 1000
+
+# Parsing texts of dataset: number of worker processes.
+DATASET_PARSER_WORKERS = os.cpu_count() or 1
+# File of lemmas cache, shared by all datasets.
+LEMMA_CACHE_FILE = os.path.join(DATA_DIR, "lemmas.sqlite3")
+
+# Uploading archives of datasets: number of threads which extract small
+# files, and maximal total size of extracted files (None means no limit).
+DATASET_UPLOAD_WORKERS = 4
+DATASET_UPLOAD_MAX_SIZE = 1 << 36
+
+# Filtering vocabulary: approximate memory (in bytes) for counts of terms.
+# When counts take more, they are spilled to disk. None means no limit.
+VOCAB_FILTER_MEMORY_LIMIT = 1 << 30
+
+# Loading matrix theta of model: if it takes more bytes, it is written
+# straight to memory-mapped file instead of memory.
+THETA_MEMMAP_SIZE = 1 << 30
+
+# Total size (in bytes) of memory-mapped matrices of models, kept open by
+# each process between requests.
+MODEL_MATRICES_CACHE_SIZE = 1 << 32
+
+# Storage of matrix phi of models: "float64" or "float32" dense array, or
+# "sparse" matrix, which keeps only elements greater than
+# PHI_SPARSE_THRESHOLD.
+PHI_STORAGE = "float64"
+PHI_SPARSE_THRESHOLD = 0
+
+# Storage of matrix theta of models: "dense" array, or "sparse" matrix,
+# which keeps for each document only THETA_SPARSE_TOP topics of each layer
+# (all if None) with weights greater than THETA_SPARSE_THRESHOLD.
+THETA_STORAGE = "dense"
+THETA_SPARSE_TOP = None
+THETA_SPARSE_THRESHOLD = 0
+
 REGISTRATION_CLOSED = False
 
 DEFAULT_FROM_EMAIL = 'visartm@yandex.ru'